@@ -23,6 +23,42 @@ def run_always(f):
     return f
 
 
+def _next_true(mask, i):
+    """
+    Returns the position of the first True in mask after position i, the
+    length of the mask if there is none (see Algo.next_run).
+    """
+    k = mask[i + 1:].argmax() if i + 1 < len(mask) else 0
+    if i + 1 + k < len(mask) and mask[i + 1 + k]:
+        return i + 1 + k
+    return len(mask)
+
+
+def _has_data(target, tickers, idx=None):
+    """
+    Returns the tickers that have data (not NaN and > 0) in target's universe
+    on the current date. Reads the target's precomputed has data flags (see
+    StrategyBase.universe_has_data) at the tickers' column positions, which
+    can be passed as idx.
+    """
+    tickers = list(tickers)
+    if idx is None:
+        idx = _columns(target, tickers)
+    ok = target.universe_has_data[idx]
+    return [t for t, k in zip(tickers, ok) if k]
+
+
+def _columns(target, tickers):
+    """
+    Returns the column positions of tickers in target's universe.
+    """
+    idx = target.universe.columns.get_indexer(tickers)
+    if (idx < 0).any():
+        raise KeyError('%s not in universe'
+                       % [t for t, i in zip(tickers, idx) if i < 0])
+    return idx
+
+
 class PrintDate(Algo):
 
     """
@@ -126,6 +162,10 @@ class RunPeriod(Algo):
         self._run_on_first_date = run_on_first_date
         self._run_on_end_of_period = run_on_end_of_period
         self._run_on_last_date = run_on_last_date
+        # trigger mask and the index it was computed for
+        self._index = None
+        self._mask = None
+        self._codes = None
 
     def __call__(self, target):
         # get last date
@@ -135,24 +175,31 @@ class RunPeriod(Algo):
         if now is None:
             return False
 
-        # not a known date in our universe
-        if now not in target.data.index:
+        index = target.data.index
+        if isinstance(target, bt.core.StrategyBase):
+            # the strategy knows the position of the current date
+            i = target.inow
+        elif now in index:
+            i = index.get_loc(now)
+        else:
+            # not a known date in our universe
             return False
 
-        # get index of the current date
-        index = target.data.index.get_loc(target.now)
+        mask = self.trigger_mask(index)
+        if mask is not None:
+            return bool(mask[i])
 
         result = False
 
         # index 0 is a date added by the Backtest Constructor
-        if index == 0:
+        if i == 0:
             return False
         # first date
-        if index == 1:
+        if i == 1:
             if self._run_on_first_date:
                 result = True
         # last date
-        elif index == (len(target.data.index) - 1):
+        elif i == (len(index) - 1):
             if self._run_on_last_date:
                 result = True
         else:
@@ -164,13 +211,63 @@ class RunPeriod(Algo):
             if self._run_on_end_of_period:
                 index_offset = 1
 
-            date_to_compare = target.data.index[index + index_offset]
+            date_to_compare = index[i + index_offset]
             date_to_compare = pd.Timestamp(date_to_compare)
 
             result = self.compare_dates(now, date_to_compare)
 
         return result
 
+    def trigger_mask(self, index):
+        """
+        Returns a boolean array flagging the dates of index on which the algo
+        runs. The mask is computed once per index, from the period codes of
+        the dates (see period_codes), so that each call is a lookup.
+
+        Returns None if the algo has no period codes - its compare_dates
+        method is then called on each date.
+        """
+        if index is self._index:
+            return self._mask
+
+        # the codes of the dates already seen are kept
+        k = bt.core._grown(self._index, index)
+        codes = self.period_codes(index[k:])
+        mask = None
+        if codes is not None:
+            codes = np.asarray(codes)
+            if k:
+                codes = np.r_[self._codes, codes]
+            n = len(index)
+            mask = np.zeros(n, dtype=bool)
+            # index 0 is a date added by the Backtest Constructor
+            if n > 1:
+                mask[1] = self._run_on_first_date
+            if n > 2:
+                mask[n - 1] = self._run_on_last_date
+                if self._run_on_end_of_period:
+                    mask[2:n - 1] = codes[2:n - 1] != codes[3:]
+                else:
+                    mask[2:n - 1] = codes[2:n - 1] != codes[1:n - 2]
+
+        self._index = index
+        self._mask = mask
+        self._codes = codes
+        return mask
+
+    def period_codes(self, dates):
+        """
+        Returns an integer array identifying the period of each date (see
+        trigger_mask), or None to compare the dates with compare_dates.
+        """
+        return None
+
+    def next_run(self, target):
+        mask = self.trigger_mask(target.data.index)
+        if mask is None:
+            return None
+        return _next_true(mask, target.inow)
+
     @abc.abstractmethod
     def compare_dates(self, now, date_to_compare):
         raise(NotImplementedError('RunPeriod Algo is an abstract class!'))
@@ -197,6 +294,9 @@ class RunDaily(RunPeriod):
             return True
         return False
 
+    def period_codes(self, dates):
+        return dates.values.astype('datetime64[D]').astype(np.int64)
+
 
 class RunWeekly(RunPeriod):
 
@@ -220,6 +320,9 @@ class RunWeekly(RunPeriod):
             return True
         return False
 
+    def period_codes(self, dates):
+        return np.asarray(dates.year) * 100 + np.asarray(dates.week)
+
 class RunMonthly(RunPeriod):
 
     """
@@ -242,6 +345,9 @@ class RunMonthly(RunPeriod):
             return True
         return False
 
+    def period_codes(self, dates):
+        return np.asarray(dates.year) * 12 + np.asarray(dates.month)
+
 
 class RunQuarterly(RunPeriod):
 
@@ -265,6 +371,9 @@ class RunQuarterly(RunPeriod):
             return True
         return False
 
+    def period_codes(self, dates):
+        return np.asarray(dates.year) * 4 + np.asarray(dates.quarter)
+
 class RunYearly(RunPeriod):
 
     """
@@ -287,6 +396,9 @@ class RunYearly(RunPeriod):
             return True
         return False
 
+    def period_codes(self, dates):
+        return np.asarray(dates.year)
+
 
 class RunOnDate(Algo):
 
@@ -308,10 +420,22 @@ class RunOnDate(Algo):
         super(RunOnDate, self).__init__()
         # parse dates and save
         self.dates = [pd.to_datetime(d) for d in dates]
+        # run dates in the target's index - see next_run
+        self._index = None
+        self._mask = None
 
     def __call__(self, target):
         return target.now in self.dates
 
+    def next_run(self, target):
+        index = target.data.index
+        if index is not self._index:
+            k = bt.core._grown(self._index, index)
+            mask = index[k:].isin(self.dates)
+            self._mask = np.r_[self._mask[:k], mask] if k else mask
+            self._index = index
+        return _next_true(self._mask, target.inow)
+
 
 class RunAfterDate(Algo):
 
@@ -339,6 +463,11 @@ class RunAfterDate(Algo):
     def __call__(self, target):
         return target.now > self.date
 
+    def next_run(self, target):
+        index = target.data.index
+        return max(target.inow + 1,
+                   index.searchsorted(self.date, side='right'))
+
 
 class RunAfterDays(Algo):
 
@@ -433,8 +562,9 @@ class SelectAll(Algo):
         if self.include_no_data:
             target.temp['selected'] = target.universe.columns
         else:
-            universe = target.universe.loc[target.now].dropna()
-            target.temp['selected'] = list(universe[universe > 0].index)
+            ok = target.universe_has_data
+            target.temp['selected'] = \
+                target.universe.columns.values[ok].tolist()
         return True
 
 
@@ -457,13 +587,20 @@ class SelectThese(Algo):
         super(SelectThese, self).__init__()
         self.tickers = tickers
         self.include_no_data = include_no_data
+        # positions of the tickers in the target's universe
+        self._columns = None
+        self._idx = None
 
     def __call__(self, target):
         if self.include_no_data:
             target.temp['selected'] = self.tickers
         else:
-            universe = target.universe[self.tickers].loc[target.now].dropna()
-            target.temp['selected'] = list(universe[universe > 0].index)
+            columns = target.universe.columns
+            if columns is not self._columns:
+                self._idx = _columns(target, self.tickers)
+                self._columns = columns
+            target.temp['selected'] = _has_data(target, self.tickers,
+                                                self._idx)
         return True
 
 
@@ -510,6 +647,10 @@ class SelectHasData(Algo):
             min_count = bt.ffn.get_num_days_required(lookback)
         self.min_count = min_count
         self.include_no_data = include_no_data
+        # first row of the lookback window of each date of the target's
+        # index
+        self._index = None
+        self._starts = None
 
     def __call__(self, target):
         if 'selected' in target.temp:
@@ -517,12 +658,25 @@ class SelectHasData(Algo):
         else:
             selected = target.universe.columns
 
-        filt = target.universe[selected].loc[target.now - self.lookback:]
-        cnt = filt.count()
-        cnt = cnt[cnt >= self.min_count]
+        selected = list(selected)
+        idx = _columns(target, selected)
+        if isinstance(self.lookback, (int, np.integer)):
+            start, stop = target.universe_rows(self.lookback)
+        else:
+            index = target.data.index
+            if index is not self._index:
+                k = bt.core._grown(self._index, index)
+                starts = index.searchsorted(index[k:] - self.lookback,
+                                            side='left')
+                self._starts = np.r_[self._starts[:k], starts] if k \
+                    else starts
+                self._index = index
+            start, stop = self._starts[target.inow], target.inow + 1
+        cnt = target.universe_counts(start, stop)[idx]
+        ok = cnt >= self.min_count
         if not self.include_no_data:
-            cnt = cnt[target.universe[selected].loc[target.now] > 0]
-        target.temp['selected'] = list(cnt.index)
+            ok &= target.universe_has_data[idx]
+        target.temp['selected'] = [t for t, k in zip(selected, ok) if k]
         return True
 
 
@@ -650,9 +804,7 @@ class SelectWhere(Algo):
             selected = sig[sig == True].index
             # save as list
             if not self.include_no_data:
-                universe = target.universe[
-                    list(selected)].loc[target.now].dropna()
-                selected = list(universe[universe > 0].index)
+                selected = _has_data(target, selected)
             target.temp['selected'] = list(selected)
 
         return True
@@ -700,8 +852,7 @@ class SelectRandomly(AlgoStack):
             sel = target.universe.columns
 
         if not self.include_no_data:
-            universe = target.universe[list(sel)].loc[target.now].dropna()
-            sel = list(universe[universe > 0].index)
+            sel = _has_data(target, sel)
 
         if self.n is not None:
             n = self.n if self.n < len(sel) else len(sel)
@@ -741,9 +892,10 @@ class StatTotalReturn(Algo):
 
     def __call__(self, target):
         selected = target.temp['selected']
-        t0 = target.now - self.lag
-        prc = target.universe[selected].loc[t0 - self.lookback:t0]
-        target.temp['stat'] = prc.calc_total_return()
+        idx = _columns(target, selected)
+        # same as ffn's calc_total_return
+        ret = target.universe_returns(self.lookback, self.lag)
+        target.temp['stat'] = pd.Series(ret[idx], index=selected)
         return True
 
 
@@ -831,6 +983,9 @@ class WeighTarget(Algo):
 
     def __init__(self, weights):
         self.weights = weights
+        # weight dates in the target's index - see next_run
+        self._index = None
+        self._mask = None
 
     def __call__(self, target):
         # get current target weights
@@ -844,6 +999,15 @@ class WeighTarget(Algo):
         else:
             return False
 
+    def next_run(self, target):
+        index = target.data.index
+        if index is not self._index:
+            k = bt.core._grown(self._index, index)
+            mask = index[k:].isin(self.weights.index)
+            self._mask = np.r_[self._mask[:k], mask] if k else mask
+            self._index = index
+        return _next_true(self._mask, target.inow)
+
 
 class WeighInvVol(Algo):
 
@@ -883,8 +1047,8 @@ class WeighInvVol(Algo):
             target.temp['weights'] = {selected[0]: 1.}
             return True
 
-        t0 = target.now - self.lag
-        prc = target.universe[selected].loc[t0 - self.lookback:t0]
+        start, stop = target.universe_rows(self.lookback, self.lag)
+        prc = target.universe.iloc[start:stop][selected]
         tw = bt.ffn.calc_inv_vol_weights(
             prc.to_returns().dropna())
         target.temp['weights'] = tw.dropna()
@@ -961,8 +1125,8 @@ class WeighERC(Algo):
             target.temp['weights'] = {selected[0]: 1.}
             return True
 
-        t0 = target.now - self.lag
-        prc = target.universe[selected].loc[t0 - self.lookback:t0]
+        start, stop = target.universe_rows(self.lookback, self.lag)
+        prc = target.universe.iloc[start:stop][selected]
         tw = bt.ffn.calc_erc_weights(
             prc.to_returns().dropna(),
             initial_weights=self.initial_weights,
@@ -1024,8 +1188,8 @@ class WeighMeanVar(Algo):
             target.temp['weights'] = {selected[0]: 1.}
             return True
 
-        t0 = target.now - self.lag
-        prc = target.universe[selected].loc[t0 - self.lookback:t0]
+        start, stop = target.universe_rows(self.lookback, self.lag)
+        prc = target.universe.iloc[start:stop][selected]
         tw = bt.ffn.calc_mean_var_weights(
             prc.to_returns().dropna(), weight_bounds=self.bounds,
             covar_method=self.covar_method, rf=self.rf)
@@ -1237,8 +1401,8 @@ class TargetVol(Algo):
             return True
 
 
-        t0 = target.now - self.lag
-        prc = target.universe.loc[t0 - self.lookback:t0, selected]
+        start, stop = target.universe_rows(self.lookback, self.lag)
+        prc = target.universe.iloc[start:stop][list(selected)]
         returns = bt.ffn.to_returns(prc)
 
         # calc covariance matrix
@@ -1339,8 +1503,8 @@ class PTE_Rebalance(Algo):
                 weights[c] -= target_weights[c]
 
 
-        t0 = target.now - self.lag
-        prc = target.universe.loc[t0 - self.lookback:t0, cols]
+        start, stop = target.universe_rows(self.lookback, self.lag)
+        prc = target.universe.iloc[start:stop][cols]
         returns = bt.ffn.to_returns(prc)
 
         # calc covariance matrix
@@ -1425,8 +1589,13 @@ class CloseDead(Algo):
             return True
 
         targets = target.temp['weights']
-        for c in target.children:
-            if target.universe[c].loc[target.now] <= 0:
+        children = list(target.children)
+        idx = _columns(target, children)
+        # dead - a price of zero or less, which is not NaN
+        dead = ~target.universe_has_data[idx] & \
+            ~np.isnan(target.universe_row[idx])
+        for c, k in zip(children, dead):
+            if k:
                 target.close(c)
                 if c in targets:
                     del targets[c]
@@ -1452,10 +1621,17 @@ class Rebalance(Algo):
             in cash. If this value is not provided (default), the full value
             of the strategy is allocated to securities.
 
+    Args:
+        * batch (bool): Rebalance all the children at once (see
+            StrategyBase.rebalance_many) instead of one after the other.
+            The weight deltas are then all computed before the trades, so
+            with commissions the results differ slightly.
+
     """
 
-    def __init__(self):
+    def __init__(self, batch=False):
         super(Rebalance, self).__init__()
+        self.batch = batch
 
     def __call__(self, target):
         if 'weights' not in target.temp:
@@ -1463,18 +1639,39 @@ class Rebalance(Algo):
 
         targets = target.temp['weights']
 
+        # light paper trade follows the same targets - the trades below are
+        # not mirrored in it (see StrategyBase.use_light_paper_trade)
+        if target._paper_trade and target._paper is None:
+            target.paper_rebalance(targets, target.temp.get('cash', 0.))
+            target._paper_synced = True
+            try:
+                self._rebalance(target, targets)
+            finally:
+                target._paper_synced = False
+        else:
+            self._rebalance(target, targets)
+        return True
+
+    def _rebalance(self, target, targets):
         # de-allocate children that are not in targets and have non-zero value
         # (open positions)
+        close = []
         for cname in target.children:
             # if this child is in our targets, we don't want to close it out
             if cname in targets:
                 continue
 
             # get child and value
-            c = target.children[cname]
-            v = c.value
+            v = target.children[cname].value
             # if non-zero and non-null, we need to close it out
             if v != 0. and not np.isnan(v):
+                close.append(cname)
+
+        if self.batch:
+            if close:
+                target.rebalance_many(dict.fromkeys(close, 0.))
+        else:
+            for cname in close:
                 target.close(cname)
 
         # save value because it will change after each call to allocate
@@ -1486,10 +1683,11 @@ class Rebalance(Algo):
         if 'cash' in target.temp:
             base = base * (1 - target.temp['cash'])
 
-        for item in iteritems(targets):
-            target.rebalance(item[1], child=item[0], base=base)
-
-        return True
+        if self.batch:
+            target.rebalance_many(targets, base=base)
+        else:
+            for item in iteritems(targets):
+                target.rebalance(item[1], child=item[0], base=base)
 
 
 class RebalanceOverTime(Algo):
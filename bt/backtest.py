@@ -2,35 +2,214 @@
 Contains backtesting logic and objects.
 """
 from __future__ import division
-from copy import deepcopy
+from copy import copy, deepcopy
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import bt
 import ffn
 import pandas as pd
 import numpy as np
 from matplotlib import pyplot as plt
 import pyprind
+import numbers
+import os
+import pickle
+import random
+import tempfile
+import threading
+from future.utils import iteritems, string_types
 
 
-def run(*backtests):
+def run(*backtests, **kwargs):
     """
     Runs a series of backtests and returns a Result
     object containing the results of the backtests.
 
     Args:
         * backtest (*list): List of backtests.
+        * n_jobs (int): Number of workers used to run the backtests. 1
+            (default) runs them one after the other in the calling process. -1
+            uses one worker per CPU.
+        * executor (str): 'process' (default) or 'thread'. Process workers
+            receive each distinct data set once and send the results back as
+            arrays (see Backtest._snapshot) - the backtests' strategies,
+            algos and commission functions must therefore be picklable (no
+            lambdas). The state of the algos and paper trades stays in the
+            workers, so these backtests can not carry on (see
+            Backtest.append_data and Backtest.checkpoint). Threads share the
+            random generators, so seeded backtests (see Backtest) run one at
+            a time.
 
     Returns:
         Result
 
     """
-    # run each backtest
-    for bkt in backtests:
-        bkt.run()
+    n_jobs = kwargs.pop('n_jobs', 1)
+    executor = kwargs.pop('executor', 'process')
+    if kwargs:
+        raise TypeError('run() got unexpected keyword arguments: %s'
+                        % ', '.join(kwargs))
+
+    _run_all(backtests, n_jobs, executor)
 
     return Result(*backtests)
 
 
-def benchmark_random(backtest, random_strategy, nsim=100):
+def _run_all(backtests, n_jobs, executor):
+    n_jobs = _n_jobs(n_jobs, executor)
+    todo = [bkt for bkt in backtests if not bkt.has_run]
+
+    if min(n_jobs, len(todo)) > 1:
+        _run_parallel(todo, min(n_jobs, len(todo)), executor)
+    else:
+        # run each backtest
+        for bkt in backtests:
+            bkt.run()
+
+
+def _n_jobs(n_jobs, executor):
+    # validates the parallel options of run and benchmark_random
+    if executor not in ('process', 'thread'):
+        raise ValueError('executor must be one of process or thread, '
+                         'got %s' % executor)
+
+    if n_jobs is None:
+        return 1
+    elif n_jobs < 0:
+        return multiprocessing.cpu_count()
+    return n_jobs
+
+
+def _pool(executor, n_jobs, initializer=None, initargs=()):
+    if executor == 'thread':
+        return ThreadPool(n_jobs, initializer, initargs)
+    return multiprocessing.Pool(n_jobs, initializer, initargs)
+
+
+# held while a seeded backtest's generators are in use - see Backtest._seeded
+_random_lock = threading.RLock()
+
+# node attributes sent back by worker processes - see Backtest._snapshot
+_SCALARS = (numbers.Number, np.bool_, pd.Timestamp, type(None)) + \
+    tuple(string_types)
+
+# version of the snapshots taken by Backtest.checkpoint
+_CHECKPOINT_VERSION = 1
+
+# node attributes holding data, left out of snapshots - see
+# Backtest.checkpoint
+_DATA_ATTRS = ('_original_data', '_universe', '_universe_values',
+               '_has_data', '_data_counts', '_funiverse', '_price_values',
+               '_buffers')
+
+
+def _tree_nodes(strategy):
+    # nodes of a strategy tree, including those of its paper trades
+    nodes = []
+    for m in strategy.members:
+        nodes.append(m)
+        if isinstance(m, bt.core.StrategyBase) and m._paper is not None:
+            nodes.extend(_tree_nodes(m._paper))
+    return nodes
+
+
+# data sets of the backtests run by a worker process - see _run_parallel
+_worker_data = None
+
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+
+def _run_worker(task):
+    i, k, bkt = task
+    bkt.data = _worker_data[k]
+    if isinstance(bkt.data, SharedUniverse):
+        bkt.data = bkt.data.data
+    bkt.dates = bkt.data.index
+    bkt.progress_bar = False
+    bkt.run()
+    return i, bkt._snapshot()
+
+
+def _run_thread(bkt):
+    bkt.run()
+
+
+def _run_parallel(backtests, n_jobs, executor):
+    """
+    Runs backtests on a pool of n_jobs workers. A single progress bar tracks
+    the number of backtests completed.
+    """
+    bar = None
+    if any(bkt.progress_bar for bkt in backtests):
+        bar = pyprind.ProgBar(len(backtests), title='bt.run', stream=1)
+
+    if executor == 'thread':
+        # the backtests' own progress bars would be interleaved
+        flags = [bkt.progress_bar for bkt in backtests]
+        for bkt in backtests:
+            bkt.progress_bar = False
+
+        pool = _pool(executor, n_jobs)
+        try:
+            for _ in pool.imap_unordered(_run_thread, backtests):
+                if bar is not None:
+                    bar.update()
+        finally:
+            pool.terminate()
+            pool.join()
+            for bkt, flag in zip(backtests, flags):
+                bkt.progress_bar = flag
+        return
+
+    # ship each distinct data set once per worker (through the pool's
+    # initializer) instead of once per backtest
+    data = []
+    tasks = []
+    for i, bkt in enumerate(backtests):
+        # a SharedUniverse is sent as a reference to its file
+        src = bkt.data if bkt._shared is None else bkt._shared
+        k = _find_data(data, src)
+        if k < 0:
+            k = len(data)
+            data.append(src)
+        task = copy(bkt)
+        task.data = None
+        task.dates = None
+        task._data_buffers = None
+        tasks.append((i, k, task))
+
+    pool = _pool(executor, n_jobs, _init_worker, (data,))
+    try:
+        for i, snapshot in pool.imap_unordered(_run_worker, tasks):
+            backtests[i]._restore(snapshot)
+            if bar is not None:
+                bar.update()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def _find_data(data, df):
+    # index of df in the list of DataFrames data, -1 if not found - the data
+    # is compared only if it is not found by identity
+    for k, x in enumerate(data):
+        if x is df:
+            return k
+    if isinstance(df, SharedUniverse):
+        return -1
+    for k, x in enumerate(data):
+        if not isinstance(x, SharedUniverse) and x.shape == df.shape and \
+                x.index.equals(df.index) and x.columns.equals(df.columns) \
+                and x.equals(df):
+            return k
+    return -1
+
+
+def benchmark_random(backtest, random_strategy, nsim=100, seed=None,
+                     n_jobs=1, executor='process', stream=False):
     """
     Given a backtest and a random strategy, compare backtest to
     a number of random portfolios.
@@ -48,6 +227,17 @@ def benchmark_random(backtest, random_strategy, nsim=100):
             against. The strategy should have a random component to
             emulate skilless behavior.
         * nsim (int): number of random strategies to create.
+        * seed (int): Seed from which the seeds of the random backtests are
+            drawn (see Backtest). Results are reproducible for a given seed,
+            whatever the number and kind of workers.
+        * n_jobs (int): Number of workers (see run).
+        * executor (str): 'process' or 'thread' (see run). The random
+            backtests share the global random generators, so threads
+            run them one at a time.
+        * stream (bool): Only keep the stats of the random backtests. The
+            result then only holds the benchmarked backtest, the random
+            backtests' stats are in r_stats. Memory use does not grow with
+            nsim beyond these stats.
 
     Returns:
         RandomBenchmarkResult
@@ -61,22 +251,104 @@ def benchmark_random(backtest, random_strategy, nsim=100):
     if not backtest.has_run:
         backtest.run()
 
-    bts = []
-    bts.append(backtest)
     data = backtest.data
-
-    # create and run random backtests
-    for i in range(nsim):
-        random_strategy.name = 'random_%s' % i
-        rbt = bt.Backtest(random_strategy, data)
-        rbt.run()
-
-        bts.append(rbt)
-
-    # now create new RandomBenchmarkResult
-    res = RandomBenchmarkResult(*bts)
-
-    return res
+    seeds = np.random.RandomState(seed).randint(0, 2 ** 31 - 1, nsim)
+    n_jobs = min(_n_jobs(n_jobs, executor), nsim)
+
+    if not stream:
+        bts = [bt.Backtest(random_strategy, data, name='random_%s' % i,
+                           progress_bar=backtest.progress_bar,
+                           seed=int(seeds[i]))
+               for i in range(nsim)]
+        _run_all(bts, n_jobs, executor)
+
+        # now create new RandomBenchmarkResult
+        return RandomBenchmarkResult(backtest, *bts)
+
+    tasks = [(i, int(x)) for i, x in enumerate(seeds)]
+    if n_jobs > 1:
+        pool = _pool(executor, n_jobs, _init_random_worker,
+                     (random_strategy, data))
+        try:
+            stats = dict(pool.imap_unordered(_run_random, tasks))
+        finally:
+            pool.terminate()
+            pool.join()
+    else:
+        stats = dict(_random_stats(random_strategy, data, i, s)
+                     for i, s in tasks)
+
+    r_stats = pd.DataFrame(stats)[['random_%s' % i for i in range(nsim)]]
+    return RandomBenchmarkResult(backtest, r_stats=r_stats)
+
+
+# random strategy and data used by benchmark_random's workers
+_worker_random = None
+
+
+def _init_random_worker(strategy, data):
+    global _worker_random
+    _worker_random = strategy, data
+
+
+def _run_random(task):
+    return _random_stats(_worker_random[0], _worker_random[1], *task)
+
+
+def _random_stats(strategy, data, i, seed):
+    # stats of one of benchmark_random's backtests
+    rbt = bt.Backtest(strategy, data, name='random_%s' % i,
+                      progress_bar=False, seed=seed)
+    rbt.run()
+    # same dates as in the benchmarked backtest's Result (the random
+    # backtests have an extra row at the start)
+    prices = rbt.strategy.prices.loc[data.index[0]:]
+    return rbt.name, prices.calc_perf_stats().stats
+
+
+def _check_columns(data):
+    if data.columns.duplicated().any():
+        cols = data.columns[data.columns.duplicated().tolist()].tolist()
+        raise Exception(
+            'data provided has some duplicate column names: \n%s \n'
+            'Please remove duplicates!' % cols)
+
+
+def _t0(data):
+    # date of the virtual row added before the data (see _add_t0)
+    return data.index[0] - pd.DateOffset(days=1)
+
+
+def _add_t0(data):
+    # add virtual row at t0-1day with NaNs
+    # this is so that any trading action at t0 can be evaluated relative to
+    # a clean starting point. This is related to #83. Basically, if you
+    # have a big trade / commision on day 0, then the Strategy.prices will
+    # be adjusted at 0, and hide the 'total' return. The series should
+    # start at 100, but may start at 90, for example. Here, we add a
+    # starting point at t0-1day, and this is the reference starting point
+    #
+    # Backtests that share data should use a SharedUniverse, which holds
+    # the virtual row already.
+    if len(data.columns) and (data.dtypes == np.float64).all():
+        # a single copy into one float block - cheaper than concat
+        index = pd.Index([_t0(data)]).append(data.index)
+        values = np.empty((len(index), len(data.columns)))
+        values[0] = np.nan
+        values[1:] = data.values
+        return pd.DataFrame(values, index=index, columns=data.columns,
+                            copy=False)
+
+    return pd.concat([
+        pd.DataFrame(np.nan, columns=data.columns, index=[_t0(data)]),
+        data])
+
+
+def _growable(data):
+    # data that append_data can grow in place - floats on naive dates
+    return isinstance(data.index, pd.DatetimeIndex) and \
+        data.index.tz is None and len(data.columns) > 0 and \
+        (data.dtypes == np.float64).all()
 
 
 class Backtest(object):
@@ -88,30 +360,68 @@ class Backtest(object):
     A backtest is basically testing a strategy over a data set.
 
     Note:
-        The Strategy will be deepcopied so it is re-usable in other
-        backtests. To access the backtested strategy, simply access
+        The Strategy will be cloned (see Node.clone) so it is re-usable in
+        other backtests. To access the backtested strategy, simply access
         the strategy attribute.
 
+        Each Backtest holds a copy of the data with a virtual row before
+        the first date. Backtests of the same data can share a single copy
+        through a SharedUniverse.
+
+        Besides run, the dates can be processed one at a time (step) or up
+        to a given date (run_until), and new dates can be appended to the
+        data as they come (append_data).
+
     Args:
         * strategy (Strategy, Node, StrategyBase): The Strategy to be tested.
-        * data (DataFrame): DataFrame containing data used in backtest. This
-            will be the Strategy's "universe".
+        * data (DataFrame, SharedUniverse): DataFrame containing data used in
+            backtest. This will be the Strategy's "universe". A SharedUniverse
+            is used without being copied.
         * name (str): Backtest name - defaults to strategy name
         * initial_capital (float): Initial amount of capital passed to
             Strategy.
         * commissions (fn(quantity, price)): The commission function
-        to be used. Ex: commissions=lambda q, p: max(1, abs(q) * 0.01)
+        to be used. Ex: commissions=lambda q, p: max(1, abs(q) * 0.01). A
+        CommissionModel such as bt.core.MinimumCommission(1, per_unit=0.01)
+        is equivalent and faster.
         * progress_bar (Bool): Display progress bar while running backtest
+        * engine (str): 'loop' (default) updates the whole tree on each date.
+            'vectorized' runs strategies made of an optional RunPeriod algo
+            followed by SelectAll, WeighEqually, Rebalance or WeighTarget,
+            Rebalance with array operations. With commissions, its results
+            may differ slightly from the loop's (see
+            _rebalance_quantities). Other strategies fall back to the loop.
+            'fast_forward' runs the loop on the dates on which the algo stack
+            may run only - RunPeriod, RunOnDate, RunAfterDate or WeighTarget
+            first in the stack - and marks the dates in between to market
+            with array operations (see _fast_forward). Its results are the
+            loop's.
+        * seed (int): If set, the backtest has its own random and
+            numpy.random generators (used by algos such as SelectRandomly
+            and WeighRandomly), seeded with it. They are swapped in while
+            the backtest processes dates and the caller's generators are
+            left as they were. Seeded backtests run by threads take turns
+            (see run).
+        * sparse (bool): Store the securities' positions and outlays
+            sparsely (see StrategyBase.use_sparse_storage). Saves memory with
+            very wide universes.
+        * dtype (dtype): Type of the stored history (values, positions,
+            outlays, etc.). numpy.float32 halves the memory used by the
+            results (see StrategyBase.set_store_dtype).
+        * memmap_dir (str): If set, the history is stored in a
+            memory-mapped file created in this directory instead of memory
+            (see StrategyBase.set_store_directory). The file is deleted by
+            close.
 
     Attributes:
-        * strategy (Strategy): The Backtest's Strategy. This will be a deepcopy
+        * strategy (Strategy): The Backtest's Strategy. This will be a clone
             of the Strategy that was passed in.
         * data (DataFrame): Data passed in
         * dates (DateTimeIndex): Data's index
         * initial_capital (float): Initial capital
         * name (str): Backtest name
         * stats (ffn.PerformanceStats): Performance statistics
-        * has_run (bool): Run flag
+        * has_run (bool): Run flag - True once all the dates were processed
         * weights (DataFrame): Weights of each component over time
         * security_weights (DataFrame): Weights of each security as a
             percentage of the whole portfolio over time
@@ -123,90 +433,521 @@ class Backtest(object):
                  initial_capital=1000000.0,
                  commissions=None,
                  integer_positions=True,
-                 progress_bar=True):
+                 progress_bar=True,
+                 engine='loop',
+                 seed=None,
+                 sparse=False,
+                 dtype=np.float64,
+                 memmap_dir=None):
 
-        if data.columns.duplicated().any():
-            cols = data.columns[data.columns.duplicated().tolist()].tolist()
-            raise Exception(
-                'data provided has some duplicate column names: \n%s \n'
-                'Please remove duplicates!' % cols)
+        if not isinstance(data, SharedUniverse):
+            _check_columns(data)
 
         # we want to reuse strategy logic - copy it!
         # basically strategy is a template
-        self.strategy = deepcopy(strategy)
+        if isinstance(strategy, bt.core.Node):
+            self.strategy = strategy.clone()
+        else:
+            self.strategy = deepcopy(strategy)
         self.strategy.use_integer_positions(integer_positions)
+        self.strategy.use_sparse_storage(sparse)
+        self.strategy.set_store_dtype(dtype)
+        self.strategy.set_store_directory(memmap_dir)
 
-        # add virtual row at t0-1day with NaNs
-        # this is so that any trading action at t0 can be evaluated relative to
-        # a clean starting point. This is related to #83. Basically, if you
-        # have a big trade / commision on day 0, then the Strategy.prices will
-        # be adjusted at 0, and hide the 'total' return. The series should
-        # start at 100, but may start at 90, for example. Here, we add a
-        # starting point at t0-1day, and this is the reference starting point
-        data = pd.concat([
-            pd.DataFrame(np.nan, columns=data.columns,
-                         index=[data.index[0] - pd.DateOffset(days=1)]),
-            data])
-
-        self.data = data
-        self.dates = data.index
+        self._set_data(data)
         self.initial_capital = initial_capital
         self.name = name if name is not None else strategy.name
         self.progress_bar = progress_bar
 
+        if engine not in ('loop', 'vectorized', 'fast_forward'):
+            raise ValueError('engine must be one of loop, vectorized or '
+                             'fast_forward, got %s' % engine)
+        self.engine = engine
+        self.seed = seed
+        # state of the backtest's generators once seeded - see _seeded
+        self._random = None
+
         if commissions is not None:
             self.strategy.set_commissions(commissions)
 
         self.stats = {}
-        self._original_prices = None
         self._weights = None
         self._sweights = None
         self.has_run = False
+        # position of the next date to process - None until set up
+        self._inext = None
+        # run by a process worker - see _restore
+        self._from_worker = False
+
+    def _set_data(self, data):
+        if isinstance(data, SharedUniverse):
+            # the shared data already has the virtual row
+            self._shared = data
+            data = data.data
+        else:
+            self._shared = None
+            data = _add_t0(data)
+
+        self.data = data
+        self.dates = data.index
+        # buffers holding the data once it grows - see append_data
+        self._data_buffers = None
 
     def run(self):
         """
-        Runs the Backtest.
+        Runs the Backtest - processes the dates that have not been processed
+        yet (all of them, unless step or run_until were called).
         """
+        self._seeded(self._run)
+
+    def _run(self):
         if self.has_run:
             return
 
-        # set run flag to avoid running same test more than once
-        self.has_run = True
+        # the vectorized engine only runs whole backtests
+        start = self._inext is None
+        if start:
+            self._start()
+
+        # the vectorized engine reports whether it could run the strategy
+        if start and self.engine == 'vectorized' and \
+                _run_vectorized(self.strategy):
+            if self.progress_bar:
+                bar = pyprind.ProgBar(len(self.dates), title=self.name,
+                                      stream=1)
+                bar.update(len(self.dates) - 1)
+            self._inext = len(self.dates)
+            self._processed()
+        else:
+            self._run_to(len(self.dates))
+
+    def step(self):
+        """
+        Processes the next date of the data.
+
+        Returns:
+            The date processed, None if all the dates were processed (see
+            append_data).
+
+        """
+        return self._seeded(self._step)
+
+    def _step(self):
+        if self._inext is None:
+            self._start()
+        if self._inext == len(self.dates):
+            return None
+
+        dt = self.dates[self._inext]
+        self._update(dt, self._inext)
+        self._inext += 1
+        self._processed()
+        return dt
+
+    def run_until(self, date):
+        """
+        Processes the dates of the data up to and including date. The
+        Backtest can carry on from there with step, run_until or run, and
+        its results (stats, weights, etc.) are those up to the last date
+        processed.
+
+        Args:
+            * date: Last date to process.
+
+        """
+        self._seeded(self._run_until, date)
+
+    def _run_until(self, date):
+        if self._inext is None:
+            self._start()
+        self._run_to(self.dates.searchsorted(pd.Timestamp(date),
+                                             side='right'))
+
+    def _seeded(self, fn, *args):
+        # calls fn with the backtest's own generators if it is seeded - the
+        # caller's are restored afterwards. The generators are global, so
+        # seeded backtests run by threads hold a lock while they use them.
+        if self.seed is None:
+            return fn(*args)
+
+        with _random_lock:
+            states = random.getstate(), np.random.get_state()
+            if self._random is None:
+                random.seed(self.seed)
+                np.random.seed(self.seed)
+            else:
+                random.setstate(self._random[0])
+                np.random.set_state(self._random[1])
+            try:
+                return fn(*args)
+            finally:
+                self._random = random.getstate(), np.random.get_state()
+                random.setstate(states[0])
+                np.random.set_state(states[1])
+
+    def append_data(self, rows):
+        """
+        Appends new dates to the data, for live use. Only the new dates are
+        processed by the next call to step, run_until or run - the strategy
+        keeps its state and its history grows in place (see
+        StrategyBase.extend_universe).
+
+        Each date is processed with the data known at the time: algos that
+        treat the last date of the data apart (such as RunPeriod) see the
+        date as the last one if it was when it was processed.
+
+        The data grows in place, as the strategy's history, so that adding
+        dates one at a time is amortized. This needs float data on dates
+        without a time zone - other data is copied on each call.
+
+        A Backtest run by a process worker (see run) can not carry on: its
+        algos' state is left in the worker.
+
+        Args:
+            * rows (DataFrame): Data on dates after the last one. Columns
+                that are missing are NaN.
+
+        """
+        self._check_local()
+        unknown = rows.columns.difference(self.data.columns)
+        if len(unknown) > 0:
+            raise ValueError('rows have columns that are not in the data: %s'
+                             % unknown.tolist())
+        if len(rows.index) == 0:
+            return
+        if not rows.index.is_monotonic_increasing or \
+                rows.index[0] <= self.dates[-1]:
+            raise ValueError('rows must be sorted and come after the last '
+                             'date of the data (%s)' % self.dates[-1])
+
+        rows = rows.reindex(columns=self.data.columns)
+        if self._data_buffers is not None or _growable(self.data):
+            data = self._extend_data(rows)
+        else:
+            data = pd.concat([self.data, rows])
+        # the shared data is left as it is
+        self._shared = None
+        self.data = data
+        self.dates = data.index
+
+        if self._inext is not None:
+            self.strategy.extend_universe(data)
+        self.has_run = False
+
+    def _extend_data(self, rows):
+        # the values and dates of the data are held in buffers that grow in
+        # place (see bt.core._RowBuffer) - the data is a view on them. The
+        # first call copies the data, which may be shared.
+        if self._data_buffers is None:
+            self._data_buffers = (bt.core._RowBuffer(self.data.values),
+                                  bt.core._RowBuffer(self.dates.values))
+        n = len(self.dates)
+        m = n + len(rows.index)
+        values, dates = [b.extend(m, n) for b in self._data_buffers]
+        self._data_buffers = values, dates
+        values.array[n:] = rows.values
+        dates.array[n:] = np.asarray(rows.index, dtype='M8[ns]')
+
+        index = pd.DatetimeIndex(dates.array, name=self.dates.name,
+                                 copy=False)
+        return pd.DataFrame(values.array, index=index,
+                            columns=self.data.columns, copy=False)
+
+    def checkpoint(self):
+        """
+        Snapshot of a Backtest that has started (see step and run_until),
+        from which it can be resumed (see resume) - to recover from a crash
+        or to run several scenarios from a common start.
+
+        The snapshot holds the strategy tree (its nodes, algos and their
+        state), its history up to the last date processed and the state of
+        the random generators (the backtest's own if seeded), but not the
+        data. Like for process workers
+        (see run), the strategy's algos and commission function must be
+        picklable. A Backtest run by a process worker has no such state and
+        can not be checkpointed.
+
+        Returns:
+            dict
+
+        """
+        if self._inext is None:
+            raise ValueError('the backtest has not started')
+        self._check_local()
+
+        nodes = _tree_nodes(self.strategy)
+        # the data is left out and the history is cut at the last date
+        # processed - the tree is restored once pickled
+        saved = []
+        stores = {}
+        for node in nodes:
+            state = dict((k, node.__dict__.pop(k)) for k in _DATA_ATTRS
+                         if k in node.__dict__)
+            state['_store'] = node._store
+            saved.append(state)
+            if id(node._store) not in stores:
+                stores[id(node._store)] = node._store.copy(self._inext)
+            node._store = stores[id(node._store)]
+        try:
+            strategy = pickle.dumps(self.strategy, pickle.HIGHEST_PROTOCOL)
+        finally:
+            for node, state in zip(nodes, saved):
+                node.__dict__.update(state)
+
+        if self.seed is None:
+            states = random.getstate(), np.random.get_state()
+        else:
+            states = self._random
+        return {'version': _CHECKPOINT_VERSION,
+                'strategy': strategy,
+                'dates': self.dates[:self._inext],
+                'random': states,
+                'name': self.name,
+                'initial_capital': self.initial_capital,
+                'progress_bar': self.progress_bar,
+                'engine': self.engine,
+                'seed': self.seed}
+
+    @classmethod
+    def resume(cls, snapshot, data):
+        """
+        Creates a Backtest from a snapshot (see checkpoint). It carries on
+        from the last date processed before the snapshot was taken. The
+        random generators (the backtest's own if seeded) are restored to
+        their state at that time.
+
+        Args:
+            * snapshot (dict): Snapshot of a Backtest.
+            * data (DataFrame, SharedUniverse): Data of the Backtest. It
+                must start with the dates processed before the snapshot was
+                taken, with the same data. What comes after may differ
+                from the original data.
 
+        Returns:
+            Backtest
+
+        """
+        if snapshot.get('version') != _CHECKPOINT_VERSION:
+            raise ValueError('unsupported snapshot version: %s'
+                             % snapshot.get('version'))
+
+        bkt = cls.__new__(cls)
+        bkt._from_worker = False
+        bkt.strategy = pickle.loads(snapshot['strategy'])
+        bkt._set_data(data)
+        for k in ['name', 'initial_capital', 'progress_bar', 'engine',
+                  'seed']:
+            setattr(bkt, k, snapshot[k])
+
+        dates = snapshot['dates']
+        n = len(dates)
+        if not bkt.dates[:n].equals(dates):
+            raise ValueError('data does not start with the dates of the '
+                             'snapshot')
+
+        # the data up to the last date processed is attached to the tree,
+        # which then grows to the rest of the data
+        prefix = bkt.data.iloc[:n]
+        for node in _tree_nodes(bkt.strategy):
+            if isinstance(node, bt.core.StrategyBase):
+                node._original_data = prefix
+                node._setup_universe(prefix)
+                if node._has_strat_children:
+                    for c, col in zip(node._strat_children,
+                                      node._strat_cols):
+                        node._universe_values[:, col] = \
+                            node._store.price[:, node.children[c]._col]
+            else:
+                node._attach_prices(prefix)
+        bkt.strategy.extend_universe(bkt.data)
+
+        if bkt.seed is None:
+            bkt._random = None
+            random.setstate(snapshot['random'][0])
+            np.random.set_state(snapshot['random'][1])
+        else:
+            bkt._random = snapshot['random']
+
+        bkt._inext = n
+        bkt._processed()
+        return bkt
+
+    def _start(self):
         # setup strategy
         self.strategy.setup(self.data)
 
         # adjust strategy with initial capital
         self.strategy.adjust(self.initial_capital)
 
-        # loop through dates
-        # init progress bar
-        if self.progress_bar:
-            bar = pyprind.ProgBar(len(self.dates), title=self.name, stream=1)
-
         # since there is a dummy row at time 0, start backtest at date 1.
         # we must still update for t0
         self.strategy.update(self.dates[0])
+        self._inext = 1
+
+    def _update(self, dt, inow):
+        # update strategy - passing the position of the date saves looking
+        # it up in the index, which is new after each append_data
+        self.strategy.update(dt, None, inow)
+
+        if not self.strategy.bankrupt:
+            self.strategy.run()
+            # need update after to save weights, values and such
+            self.strategy.update(dt, None, inow)
+
+    def _run_to(self, stop):
+        # processes the dates up to position stop (excluded)
+        # init progress bar
+        progress_bar = self.progress_bar and stop > self._inext
+        if progress_bar:
+            bar = pyprind.ProgBar(stop - self._inext, title=self.name,
+                                  stream=1)
+
+        fast = self.engine == 'fast_forward'
+        i = self._inext
+        while i < stop:
+            if fast:
+                # skip to the next date on which the stack may run
+                j = _fast_forward(self.strategy, i, stop)
+                if progress_bar and j > i:
+                    bar.update(j - i)
+                i = j
+                if i == stop:
+                    break
 
-        # and for the backtest loop, start at date 1
-        for dt in self.dates[1:]:
             # update progress bar
-            if self.progress_bar:
+            if progress_bar:
                 bar.update()
 
-            # update strategy
-            self.strategy.update(dt)
+            self._update(self.dates[i], i)
+            if self.strategy.bankrupt and progress_bar:
+                bar.stop()
+            i += 1
+
+        self._inext = max(self._inext, stop)
+        self._processed()
+
+    def _processed(self):
+        # results are recomputed when accessed
+        self.has_run = self._inext == len(self.dates)
+        self._stats = None
+        self._weights = None
+        self._sweights = None
+
+    @property
+    def stats(self):
+        """
+        Performance statistics up to the last date processed.
+        """
+        if self._stats is None:
+            self._stats = self.strategy.prices.calc_perf_stats()
+        return self._stats
 
-            if not self.strategy.bankrupt:
-                self.strategy.run()
-                # need update after to save weights, values and such
-                self.strategy.update(dt)
+    @stats.setter
+    def stats(self, stats):
+        self._stats = stats
+
+    def close(self):
+        """
+        Releases the strategy's history if it is memory-mapped (see
+        memmap_dir) and deletes its file. The results can not be accessed
+        afterwards.
+        """
+        if self.strategy._store is not None:
+            self.strategy._store.close()
+
+    def _check_local(self):
+        # the algos and paper trades of a backtest run by a process worker
+        # are not sent back - it can not carry on
+        if self._from_worker:
+            raise ValueError('%s was run by a process worker and can not '
+                             'carry on - run it in this process (see run)'
+                             % self.name)
+
+    def _snapshot(self):
+        """
+        Compact state of a Backtest that has run: the tree's TreeStore block
+        and trades, the scalar attributes of each node (keyed by the node's
+        path from the root) and the stats. This is what process workers send
+        back instead of pickling the whole strategy tree (see run) - enough
+        for the results, but not for the Backtest to carry on (the algos and
+        paper trades are left out).
+        """
+        store = self.strategy._store
+        nodes = []
+        for m in self.strategy.members:
+            path = []
+            node = m
+            while node.parent is not node:
+                path.append(node.name)
+                node = node.parent
+            state = dict((k, v) for k, v in iteritems(vars(m))
+                         if isinstance(v, _SCALARS))
+            nodes.append((tuple(reversed(path)), state))
+
+        if store.path is not None:
+            # memory-mapped - the store is sent by location, and its file is
+            # handed over to the Backtest restoring the snapshot
+            store.flush()
+            store._own(False)
+            return store, None, nodes, self.stats
+        return (store.block[:, :, :store.ncols], store.trades.records, nodes,
+                self.stats)
+
+    def _restore(self, snapshot):
+        """
+        Brings the Backtest to the state of a snapshot taken after running
+        the same Backtest elsewhere (see _snapshot). Securities created during
+        the run are added to the strategy tree.
+        """
+        block, trades, nodes, stats = snapshot
+
+        if isinstance(block, bt.core.TreeStore):
+            # memory-mapped store - this Backtest now owns the file
+            store = block
+            store._own()
+        else:
+            store = bt.core.TreeStore(self.data.index,
+                                      capacity=block.shape[2],
+                                      sparse=self.strategy.sparse_storage,
+                                      dtype=block.dtype)
+            store.block[:] = block
+            store.ncols = block.shape[2]
+            store.trades.extend(trades['date'], trades['node'],
+                                trades['quantity'], trades['price'],
+                                trades['fee'], trades['outlay'])
+
+        strategies = []
+        for path, state in nodes:
+            node = self.strategy
+            for name in path:
+                if name not in node.children:
+                    node._add_child(bt.core.SecurityBase(name))
+                node = node.children[name]
+
+            node.__dict__.update(state)
+            node._store = store
+            if isinstance(node, bt.core.StrategyBase):
+                strategies.append(node)
             else:
-                if self.progress_bar:
-                    bar.stop()
+                node._attach_prices(self.data)
+                if node._sparse:
+                    store.nsparse = max(store.nsparse, node._col + 1)
+
+        for s in strategies:
+            s._original_data = self.data
+            s._setup_universe(self.data)
+            s._activev = [c for c in s._childrenv if c._active]
+            # strategy children's prices are written in the universe as the
+            # backtest runs
+            if s._has_strat_children:
+                for c, col in zip(s._strat_children, s._strat_cols):
+                    s._universe_values[:s.inow + 1, col] = \
+                        store.price[:s.inow + 1, s.children[c]._col]
 
-        self.stats = self.strategy.prices.calc_perf_stats()
-        self._original_prices = self.strategy.prices
+        self.has_run = True
+        self._inext = len(self.dates)
+        self._from_worker = True
+        self.stats = stats
 
     @property
     def weights(self):
@@ -216,9 +957,10 @@ class Backtest(object):
         if self._weights is not None:
             return self._weights
         else:
-            vals = pd.DataFrame({x.full_name: x.values for x in
-                                 self.strategy.members})
-            vals = vals.div(self.strategy.values, axis=0)
+            members = self.strategy.members
+            vals = self._store_weights(members)
+            vals = pd.DataFrame(vals, index=self.strategy.values.index,
+                                columns=[x.full_name for x in members])
             self._weights = vals
             return vals
 
@@ -239,24 +981,42 @@ class Backtest(object):
             return self._sweights
         else:
             # get values for all securities in tree and divide by root values
-            # for security weights
-            vals = {}
-            for m in self.strategy.members:
-                if isinstance(m, bt.core.SecurityBase):
-                    if m.name in vals:
-                        vals[m.name] += m.values
-                    else:
-                        vals[m.name] = m.values
-            vals = pd.DataFrame(vals)
-
-            # divide by root strategy values
-            vals = vals.div(self.strategy.values, axis=0)
+            # for security weights. The same security can appear in multiple
+            # sub-strategies, in which case its weights are summed up.
+            secs = [m for m in self.strategy.members
+                    if isinstance(m, bt.core.SecurityBase)]
+            vals = pd.DataFrame(self._store_weights(secs),
+                                index=self.strategy.values.index,
+                                columns=[m.name for m in secs])
+            if len(secs) > 0:
+                vals = vals.groupby(level=0, axis=1).sum()
 
             # save for future use
             self._sweights = vals
 
             return vals
 
+    def _store_weights(self, nodes):
+        """
+        Returns the (dates x nodes) weights of the given nodes relative to the
+        root strategy, up to the current date. Values are divided in one pass
+        over the store rather than Series by Series.
+        """
+        # resolve stale state and get the number of rows up to now
+        n = len(self.strategy.values)
+        store = self.strategy._store
+        sparse = [k for k, x in enumerate(nodes) if x._issec and x._sparse]
+        if sparse:
+            dense = sorted(set(range(len(nodes))) - set(sparse))
+            values = np.empty((n, len(nodes)))
+            values[:, dense] = store.value[:n, [nodes[k]._col for k in dense]]
+            for k in sparse:
+                values[:, k] = nodes[k]._values.values[:n]
+        else:
+            values = store.value[:n, [x._col for x in nodes]]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return values / store.value[:n, self.strategy._col][:, None]
+
     @property
     def herfindahl_index(self):
         """
@@ -433,9 +1193,11 @@ class Result(ffn.GroupStats):
         """
         Helper function that returns the transactions in the following format:
 
-            dt, security | quantity, price
+            dt, security | price, quantity, fee
 
-        The result is a MultiIndex DataFrame.
+        The result is a MultiIndex DataFrame. The transactions are read from
+        the tree's trade ledger (see bt.core.TradeLedger) - trades of the
+        same security on the same date are netted and their fees summed.
 
         Args:
             * strategy_name (str): If none, it will take the first backtest's
@@ -448,27 +1210,20 @@ class Result(ffn.GroupStats):
         # extract strategy given strategy_name
         s = self.backtests[strategy_name].strategy
 
-        # get prices for each security in the strategy & create unstacked
-        # series
-        prc = pd.DataFrame({x.name: x.prices for x in s.securities}).unstack()
-
-        # get security positions
-        positions = pd.DataFrame({x.name: x.positions for x in s.securities})
-        # trades are diff
-        trades = positions.diff()
-        # must adjust first row
-        trades.iloc[0] = positions.iloc[0]
-        # now convert to unstacked series, dropping nans along the way
-        trades = trades[trades != 0].unstack().dropna()
-
-        res = pd.DataFrame({'price': prc, 'quantity': trades}).dropna(
-            subset=['quantity'])
+        names = dict((x._col, x.name) for x in s.securities)
+        trades = s._store.trades.records
+        trades = trades[np.in1d(trades['node'], list(names))]
 
-        # set names
-        res.index.names = ['Security', 'Date']
+        res = pd.DataFrame({
+            'Date': s._store.index[trades['date']],
+            'Security': [names[c] for c in trades['node']],
+            'price': trades['price'],
+            'quantity': trades['quantity'],
+            'fee': trades['fee']})
 
-        # swap levels so that we have (date, security) as index and sort
-        res = res.swaplevel().sort_index()
+        res = res.groupby(['Date', 'Security']).agg(
+            {'price': 'last', 'quantity': 'sum', 'fee': 'sum'})
+        res = res.loc[res['quantity'] != 0, ['price', 'quantity', 'fee']]
 
         return res
 
@@ -480,7 +1235,10 @@ class RandomBenchmarkResult(Result):
     to random strategy benchmarking.
 
     Args:
-        * backtests (list): List of backtests
+        * backtests (list): List of backtests - the first one is the
+            benchmarked backtest.
+        * r_stats (DataFrame): Stats of the random strategies, if they are
+            not part of backtests (see benchmark_random's stream mode).
 
     Attributes:
         * base_name (str): Name of backtest being benchmarked
@@ -489,11 +1247,13 @@ class RandomBenchmarkResult(Result):
 
     """
 
-    def __init__(self, *backtests):
+    def __init__(self, *backtests, **kwargs):
         super(RandomBenchmarkResult, self).__init__(*backtests)
         self.base_name = backtests[0].name
         # seperate stats to make
-        self.r_stats = self.stats.drop(self.base_name, axis=1)
+        self.r_stats = kwargs.pop('r_stats', None)
+        if self.r_stats is None:
+            self.r_stats = self.stats.drop(self.base_name, axis=1)
         self.b_stats = self.stats[self.base_name]
 
     def plot_histogram(self, statistic='monthly_sharpe',
@@ -532,3 +1292,497 @@ class RandomBenchmarkResult(Result):
         ax.set_title(title)
         plt.axvline(self.b_stats[statistic], linewidth=4)
         ser.plot(kind='kde')
+
+
+class SharedUniverse(object):
+
+    """
+    Price data stored once in a memory-mapped file, to be shared by many
+    Backtests and worker processes.
+
+    Backtests created with a SharedUniverse as data use a read-only view on
+    the file instead of their own copy of the data. Pickling a SharedUniverse
+    only sends the file's location, so the workers of run(n_jobs=...)
+    attach to the same file and the operating system keeps a single physical
+    copy of the prices, whatever the number of backtests and processes.
+
+    The file holds the data with the virtual row that Backtest adds before
+    the first date. The data is stored as floats.
+
+    Args:
+        * data (DataFrame): Price data.
+        * path (str): File the data is written to. Defaults to a temporary
+            file, deleted by close.
+
+    Attributes:
+        * path (str): File holding the data.
+        * data (DataFrame): Read-only view on the file, with the virtual row.
+
+    """
+
+    def __init__(self, data, path=None):
+        _check_columns(data)
+
+        self._owner = path is None
+        if path is None:
+            fd, path = tempfile.mkstemp(suffix='.npy', prefix='bt-')
+            os.close(fd)
+        self.path = path
+
+        values = np.lib.format.open_memmap(
+            path, mode='w+', dtype=float,
+            shape=(len(data.index) + 1, len(data.columns)))
+        values[0] = np.nan
+        values[1:] = data.values
+        values.flush()
+        del values
+
+        self._index = data.index.insert(0, _t0(data))
+        self._columns = data.columns
+        self._attach()
+
+    def _attach(self):
+        values = np.load(self.path, mmap_mode='r')
+        self.data = pd.DataFrame(values, index=self._index,
+                                 columns=self._columns, copy=False)
+
+    def __getstate__(self):
+        return {'path': self.path, '_index': self._index,
+                '_columns': self._columns}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # copies never delete the file
+        self._owner = False
+        self._attach()
+
+    def close(self):
+        """
+        Deletes the file if it is a temporary file created by this
+        SharedUniverse. Backtests using it must not be run afterwards.
+        """
+        self.data = None
+        if self._owner and os.path.exists(self.path):
+            os.remove(self.path)
+        self._owner = False
+
+
+def _vectorized_plan(strategy):
+    """
+    Inspects a set up Strategy and determines if its logic can be reproduced
+    by the vectorized engine.
+
+    Supported strategies are root Strategies with no strategy children whose
+    stack is an optional RunPeriod algo (RunDaily, RunMonthly, etc.)
+    followed by either SelectAll, WeighEqually, Rebalance or WeighTarget,
+    Rebalance.
+
+    Returns:
+        (names, mask, weigh) or None if the strategy needs the regular loop.
+        names is the column order used by the engine, mask flags the
+        rebalance dates and weigh(i, prices) returns the target weights on
+        date i (NaN for securities that are not targets).
+
+    """
+    if type(strategy) is not bt.core.Strategy or \
+            strategy.parent is not strategy:
+        return None
+
+    if strategy._has_strat_children:
+        return None
+
+    if any(type(c) is not bt.core.SecurityBase for c in strategy._childrenv):
+        return None
+
+    algos = list(strategy.stack.algos)
+    run = None
+    if algos and isinstance(algos[0], bt.algos.RunPeriod):
+        run = algos.pop(0)
+    kinds = [type(x) for x in algos]
+
+    universe = strategy._universe
+    dates = universe.index
+    names = list(universe.columns)
+    mask = np.ones(len(dates), dtype=bool)
+
+    if kinds == [bt.algos.WeighTarget, bt.algos.Rebalance]:
+        weights = algos[0].weights
+        wnames = list(weights.columns)
+        if weights.index.duplicated().any() or \
+                not set(wnames).issubset(names):
+            return None
+
+        # the loop creates children in the order of the weights' columns
+        names = wnames + [x for x in names if x not in set(wnames)]
+        mask &= dates.isin(weights.index)
+        wvals = weights.reindex(index=dates, columns=names).values.astype(
+            float)
+
+        def weigh(i, prices):
+            return wvals[i]
+
+    elif kinds == [bt.algos.SelectAll, bt.algos.WeighEqually,
+                   bt.algos.Rebalance] and not algos[0].include_no_data:
+
+        def weigh(i, prices):
+            with np.errstate(invalid='ignore'):
+                selected = prices > 0
+            return np.where(selected, 1.0 / max(selected.sum(), 1), np.nan)
+
+    else:
+        return None
+
+    # index 0 is the row added by the Backtest constructor - never run there
+    mask[0] = False
+
+    if run is not None:
+        runs = run.trigger_mask(dates)
+        if runs is not None:
+            mask &= runs
+        else:
+            now, inow = strategy.now, strategy.inow
+            for i in np.flatnonzero(mask):
+                strategy.now = dates[i]
+                strategy.inow = i
+                mask[i] = run(strategy)
+            strategy.now, strategy.inow = now, inow
+
+    return names, mask, weigh
+
+
+def _rebalance_quantities(pos, prc, w, cash, fn, integer, names, date):
+    """
+    Vectorized version of the Rebalance algo for a Strategy of securities.
+    Returns the quantities traded.
+
+    Like StrategyBase.rebalance_many, the weight deltas of all the securities
+    are computed from the value before the trades.
+    """
+    q = np.zeros(len(pos))
+    held = pos != 0
+    targets = ~np.isnan(w)
+
+    # close out positions that are not targets
+    close = held & ~targets
+    q[close] = -pos[close]
+    cash -= (q[close] * prc[close]).sum() + bt.core._commissions(
+        fn, q[close], prc[close]).sum()
+    held = held & ~close
+
+    base = cash + (pos[held] * prc[held]).sum()
+
+    # close out targets with a weight of 0
+    close = targets & (w == 0) & held
+    q[close] = -pos[close]
+
+    alloc = targets & (w != 0)
+    value = np.where(held, pos * prc, 0.)
+    weight = value / base if base != 0 else np.zeros(len(pos))
+    amount = np.where(alloc, (w - weight) * base, 0.)
+    alloc &= amount != 0
+
+    bad = alloc & ((prc == 0) | np.isnan(prc))
+    if bad.any():
+        i = np.flatnonzero(bad)[0]
+        raise Exception(
+            'Cannot allocate capital to %s because price is %s as of %s'
+            % (names[i], prc[i], date))
+
+    q[alloc] = bt.core._allocation_quantities(
+        amount[alloc], pos[alloc], value[alloc], prc[alloc], fn, integer)
+    return q
+
+
+def _security_values(prices, pos, mult, names):
+    """
+    Values of the positions pos over rows of prices.
+    """
+    held = pos != 0
+    if np.isnan(prices[:, held]).any():
+        i = np.flatnonzero(held)[np.isnan(prices[:, held]).any(axis=0)][0]
+        raise Exception(
+            'Position is open (non-zero) and latest price is NaN '
+            'for security %s. Cannot update node value.' % names[i])
+    return np.where(held, pos * prices * mult, 0.)
+
+
+def _run_vectorized(strategy):
+    """
+    Runs a set up Strategy using array operations instead of updating the
+    tree on each date. Positions only change on rebalance dates, so the
+    engine steps from one rebalance date to the next and marks the whole
+    period to market at once. The results are written to the tree's store
+    and the nodes are left in the state the loop would have left them in.
+
+    Returns False, without touching the strategy, if its logic is not
+    supported (see _vectorized_plan).
+    """
+    plan = _vectorized_plan(strategy)
+    if plan is None:
+        return False
+    names, mask, weigh = plan
+
+    universe = strategy._universe
+    dates = universe.index
+    prices = universe[names].values.astype(float)
+    ndates, n = prices.shape
+    integer = strategy.integer_positions
+    fn = strategy.commission_fn
+
+    mult = np.ones(n)
+    for k, name in enumerate(names):
+        if name in strategy.children:
+            mult[k] = strategy.children[name].multiplier
+
+    positions = np.zeros((ndates, n))
+    outlays = np.zeros((ndates, n))
+    capital = np.empty(ndates)
+    fees = np.zeros(ndates)
+    # children are created the first time they get a non-zero target
+    created = np.full(n, -1, dtype=int)
+    created_order = []
+    last_trade = np.full(n, -1, dtype=int)
+    # (date, security, quantity, price, fee, outlay) of each booked trade
+    trades = []
+
+    pos = np.zeros(n)
+    cash = strategy._capital
+    capital[0] = cash
+
+    def book(i, q, cash):
+        traded = q != 0
+        prc = prices[i] * mult
+        out = q[traded] * prc[traded]
+        fee = bt.core._commissions(fn, q[traded], prc[traded])
+        trades.append((i, np.flatnonzero(traded), q[traded], prices[i, traded],
+                       fee, out))
+        pos[traded] += q[traded]
+        outlays[i, traded] += out
+        fees[i] += fee.sum()
+        last_trade[traded] = i
+        cash -= (out + fee).sum()
+        positions[i] = pos
+        capital[i] = cash
+        return cash
+
+    start = 1
+    for j in list(np.flatnonzero(mask)) + [ndates]:
+        # mark to market up to and including the next rebalance date
+        end = min(j + 1, ndates)
+        positions[start:end] = pos
+        capital[start:end] = cash
+        value = cash + _security_values(
+            prices[start:end], pos, mult, names).sum(axis=1)
+        neg = np.flatnonzero(value < 0)
+
+        if j < ndates and not len(neg):
+            w = weigh(j, prices[j])
+            new = np.flatnonzero((~np.isnan(w)) & (w != 0) & (created < 0))
+            created[new] = j
+            created_order.extend(new)
+
+            q = _rebalance_quantities(pos, prices[j] * mult, w, cash, fn,
+                                      integer, names, dates[j])
+            cash = book(j, q, cash)
+
+            held = pos != 0
+            if cash + (pos[held] * prices[j, held] * mult[held]).sum() < 0:
+                neg = [j - start]
+
+        if len(neg):
+            # bankrupt - flatten and stop trading
+            i = start + neg[0]
+            cash = book(i, -pos, cash)
+            positions[i + 1:] = 0
+            capital[i + 1:] = cash
+            strategy.bankrupt = True
+            break
+
+        start = j + 1
+
+    values = np.where(positions != 0, positions * prices * mult, 0.)
+    total = capital + values.sum(axis=1)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ret = total[1:] / total[:-1] - 1
+    zero = total[:-1] == 0
+    if (zero & (total[1:] != 0)).any():
+        i = np.flatnonzero(zero & (total[1:] != 0))[0] + 1
+        raise ZeroDivisionError(
+            'Could not update %s on %s. Last value was 0 and current value '
+            'is %s.' % (strategy.name, dates[i], total[i]))
+    ret[zero] = 0
+    price = np.cumprod(np.r_[strategy._price, 1 + ret])
+
+    store = strategy._store
+    col = strategy._col
+    store.value[:, col] = total
+    store.price[:, col] = price
+    store.cash[:, col] = capital
+    store.fees[:, col] = fees
+
+    # securities - same state as after the loop
+    for k in created_order:
+        name = names[k]
+        if name in strategy.children:
+            c = strategy.children[name]
+        else:
+            c = bt.core.SecurityBase(name)
+            strategy._add_child(c)
+            c.setup(universe)
+
+        # sparse securities are rebuilt from the trades
+        if not c._sparse:
+            store.position[:, c._col] = positions[:, k]
+            store.value[:, c._col] = values[:, k]
+            store.outlay[:, c._col] = outlays[:, k]
+
+        # idle securities stop updating the date after they are closed
+        held = np.flatnonzero(positions[:, k])
+        last = max(held[-1] if len(held) else -1, last_trade[k])
+        now = max(created[k], min(last + 1, ndates - 1)) if last >= 0 \
+            else created[k]
+
+        c.now = dates[now]
+        c._price = prices[now, k]
+        c._position = pos[k]
+        c._last_pos = pos[k]
+        c._value = values[now, k]
+        c._weight = values[-1, k] / total[-1] \
+            if pos[k] != 0 and total[-1] != 0 else 0.
+        c._needupdate = pos[k] != 0 or last_trade[k] == ndates - 1
+        if c._needupdate:
+            strategy._activate(c)
+
+    # record the trades now that the securities have their store columns
+    cols = np.array([strategy.children[name]._col if created[k] >= 0 else -1
+                     for k, name in enumerate(names)], dtype=int)
+    for i, k, q, prc, fee, out in trades:
+        if len(k):
+            store.trades.extend(i, cols[k], q, prc, fee, out)
+
+    strategy.now = dates[-1]
+    strategy.inow = ndates - 1
+    strategy._capital = cash
+    strategy._net_flows = 0
+    strategy._value = total[-1]
+    strategy._last_value = total[-2]
+    strategy._price = price[-1]
+    strategy._last_price = price[-2]
+    strategy._last_fee = fees[-1]
+    strategy.root.stale = False
+
+    return True
+
+
+def _fast_forward(strategy, i, stop):
+    """
+    Processes the dates of a Strategy, from position i up to stop
+    (excluded), on which its algo stack can not run (see Algo.next_run).
+    Positions do not change on these dates, so the securities and the
+    Strategy are marked to market for the whole gap at once with array
+    operations, in the same order as the loop. The store and the nodes are
+    left in the state the loop would have left them in.
+
+    Only root Strategies whose children are securities with prices in the
+    data are supported. Dates on which the loop would raise or go bankrupt
+    are left to the loop.
+
+    Returns:
+        The position of the next date to process with the loop - i if no
+        date could be skipped.
+
+    """
+    if type(strategy) is not bt.core.Strategy or \
+            strategy.parent is not strategy or strategy.bankrupt or \
+            strategy._has_strat_children:
+        return i
+
+    end = strategy.stack.next_run(strategy)
+    if end is None:
+        return i
+    end = min(end, stop)
+    if end <= i:
+        return i
+
+    active = strategy._activev
+    for c in active:
+        if type(c) is not bt.core.SecurityBase or not c._prices_set or \
+                c._outlay != 0 or (c._position == 0 and c._weight != 0):
+            return i
+
+    # value of each security and of the strategy over the gap - summed in
+    # the order of the loop
+    values = []
+    total = np.full(end - i, strategy._capital)
+    bad = np.zeros(end - i, dtype=bool)
+    for c in active:
+        prc = c._price_array[i:end]
+        with np.errstate(invalid='ignore'):
+            v = c._position * prc * c.multiplier
+        nan = np.isnan(prc)
+        if c._position == 0:
+            v[nan] = 0.
+        else:
+            # open position without a price
+            bad |= nan
+        values.append(v)
+        total += v
+
+    last = np.r_[strategy._value, total[:-1]]
+    with np.errstate(invalid='ignore'):
+        bad |= total < 0
+    bad |= (last == 0) & (total != 0)
+    if bad.any():
+        end = i + np.flatnonzero(bad)[0]
+        if end == i:
+            return i
+        total = total[:end - i]
+        last = last[:end - i]
+        values = [v[:end - i] for v in values]
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ret = np.where(last != 0, total / last - 1, 0.)
+    price = np.cumprod(np.r_[strategy._price, 1 + ret])
+
+    store = strategy._store
+    dates = store.index
+    col = strategy._col
+    store.value[i:end, col] = total
+    store.price[i:end, col] = price[1:]
+    store.cash[i:end, col] = strategy._capital
+    store.fees[i:end, col] = 0.
+
+    for c, v in zip(active, values):
+        # closed securities go idle after the first date
+        idle = c._position == 0
+        n = 1 if idle else end - i
+        if not c._sparse:
+            store.position[i:i + n, c._col] = c._position
+            store.value[i:i + n, c._col] = v[:n]
+        c.now = dates[i + n - 1]
+        c._price = c._price_array[i + n - 1]
+        c._value = v[n - 1]
+        c._last_pos = c._position
+        if idle:
+            c._needupdate = False
+            c._active = False
+        elif total[-1] != 0:
+            c._weight = v[-1] / total[-1]
+        else:
+            c._weight = 0.0
+    strategy._activev = [c for c in active if c._active]
+
+    strategy.now = dates[end - 1]
+    strategy.inow = end - 1
+    strategy._net_flows = 0
+    strategy._last_value = last[-1]
+    strategy._value = total[-1]
+    strategy._last_price = price[-2]
+    strategy._price = price[-1]
+    strategy._last_fee = 0.0
+    strategy.root.stale = False
+    strategy._dirty = False
+    strategy.temp = {}
+
+    return end
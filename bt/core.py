@@ -2,14 +2,608 @@
 Contains the core building blocks of the framework.
 """
 from __future__ import division
+import atexit
 import math
-from copy import deepcopy
+import os
+import tempfile
+import weakref
+from collections import OrderedDict
+from copy import copy, deepcopy
 
 import pandas as pd
 import numpy as np
 import cython as cy
 
 
+# files of the memory-mapped stores that own them, by path. A file is
+# deleted when its store goes away (weakref.finalize is not available on
+# Python 2), or at exit.
+_store_files = {}
+
+
+def _remove_store_file(path):
+    _store_files.pop(path, None)
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _collect_store_file(ref, path):
+    # the store owning the file went away - unless it was handed over
+    if _store_files.get(path) is ref:
+        _remove_store_file(path)
+
+
+@atexit.register
+def _remove_store_files():
+    for path in list(_store_files):
+        _remove_store_file(path)
+
+
+class TreeStore(object):
+
+    """
+    Columnar storage shared by every node of a tree.
+
+    Instead of each node allocating its own DataFrame, the root of a tree
+    owns one contiguous (dates x nodes) block per field and each node is
+    assigned an integer column in these blocks. A node's time series are
+    therefore zero-copy views into the store, and writing the current row of
+    all nodes during an update touches contiguous memory.
+
+    Strategies and securities track different quantities, but the same
+    number of them. To avoid allocating unused columns, the last two fields
+    are shared: they hold cash and fees for strategies, and position and
+    outlay for securities.
+
+    The block can be backed by a memory-mapped file (see directory), for
+    histories that do not fit in memory. Pickling such a store only sends
+    the file's location - the copy works on the same file.
+
+    In sparse mode, securities do not get columns in the block: their
+    positions, values and outlays are reconstructed from the trade ledger
+    and their prices when accessed, so memory tracks the number of trades
+    instead of dates x securities (see StrategyBase.use_sparse_storage).
+
+    Args:
+        * index (DatetimeIndex): Dates shared by all nodes in the tree.
+        * capacity (int): Initial number of node columns to allocate. The
+            store grows automatically when more nodes are added.
+        * sparse (bool): Sparse mode for securities.
+        * dtype (dtype): Type of the stored values. float32 halves the memory
+            used by the history - the nodes keep their running values in
+            double precision.
+        * directory (str): If set, the block is a memory-mapped .npy file
+            created in this directory. The file is deleted by close, or when
+            the store goes away.
+
+    Attributes:
+        * index (DatetimeIndex): Dates shared by all nodes in the tree.
+        * block (ndarray): (fields x dates x nodes) array backing the store.
+            Rows may be reserved past the last date (see extend_index).
+        * price (ndarray): dates x nodes block of prices.
+        * value (ndarray): dates x nodes block of values.
+        * cash, position (ndarray): dates x nodes block of cash (strategies)
+            or positions (securities).
+        * fees, outlay (ndarray): dates x nodes block of fees (strategies) or
+            outlays (securities).
+        * ncols (int): Number of columns in use.
+        * trades (TradeLedger): Trades of the tree's securities.
+        * sparse (bool): Sparse mode for securities.
+        * nsparse (int): Number of sparse nodes.
+        * dtype (dtype): Type of the stored values.
+        * path (str): File backing the block, if memory-mapped.
+
+    """
+
+    nfields = 4
+
+    def __init__(self, index, capacity=1, sparse=False, dtype=float,
+                 directory=None):
+        self.index = index
+        self.ncols = 0
+        self.block = None
+        self._buf = None
+        self.dtype = np.dtype(dtype)
+        self.directory = directory
+        self.path = None
+        self._owner = False
+        self._alloc(max(int(capacity), 1))
+        self.trades = TradeLedger()
+        self.sparse = sparse
+        self.nsparse = 0
+
+    def _alloc(self, capacity, rows=None):
+        if rows is None:
+            rows = len(self.index) if self._buf is None else \
+                self._buf.shape[1]
+        shape = (self.nfields, rows, capacity)
+        if self.directory is None:
+            block = np.zeros(shape, dtype=self.dtype)
+        else:
+            fd, path = tempfile.mkstemp(suffix='.npy', prefix='bt-store-',
+                                        dir=self.directory)
+            os.close(fd)
+            block = np.lib.format.open_memmap(path, mode='w+',
+                                              dtype=self.dtype, shape=shape)
+        if self.block is not None:
+            n = self.block.shape[1]
+            block[:, :n, :self.ncols] = self.block[:, :, :self.ncols]
+        self._set_block(block)
+
+        if self.directory is not None:
+            # the previous file is replaced once copied
+            self._remove()
+            self.path = path
+            self._own()
+
+    def _set_block(self, buf):
+        # the rows past the index are reserved for dates to come
+        self._buf = buf
+        block = buf[:, :len(self.index)]
+        self.block = block
+        # frames are views on the block - they must be rebuilt
+        self._frames = {}
+        self.price = block[0]
+        self.value = block[1]
+        self.cash = self.position = block[2]
+        self.fees = self.outlay = block[3]
+
+    def _own(self, owner=True):
+        """
+        Sets whether the store owns its file. The file of an owner is deleted
+        by close, or when the store goes away.
+        """
+        if owner:
+            path = self.path
+            _store_files[path] = weakref.ref(
+                self, lambda r, path=path: _collect_store_file(r, path))
+        elif self._owner:
+            _store_files.pop(self.path, None)
+        self._owner = owner
+
+    def _remove(self):
+        if self._owner and self.path is not None:
+            _remove_store_file(self.path)
+        self._owner = False
+
+    def flush(self):
+        """
+        Writes a memory-mapped block to its file.
+        """
+        if isinstance(self._buf, np.memmap):
+            self._buf.flush()
+
+    def close(self):
+        """
+        Releases a memory-mapped block and deletes its file if it was created
+        by this store. The nodes using the store must not be used
+        afterwards. Does nothing if the store is in memory.
+        """
+        if self.path is None:
+            return
+        self.block = self._buf = self.price = self.value = None
+        self.cash = self.position = self.fees = self.outlay = None
+        self._frames = {}
+        self._remove()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        # the views on the block are rebuilt by the copy
+        for k in ['block', '_buf', 'price', 'value', 'cash', 'position',
+                  'fees', 'outlay', '_frames']:
+            state.pop(k, None)
+        if self.path is None:
+            # only the columns in use are sent
+            state['_buf'] = self.block[:, :, :max(self.ncols, 1)]
+        return state
+
+    def __setstate__(self, state):
+        buf = state.pop('_buf', None)
+        self.__dict__.update(state)
+        if self.path is not None:
+            # the copy maps the same file - copies never delete it
+            self._owner = False
+            buf = np.load(self.path, mmap_mode='r+')
+        self._set_block(buf)
+
+    def copy(self, nrows=None):
+        """
+        Returns an in-memory copy of the store, limited to its first nrows
+        dates. The copy keeps the directory option: its block is moved to a
+        memory-mapped file when it grows.
+        """
+        if nrows is None:
+            nrows = len(self.index)
+        store = TreeStore(self.index[:nrows], capacity=self.ncols,
+                          sparse=self.sparse, dtype=self.dtype)
+        store.block[:, :, :self.ncols] = self.block[:, :nrows, :self.ncols]
+        store.ncols = self.ncols
+        store.nsparse = self.nsparse
+        trades = self.trades.records
+        store.trades.extend(trades['date'], trades['node'],
+                            trades['quantity'], trades['price'],
+                            trades['fee'], trades['outlay'])
+        store.directory = self.directory
+        return store
+
+    def add_column(self):
+        """
+        Reserve a new column and return its integer index. Node columns are
+        never moved, so the index remains valid if the store grows.
+        """
+        if self.ncols == self._buf.shape[2]:
+            # amortized growth - double capacity
+            self._alloc(2 * self.ncols)
+
+        col = self.ncols
+        self.ncols += 1
+        return col
+
+    def extend_index(self, index):
+        """
+        Grows the store to a longer index - the current dates followed by new
+        ones. The new rows are empty. Rows are reserved ahead (the number of
+        rows doubles when they run out), so that adding dates one at a time
+        is amortized.
+        """
+        if len(index) > self._buf.shape[1]:
+            self._alloc(self._buf.shape[2],
+                        max(len(index), 2 * self._buf.shape[1]))
+        self.index = index
+        self._set_block(self._buf)
+
+    def add_sparse_node(self):
+        """
+        Returns the id of a new sparse node. Sparse nodes have no column in
+        the block - the id identifies their trades in the ledger.
+        """
+        node = self.nsparse
+        self.nsparse += 1
+        return node
+
+    def series(self, field, col, name=None):
+        """
+        Returns a zero-copy Series view of a node's column for a given field.
+        """
+        return pd.Series(getattr(self, field)[:, col], index=self.index,
+                         name=name)
+
+    def frame(self, col, columns):
+        """
+        Returns a zero-copy DataFrame view of all the fields of a node's
+        column. The view is cached until the store grows.
+        """
+        frame = self._frames.get(col)
+        if frame is None:
+            frame = pd.DataFrame(self.block[:, :, col].T, index=self.index,
+                                 columns=columns, copy=False)
+            self._frames[col] = frame
+        return frame
+
+
+class TradeLedger(object):
+
+    """
+    Growable columnar record of the trades of a tree.
+
+    Each fill is appended when it happens (see SecurityBase.allocate) to a
+    NumPy structured array, so reading the trades back costs the number of
+    trades instead of dates x securities.
+
+    Args:
+        * capacity (int): Initial number of trades to allocate. The ledger
+            grows automatically.
+
+    Attributes:
+        * records (ndarray): Structured array of the trades so far, with
+            fields date (row in the tree's index), node (TreeStore column of
+            the security), quantity, price, fee and outlay (quantity x price
+            x multiplier, fee excluded).
+        * n (int): Number of trades.
+
+    """
+
+    dtype = np.dtype([('date', np.int64), ('node', np.int64),
+                      ('quantity', float), ('price', float), ('fee', float),
+                      ('outlay', float)])
+
+    def __init__(self, capacity=64):
+        self.n = 0
+        self._data = np.zeros(max(int(capacity), 1), dtype=self.dtype)
+        self._order = None
+
+    def _reserve(self, n):
+        if self.n + n > len(self._data):
+            # amortized growth - double capacity
+            data = np.zeros(max(2 * len(self._data), self.n + n),
+                            dtype=self.dtype)
+            data[:self.n] = self._data[:self.n]
+            self._data = data
+
+    def append(self, date, node, quantity, price, fee, outlay):
+        """
+        Record a trade.
+        """
+        self._reserve(1)
+        self._data[self.n] = (date, node, quantity, price, fee, outlay)
+        self.n += 1
+
+    def extend(self, date, node, quantity, price, fee, outlay):
+        """
+        Record several trades at once - all arguments are broadcast to
+        arrays.
+        """
+        quantity = np.atleast_1d(quantity)
+        n = len(quantity)
+        self._reserve(n)
+        rows = self._data[self.n:self.n + n]
+        rows['date'] = date
+        rows['node'] = node
+        rows['quantity'] = quantity
+        rows['price'] = price
+        rows['fee'] = fee
+        rows['outlay'] = outlay
+        self.n += n
+
+    @property
+    def records(self):
+        return self._data[:self.n]
+
+    def node_records(self, node):
+        """
+        Returns the trades of a node, in the order they were recorded.
+        """
+        # trades sorted by node - rebuilt when trades were added
+        if self._order is None or len(self._order[0]) != self.n:
+            nodes = self._data['node'][:self.n]
+            order = np.argsort(nodes, kind='mergesort')
+            self._order = order, nodes[order]
+        order, nodes = self._order
+        start, stop = np.searchsorted(nodes, [node, node + 1])
+        return self._data[order[start:stop]]
+
+    def positions(self, node, ndates):
+        """
+        Returns a node's position on each of the first ndates dates.
+        """
+        rec = self.node_records(node)
+        pos = np.zeros(ndates)
+        np.add.at(pos, rec['date'], rec['quantity'])
+        return np.cumsum(pos)
+
+    def outlays(self, node, ndates):
+        """
+        Returns a node's outlays on each of the first ndates dates.
+        """
+        rec = self.node_records(node)
+        outlay = np.zeros(ndates)
+        np.add.at(outlay, rec['date'], rec['outlay'])
+        return outlay
+
+
+# attributes a Node gets when it is set up and run - its data, history and
+# paper trade. Clones start without them (see Node.clone).
+_RUN_ATTRS = ('_store', '_positions', '_paper', '_original_data', '_universe',
+              '_universe_values', '_has_data', '_data_counts', '_funiverse',
+              '_price_values', '_buffers', '_paper_positions',
+              '_paper_strats', '_paper_mult')
+
+
+def _clone(value, memo):
+    """
+    Copies an attribute of a Node or Algo being cloned (see Node.clone).
+    """
+    if isinstance(value, Algo):
+        if id(value) in memo:
+            return memo[id(value)]
+        return value.clone(memo)
+    if isinstance(value, Node):
+        # nodes outside of the cloned tree (the parent of a cloned sub-tree
+        # for example) are not copied
+        return memo.get(id(value), value)
+    if isinstance(value, (pd.DataFrame, pd.Series, pd.Index, np.ndarray)):
+        # read-only inputs - shared
+        return value
+    if type(value) is list:
+        return [_clone(v, memo) for v in value]
+    if type(value) is tuple:
+        return tuple(_clone(v, memo) for v in value)
+    if type(value) is dict:
+        return dict((k, _clone(v, memo)) for k, v in value.items())
+    return deepcopy(value, memo)
+
+
+def _window_rows(index, lookback, lag, first=0):
+    """
+    Row ranges (starts, stops) of the lookback windows ending at each date of
+    the index from position first on - StrategyBase.universe_rows for every
+    date at once.
+    """
+    now = np.arange(first, len(index))
+
+    if isinstance(lag, (int, np.integer)):
+        stops = now - lag + 1
+        empty = stops <= 0
+        stops[empty] = 0
+        t0 = index[np.maximum(stops - 1, 0)]
+    else:
+        t0 = pd.DatetimeIndex([t - lag for t in index[first:]])
+        stops = index.searchsorted(t0, side='right').astype(int)
+        empty = np.zeros(len(now), dtype=bool)
+
+    # never look past the current row
+    stops = np.minimum(stops, now + 1)
+
+    if isinstance(lookback, (int, np.integer)):
+        starts = stops - lookback
+    else:
+        starts = index.searchsorted(
+            pd.DatetimeIndex([t - lookback for t in t0]), side='left')
+    starts = np.minimum(np.maximum(starts, 0), stops)
+    starts[empty] = 0
+    return starts, stops
+
+
+class _RowBuffer(object):
+
+    """
+    Array that grows by rows in place: rows are reserved past the ones in
+    use, and their number doubles when they run out (as in
+    TreeStore.extend_index), so that adding rows a few at a time is
+    amortized.
+
+    Args:
+        * values (ndarray): Rows in use. They are copied on the first growth.
+
+    Attributes:
+        * array (ndarray): View of the rows in use.
+
+    """
+
+    def __init__(self, values):
+        self._buf = values
+        self.array = values
+
+    def extend(self, n, start):
+        """
+        Returns a buffer holding the first start rows followed by room for
+        n - start new rows, to be written by the caller. The rows are added
+        in place, unless there is no room left or the buffer was already
+        extended past start (its rows are used by another holder) - the
+        rows are then copied to a new buffer.
+        """
+        buf = self._buf
+        if len(self.array) != start or n > len(buf):
+            rows = np.empty((max(n, 2 * start),) + buf.shape[1:],
+                            dtype=buf.dtype)
+            rows[:start] = self.array[:start]
+            if len(self.array) != start:
+                res = _RowBuffer(rows)
+                res.array = rows[:n]
+                return res
+            self._buf = buf = rows
+        self.array = buf[:n]
+        return self
+
+
+def _flag_data(values, buf=None, start=0):
+    """
+    Buffer (see _RowBuffer) of a boolean matrix flagging the values that are
+    data (not NaN and > 0). If buf is given, it holds the flags of the first
+    start rows and only the rows that follow are flagged.
+    """
+    if buf is None:
+        buf = _RowBuffer(np.empty((0,) + values.shape[1:], dtype=bool))
+        start = 0
+    buf = buf.extend(len(values), start)
+    with np.errstate(invalid='ignore'):
+        np.greater(values[start:], 0, out=buf.array[start:])
+    return buf
+
+
+def _count_data(values, buf=None, start=0):
+    """
+    Buffer (see _RowBuffer) of the cumulative counts of the values that are
+    not NaN in each column - row k counts the values of rows 0 to k
+    (excluded). If buf is given, it holds the counts of the first start rows
+    and only the rows that follow are counted.
+    """
+    if buf is None:
+        buf = _RowBuffer(np.zeros((1,) + values.shape[1:], dtype=np.int32))
+        start = 0
+    buf = buf.extend(len(values) + 1, start + 1)
+    out = buf.array
+    np.cumsum(~np.isnan(values[start:]), axis=0, dtype=np.int32,
+              out=out[start + 1:])
+    out[start + 1:] += out[start]
+    return buf
+
+
+# has-data matrices of the universes by id of the universe - see
+# _universe_has_data. An entry goes away with its universe.
+_has_data_cache = {}
+
+
+def _universe_has_data(universe, values, buf=None, start=0):
+    """
+    Has-data matrix of a universe (see _flag_data), in a buffer. Built on
+    first use and shared by all the strategies with the same universe.
+    """
+    key = id(universe)
+    cached = _has_data_cache.get(key)
+    if cached is not None and cached[0]() is universe:
+        return cached[1]
+
+    buf = _flag_data(values, buf, start)
+    ref = weakref.ref(universe,
+                      lambda r, key=key: _has_data_cache.pop(key, None))
+    _has_data_cache[key] = ref, buf
+    return buf
+
+
+def _grown(old, index):
+    """
+    Returns the number of dates of index that are in old when index is old
+    followed by new dates (see StrategyBase.extend_universe), and 0
+    otherwise. What is computed for each date of an index can then be
+    computed for the new dates only.
+    """
+    if old is None or not 0 < len(old) < len(index):
+        return 0
+    k = len(old)
+    if index[0] != old[0] or index[k - 1] != old[k - 1]:
+        return 0
+    return k
+
+
+# row ranges of the lookback windows by (id of the index, lookback, lag) -
+# see _window_bounds. The least recently used entries are evicted past
+# _WINDOWS_CACHE_SIZE and an entry goes away with its index.
+_windows_cache = OrderedDict()
+_WINDOWS_CACHE_SIZE = 16
+
+
+def _window_bounds(index, lookback, lag):
+    """
+    Row ranges (see _window_rows) of the lookback windows ending at each
+    date of an index. Built on first use and shared by all the strategies
+    with the same index - only the dates appended to an index already seen
+    are computed.
+    """
+    key = (id(index), lookback, lag)
+    cached = _windows_cache.pop(key, None)
+    if cached is not None and cached[0]() is index:
+        _windows_cache[key] = cached
+        return cached[1:]
+
+    first = 0
+    for k, entry in list(_windows_cache.items()):
+        if k[1:] == key[1:]:
+            first = _grown(entry[0](), index)
+            if first:
+                break
+    if first:
+        # the windows of the old dates do not change
+        del _windows_cache[k]
+        starts, stops = _window_rows(index, lookback, lag, first)
+        starts = np.r_[entry[1][:first], starts]
+        stops = np.r_[entry[2][:first], stops]
+    else:
+        starts, stops = _window_rows(index, lookback, lag)
+
+    ref = weakref.ref(index,
+                      lambda r, key=key: _windows_cache.pop(key, None))
+    _windows_cache[key] = ref, starts, stops
+    while len(_windows_cache) > _WINDOWS_CACHE_SIZE:
+        try:
+            _windows_cache.popitem(last=False)
+        except KeyError:
+            break
+    return starts, stops
+
+
 class Node(object):
 
     """
@@ -47,10 +641,15 @@ class Node(object):
     _weight = cy.declare(cy.double)
     _issec = cy.declare(cy.bint)
     _has_strat_children = cy.declare(cy.bint)
+    _dirty = cy.declare(cy.bint)
+    _active = cy.declare(cy.bint)
+    _col = cy.declare(cy.int)
 
     def __init__(self, name, parent=None, children=None):
 
         self.name = name
+        # in the parent's active children (see _activate)
+        self._active = False
 
         # strategy children helpers
         self._has_strat_children = False
@@ -76,8 +675,8 @@ class Node(object):
                             tmp[c] = SecurityBase(c)
                             ut.append(c)
                         else:
-                            # deepcopy object for possible later reuse
-                            tmp[c.name] = deepcopy(c)
+                            # copy object for possible later reuse
+                            tmp[c.name] = c.clone()
 
                             # if strategy, turn on flag and add name to list
                             # strategy children have special treatment
@@ -111,9 +710,12 @@ class Node(object):
         self.children = children
 
         self._childrenv = list(children.values())
+        self._activev = []
         for c in self._childrenv:
             c.parent = self
             c.root = self.root
+            c._active = False
+            self._activate(c)
 
         # set default value for now
         self.now = 0
@@ -123,6 +725,10 @@ class Node(object):
         # to update if another node tries to access a given value (say weight).
         # This avoid calling the update until it is actually needed.
         self.root.stale = False
+        # set when the node's value may have changed since its last update.
+        # Marks are propagated up to the root (see _mark_dirty) so that a
+        # stale update only walks the sub-trees that actually changed.
+        self._dirty = False
 
         # helper vars
         self._price = 0
@@ -132,9 +738,58 @@ class Node(object):
         # is security flag - used to avoid updating 0 pos securities
         self._issec = False
 
+        # column in the root's TreeStore - assigned on setup
+        self._store = None
+        self._col = -1
+
     def __getitem__(self, key):
         return self.children[key]
 
+    def clone(self, memo=None):
+        """
+        Returns a copy of the Node and its children, ready to be used in a new
+        tree (a Backtest for example). This is used instead of deepcopy: the
+        algos are cloned (see Algo.clone) and pandas objects and arrays are
+        shared with the original, since they are read-only inputs. Other
+        attributes are deep copied.
+
+        The data, history and paper trade of a Node that has been set up
+        are left out - they are rebuilt when the clone is set up (see
+        setup) - so the clone shares no run state with the original. Its
+        positions and the state of its algos are copied though: clone a
+        Node before it runs to reuse it.
+
+        The clone's parent and root are the original's, unless they are part
+        of the cloned tree.
+
+        Args:
+            * memo (dict): deepcopy memo, used to clone trees.
+
+        """
+        if memo is None:
+            memo = {}
+        c = copy(self)
+        memo[id(self)] = c
+
+        state = {}
+        # children first so that the other references to them point to the
+        # clones
+        if self.children:
+            state['children'] = dict((k, v.clone(memo))
+                                     for k, v in self.children.items())
+        for k, v in self.__dict__.items():
+            if k in _RUN_ATTRS:
+                c.__dict__.pop(k)
+            elif k not in state:
+                state[k] = _clone(v, memo)
+        c.__dict__.update(state)
+        # as they are before setup
+        c._store = None
+        if isinstance(c, StrategyBase):
+            c._positions = None
+            c._paper = None
+        return c
+
     def use_integer_positions(self, integer_positions):
         """
         Set indicator to use (or not) integer positions for a given strategy or
@@ -195,6 +850,29 @@ class Node(object):
         """
         raise NotImplementedError()
 
+    def extend_universe(self, universe, start=None):
+        """
+        Extends the universe of a Node that is set up with new dates (see
+        StrategyBase.extend_universe). start is the number of dates the Node
+        had - parents pass it to their children, whose store has grown
+        already.
+        """
+        raise NotImplementedError()
+
+    def _setup_store(self, index, sparse=False, dtype=float, directory=None):
+        """
+        Reserve a column for this Node in the tree's TreeStore. The topmost
+        Node creates the store (with the sparse, dtype and directory
+        options), other Nodes share their parent's store.
+        """
+        if self.parent is self or self.parent._store is None:
+            self._store = TreeStore(index, capacity=len(self.members),
+                                    sparse=sparse, dtype=dtype,
+                                    directory=directory)
+        else:
+            self._store = self.parent._store
+        self._col = self._store.add_column()
+
     def _add_child(self, child):
         child.parent = self
         child.root = self.root
@@ -206,6 +884,26 @@ class Node(object):
             self.children[child.name] = child
 
         self._childrenv = list(self.children.values())
+        self._activate(child)
+
+    def _activate(self, child):
+        # children visited on update - strategies, and securities that need
+        # updating (open positions or recent trades). Securities that go idle
+        # are dropped by StrategyBase.update, so the cost of an update scales
+        # with the current holdings instead of all the children ever held.
+        if not child._active:
+            child._active = True
+            self._activev.append(child)
+
+    def _mark_dirty(self):
+        # flag the path from this node up to the root. Stops at the first
+        # node that is already flagged - its ancestors are flagged as well.
+        node = self
+        while not node._dirty:
+            node._dirty = True
+            if node.parent is node or node.parent is None:
+                break
+            node = node.parent
 
     def update(self, date, data=None, inow=None):
         """
@@ -267,6 +965,7 @@ class StrategyBase(Node):
         * root (Strategy): Root node of the tree (topmost node)
         * children (dict): Strategy's children
         * now (datetime): Used when backtesting to store current date
+        * inow (int): Integer position of now in the universe's index
         * stale (bool): Flag used to determine if Strategy is stale and need
             updating
         * prices (TimeSeries): Prices of the Strategy - basically an index that
@@ -288,6 +987,14 @@ class StrategyBase(Node):
         * universe (DataFrame): Data universe available at the current time.
             Universe contains the data passed in when creating a Backtest. Use
             this data to determine strategy logic.
+        * light_paper_trade (bool): Use the paper trade ledger instead of a
+            full paper strategy (see use_light_paper_trade).
+        * sparse_storage (bool): Store the securities' positions and
+            outlays sparsely (see use_sparse_storage).
+        * store_dtype (dtype): Type of the stored history (see
+            set_store_dtype).
+        * store_directory (str): Directory of the memory-mapped history, if
+            any (see set_store_directory).
 
     """
 
@@ -297,6 +1004,11 @@ class StrategyBase(Node):
     _last_price = cy.declare(cy.double)
     _last_fee = cy.declare(cy.double)
     _paper_trade = cy.declare(cy.bint)
+    _paper_cash = cy.declare(cy.double)
+    _paper_value = cy.declare(cy.double)
+    _paper_price = cy.declare(cy.double)
+    _paper_follow = cy.declare(cy.bint)
+    _paper_synced = cy.declare(cy.bint)
     bankrupt = cy.declare(cy.bint)
 
     def __init__(self, name, children=None, parent=None):
@@ -316,8 +1028,18 @@ class StrategyBase(Node):
         self.commission_fn = self._dflt_comm_fn
 
         self._paper_trade = False
+        self._paper = None
+        self.light_paper_trade = False
+        # the price was set from the light paper trade, and trades are not
+        # mirrored in it (see paper_rebalance)
+        self._paper_follow = False
+        self._paper_synced = False
+        self.sparse_storage = False
+        self.store_dtype = np.float64
+        self.store_directory = None
         self._positions = None
         self.bankrupt = False
+        self.inow = 0
 
     @property
     def price(self):
@@ -346,6 +1068,30 @@ class StrategyBase(Node):
             self.root.update(self.now, None)
         return self._values.loc[:self.now]
 
+    @property
+    def data(self):
+        """
+        DataFrame of prices, values, cash and fees. This is a view on the
+        tree's TreeStore.
+        """
+        return self._store.frame(self._col, ['price', 'value', 'cash', 'fees'])
+
+    @property
+    def _prices(self):
+        return self._store.series('price', self._col, 'price')
+
+    @property
+    def _values(self):
+        return self._store.series('value', self._col, 'value')
+
+    @property
+    def _cash(self):
+        return self._store.series('cash', self._col, 'cash')
+
+    @property
+    def _fees(self):
+        return self._store.series('fees', self._col, 'fees')
+
     @property
     def capital(self):
         """
@@ -384,9 +1130,100 @@ class StrategyBase(Node):
             return self._funiverse
         else:
             self._last_chk = self.now
-            self._funiverse = self._universe.loc[:self.now]
+            # the rows up to now - found from now rather than inow so that
+            # it holds for callers that only set now
+            stop = self._universe.index.searchsorted(self.now, side='right')
+            self._funiverse = self._universe.iloc[:stop]
             return self._funiverse
 
+    @property
+    def universe_row(self):
+        """
+        Current row of the universe as an ndarray (ordered like
+        universe.columns). This is a view on the universe's data and should
+        not be modified.
+        """
+        return self._universe_values[self.inow]
+
+    @property
+    def universe_has_data(self):
+        """
+        Boolean ndarray flagging the columns of the universe that have data
+        (a price that is not NaN and > 0) on the current date, ordered like
+        universe.columns. This is a view and should not be modified.
+        """
+        if self._has_data is None:
+            self._set_has_data()
+        return self._has_data[self.inow]
+
+    def universe_rows(self, lookback, lag=0):
+        """
+        Integer row range (start, stop) of a lookback window ending at the
+        current date. This is the positional equivalent of
+        universe.loc[now - lag - lookback:now - lag].
+
+        Args:
+            * lookback (int, DateOffset): Window length, in rows if int.
+            * lag (int, DateOffset): Lag of the window's end, in rows if int.
+
+        """
+        index = self._universe.index
+
+        if isinstance(lag, (int, np.integer)):
+            stop = self.inow - lag + 1
+            if stop <= 0:
+                return 0, 0
+            t0 = index[stop - 1]
+        else:
+            t0 = self.now - lag
+            stop = int(index.searchsorted(t0, side='right'))
+
+        # never look past the current row
+        stop = min(stop, self.inow + 1)
+
+        if isinstance(lookback, (int, np.integer)):
+            start = stop - lookback
+        else:
+            start = int(index.searchsorted(t0 - lookback, side='left'))
+
+        return min(max(start, 0), stop), stop
+
+    def universe_window(self, lookback, lag=0):
+        """
+        Lookback window of the universe as an ndarray (see universe_rows).
+        This is a view on the universe's data and should not be modified.
+        """
+        start, stop = self.universe_rows(lookback, lag)
+        return self._universe_values[start:stop]
+
+    def universe_returns(self, lookback, lag=0):
+        """
+        Total return (last / first - 1) of each column of the universe over
+        a lookback window ending at the current date (see universe_rows).
+        The windows on all dates are found the first time a lookback and
+        lag are used (see _window_bounds), so this costs the number of
+        columns.
+        """
+        starts, stops = _window_bounds(self._universe.index, lookback, lag)
+        start, stop = starts[self.inow], stops[self.inow]
+        if start == stop:
+            raise IndexError('empty lookback window on %s' % self.now)
+
+        values = self._universe_values
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return values[stop - 1] / values[start] - 1
+
+    def universe_counts(self, start, stop):
+        """
+        Number of values that are not NaN in each column of the universe's
+        rows start to stop (excluded) - see universe_rows. Computed from
+        cumulative counts built on first use, so the cost does not depend on
+        the number of rows.
+        """
+        if self._data_counts is None:
+            self._set_data_counts()
+        return self._data_counts[stop] - self._data_counts[start]
+
     @property
     def securities(self):
         """
@@ -415,6 +1252,114 @@ class StrategyBase(Node):
         self._positions = vals
         return vals
 
+    def get_positions(self, sparse=False):
+        """
+        Positions of the securities.
+
+        Args:
+            * sparse (bool): If False, returns a DataFrame of positions
+                (see positions). If True, returns a Series of the positions
+                indexed by (Date, Security), only at the dates they changed.
+                Positions of a security held by several sub-strategies are
+                summed.
+
+        """
+        if not sparse:
+            return self.positions
+        return self._sparse_trades('quantity', cumulative=True)
+
+    def get_outlays(self, sparse=False):
+        """
+        Outlays of the securities.
+
+        Args:
+            * sparse (bool): If False, returns a DataFrame of outlays (see
+                outlays). If True, returns a Series of the non-zero outlays
+                indexed by (Date, Security). Outlays of a security held by
+                several sub-strategies are summed.
+
+        """
+        if not sparse:
+            return self.outlays
+        return self._sparse_trades('outlay')
+
+    def _sparse_trades(self, field, cumulative=False):
+        """
+        Sums a field of the trade ledger by date and security name.
+        """
+        if self.root.stale:
+            self.root.update(self.root.now, None)
+
+        names = dict((x._col, x.name) for x in self.securities)
+        trades = self._store.trades.records
+        trades = trades[np.in1d(trades['node'], list(names))]
+
+        res = pd.Series(
+            trades[field],
+            index=pd.MultiIndex.from_arrays(
+                [self._store.index[trades['date']],
+                 [names[c] for c in trades['node']]],
+                names=['Date', 'Security']), name=field)
+        res = res.groupby(level=['Date', 'Security']).sum()
+        if cumulative:
+            res = res[res != 0].groupby(level='Security').cumsum()
+        else:
+            res = res[res != 0]
+        return res
+
+    def use_sparse_storage(self, sparse=True):
+        """
+        Set the storage mode of the securities in the tree. Must be called on
+        the topmost Strategy, before setup.
+
+        By default, each security the tree trades gets dense price, value,
+        position and outlay columns over all the dates. With sparse storage,
+        only the trades are stored (see TradeLedger) - positions, outlays and
+        values are reconstructed from the trades and the universe's prices
+        when they are accessed. This is useful with very wide universes where
+        the strategy trades many different securities over time.
+
+        Args:
+            * sparse (bool): Use sparse storage?
+
+        """
+        self.sparse_storage = sparse
+
+    def set_store_dtype(self, dtype):
+        """
+        Set the type of the values stored in the tree's history (prices,
+        values, positions, outlays, cash and fees). Must be called on the
+        topmost Strategy, before setup.
+
+        With float32, the history takes half the memory. The nodes keep their
+        running values (capital, value, price, positions) in double
+        precision, so the precision loss does not accumulate over time - the
+        stored values are rounded to about 7 significant digits.
+
+        Args:
+            * dtype (dtype): numpy.float64 (default) or numpy.float32.
+
+        """
+        self.store_dtype = dtype
+
+    def set_store_directory(self, directory):
+        """
+        Store the tree's history in a memory-mapped file created in
+        directory, instead of memory. Must be called on the topmost Strategy,
+        before setup.
+
+        This allows histories larger than the memory - the operating system
+        pages the file in and out as needed. The prices, values, etc.
+        accessors are unchanged. The file is deleted by the store's close
+        method (see Backtest.close).
+
+        Args:
+            * directory (str): Directory of the file. None stores the history
+                in memory (default).
+
+        """
+        self.store_directory = directory
+
     def setup(self, universe):
         """
         Setup strategy with universe. This will speed up future calculations
@@ -429,15 +1374,44 @@ class StrategyBase(Node):
             self._paper_trade = True
             self._paper_amount = 1000000
 
-            paper = deepcopy(self)
-            paper.parent = paper
-            paper.root = paper
-            paper._paper_trade = False
-            paper.setup(self._original_data)
-            paper.adjust(self._paper_amount)
-            self._paper = paper
+            if not self.light_paper_trade:
+                paper = self.clone()
+                paper.parent = paper
+                # make sure the whole paper tree points to its new root
+                for m in paper.members:
+                    m.root = paper
+                paper._paper_trade = False
+                # the paper trade's history stays in memory
+                paper.set_store_directory(None)
+                paper.setup(self._original_data)
+                paper.adjust(self._paper_amount)
+                self._paper = paper
 
         # setup universe
+        self._setup_universe(universe)
+
+        if self._paper_trade and self.light_paper_trade:
+            self._setup_paper_ledger()
+
+        # We're not bankrupt yet
+        self.bankrupt = False
+        self._dirty = False
+
+        # setup internal data
+        self._setup_store(self._universe.index, sparse=self.sparse_storage,
+                          dtype=self.store_dtype,
+                          directory=self.store_directory)
+
+        # setup children as well - use original universe here - don't want to
+        # pollute with potential strategy children in funiverse
+        if self.children is not None:
+            [c.setup(universe) for c in self._childrenv]
+
+    def _setup_universe(self, universe):
+        """
+        Sets up the Strategy's universe - universe limited to the Strategy's
+        tickers, with a column for each strategy child if any.
+        """
         funiverse = universe
 
         if self._universe_tickers is not None:
@@ -447,6 +1421,9 @@ class StrategyBase(Node):
                                 .intersection(self._universe_tickers))
 
             funiverse = universe[valid_filter].copy()
+            # the dates are shared with the universe, as what is computed
+            # for them (see _window_bounds)
+            funiverse.index = universe.index
 
             # if we have strat children, we will need to create their columns
             # in the new universe
@@ -454,39 +1431,138 @@ class StrategyBase(Node):
                 for c in self._strat_children:
                     funiverse[c] = np.nan
 
+                # use a single float block so that the strat children's
+                # prices can be written in place (see update)
+                funiverse = pd.DataFrame(
+                    funiverse.values.astype(float), index=funiverse.index,
+                    columns=funiverse.columns, copy=False)
+                self._strat_cols = np.array(
+                    [funiverse.columns.get_loc(c)
+                     for c in self._strat_children], dtype=int)
+                self._strat_childv = [self.children[c]
+                                      for c in self._strat_children]
+
             # must create to avoid pandas warning
             funiverse = pd.DataFrame(funiverse)
 
         self._universe = funiverse
+        self._universe_values = funiverse.values
+        # securities with data on each date - see universe_has_data
+        self._has_data = None
+        # cumulative counts of values - see universe_counts
+        self._data_counts = None
+        # buffers of the arrays above, which grow with the universe (see
+        # extend_universe)
+        self._buffers = {}
         # holds filtered universe
         self._funiverse = funiverse
         self._last_chk = None
 
-        # We're not bankrupt yet
-        self.bankrupt = False
+    def _set_has_data(self, start=0):
+        """
+        Builds the has-data matrix of the universe (see universe_has_data),
+        or only its rows from start on if it is being extended. Strategies
+        with the same universe share it, unless they have strategy children:
+        their prices are written in the universe as the Strategy runs.
+        """
+        buf = self._buffers.get('has_data') if start else None
+        if self._has_strat_children:
+            buf = _flag_data(self._universe_values, buf, start)
+        else:
+            buf = _universe_has_data(self._universe, self._universe_values,
+                                     buf, start)
+        self._buffers['has_data'] = buf
+        self._has_data = buf.array
 
-        # setup internal data
-        self.data = pd.DataFrame(index=funiverse.index,
-                                 columns=['price', 'value', 'cash', 'fees'],
-                                 data=0.0)
+    def _set_data_counts(self, start=0):
+        """
+        Builds the cumulative counts of values of the universe (see
+        universe_counts), or only their rows from start on if they are
+        being extended.
+        """
+        buf = self._buffers.get('counts') if start else None
+        buf = _count_data(self._universe_values, buf, start)
+        self._buffers['counts'] = buf
+        self._data_counts = buf.array
+
+    def _extend_values(self, universe, n):
+        """
+        Grows the Strategy's universe from its first n dates to those of
+        universe, writing the new rows in a buffer (see _RowBuffer) rather
+        than filtering and copying the whole universe again.
+        """
+        if self._universe_tickers is None:
+            self._universe = self._funiverse = universe
+            self._universe_values = universe.values
+            return
 
-        self._prices = self.data['price']
-        self._values = self.data['value']
-        self._cash = self.data['cash']
-        self._fees = self.data['fees']
+        buf = self._buffers.get('universe')
+        if buf is None:
+            buf = _RowBuffer(self._universe_values)
+        buf = buf.extend(len(universe.index), n)
+        self._buffers['universe'] = buf
+        values = buf.array
+
+        # columns of the strategy children are not in the universe
+        columns = self._universe.columns
+        cols = universe.columns.get_indexer(columns)
+        values[n:] = np.take(universe.values[n:], cols, axis=1)
+        values[n:, cols < 0] = np.nan
+
+        self._universe = self._funiverse = pd.DataFrame(
+            values, index=universe.index, columns=columns, copy=False)
+        self._universe_values = values
+        self._last_chk = None
+
+    def extend_universe(self, universe, start=None):
+        """
+        Extends the universe of a Strategy that is set up, and its children's,
+        with new dates. The Strategy can then carry on from where it stopped
+        instead of being run again from the start: its state is kept and its
+        history grows in place (see TreeStore.extend_index).
+
+        Only the new dates are processed: the universes, the has-data flags
+        and the counts of values are held in buffers that grow in place
+        (see _RowBuffer), so that adding dates a few at a time is
+        amortized.
+
+        Args:
+            * universe (DataFrame): The Strategy's universe followed by the
+                new dates, with the same columns.
+            * start (int): Number of dates the Strategy had (see
+                Node.extend_universe).
+
+        """
+        if self.parent is self or self._store is not self.parent._store:
+            # top of a tree (or of a paper trade) - owns the store
+            self._store.extend_index(universe.index)
+        self._original_data = universe
+
+        n = len(self._universe.index)
+        if start is None:
+            start = n
+        self._extend_values(universe, n)
+        # only the new rows are flagged and counted
+        if self._has_data is not None:
+            self._set_has_data(n)
+        if self._data_counts is not None:
+            self._set_data_counts(n)
+
+        if self._paper_trade and self._paper is not None:
+            self._paper.extend_universe(universe, start)
 
-        # setup children as well - use original universe here - don't want to
-        # pollute with potential strategy children in funiverse
         if self.children is not None:
-            [c.setup(universe) for c in self._childrenv]
+            for c in self._childrenv:
+                c.extend_universe(universe, start)
 
-    @cy.locals(newpt=cy.bint, val=cy.double, ret=cy.double)
+    @cy.locals(newpt=cy.bint, val=cy.double, ret=cy.double, idle=cy.int)
     def update(self, date, data=None, inow=None):
         """
         Update strategy. Updates prices, values, weight, etc.
         """
         # resolve stale state
         self.root.stale = False
+        self._dirty = False
 
         # update helpers on date change
         # also set newpt flag
@@ -500,23 +1576,30 @@ class StrategyBase(Node):
             self._last_fee = 0.0
             newpt = True
 
-        # update now
-        self.now = date
+        # update now - the row of the date is looked up unless known (the
+        # index is new after the universe is extended)
         if inow is None:
-            if self.now == 0:
+            if date == 0:
                 inow = 0
+            elif date == self.now:
+                inow = self.inow
             else:
-                inow = self.data.index.get_loc(date)
+                inow = self._store.index.get_loc(date)
+        self.now = date
+        self.inow = inow
 
         # update children if any and calculate value
         val = self._capital  # default if no children
 
         if self.children is not None:
-            for c in self._childrenv:
+            for c in self._activev:
                 # avoid useless update call
                 if c._issec and not c._needupdate:
                     continue
-                c.update(date, data, inow)
+                # on the same date, strategy children that have not changed
+                # since their last update keep their value
+                if c._issec or newpt or c._dirty or c.now != date:
+                    c.update(date, data, inow)
                 val += c.value
 
         if self.root == self:
@@ -530,7 +1613,7 @@ class StrategyBase(Node):
         # won't change
         if newpt or self._value != val:
             self._value = val
-            self._values.values[inow] = val
+            self._store.value[inow, self._col] = val
 
             bottom = self._last_value + self._net_flows
             if bottom != 0:
@@ -550,13 +1633,16 @@ class StrategyBase(Node):
                                              self._value))
 
             self._price = self._last_price * (1 + ret)
-            self._prices.values[inow] = self._price
+            self._store.price[inow, self._col] = self._price
+            self._paper_follow = False
 
         # update children weights
         if self.children is not None:
-            for c in self._childrenv:
+            idle = 0
+            for c in self._activev:
                 # avoid useless update call
                 if c._issec and not c._needupdate:
+                    idle += 1
                     continue
 
                 if val != 0:
@@ -564,26 +1650,249 @@ class StrategyBase(Node):
                 else:
                     c._weight = 0.0
 
+            # drop the securities that went idle
+            if idle:
+                for c in self._activev:
+                    if c._issec and not c._needupdate:
+                        c._active = False
+                self._activev = [c for c in self._activev if c._active]
+
         # if we have strategy children, we will need to update them in universe
+        # - a single positional write for all of them. The tree is up to date
+        # at this point so the children's prices can be read directly.
         if self._has_strat_children:
-            for c in self._strat_children:
-                # TODO: optimize ".loc" here as well
-                self._universe.loc[date, c] = self.children[c].price
+            prc = [c._price for c in self._strat_childv]
+            self._universe_values[inow, self._strat_cols] = prc
+            if self._has_data is not None:
+                with np.errstate(invalid='ignore'):
+                    self._has_data[inow, self._strat_cols] = \
+                        np.greater(prc, 0)
+            if self._data_counts is not None:
+                self._data_counts[inow + 1, self._strat_cols] = \
+                    self._data_counts[inow, self._strat_cols] + \
+                    ~np.isnan(prc)
 
         # Cash should track the unallocated capital at the end of the day, so
         # we should update it every time we call "update".
         # Same for fees
-        self._cash.values[inow] = self._capital
-        self._fees.values[inow] = self._last_fee
+        self._store.cash[inow, self._col] = self._capital
+        self._store.fees[inow, self._col] = self._last_fee
 
         # update paper trade if necessary
         if newpt and self._paper_trade:
-            self._paper.update(date)
-            self._paper.run()
-            self._paper.update(date)
-            # update price
-            self._price = self._paper.price
-            self._prices.values[inow] = self._price
+            if self._paper is None:
+                self._paper_update(inow)
+                self._price = self._paper_price
+                self._paper_follow = True
+            else:
+                self._paper.update(date, None, inow)
+                self._paper.run()
+                self._paper.update(date, None, inow)
+                # update price
+                self._price = self._paper.price
+            self._store.price[inow, self._col] = self._price
+
+    def use_light_paper_trade(self, light=True):
+        """
+        Set the paper trade mode of the strategy and its strategy children.
+
+        The price of a Strategy that is the child of another Strategy comes
+        from a paper trade - the Strategy is run with a fixed amount of
+        capital, regardless of what its parent allocated to it. By default, a
+        full copy of the Strategy is set up and run next to the real one, so
+        the Strategy is backtested twice.
+
+        The light paper trade reuses the decisions of the real Strategy
+        instead: the target weights handed to the Rebalance algo are applied
+        to a ledger of positions and cash (see paper_rebalance), so the algos
+        only run once. The Strategy's other trades (allocate to a child,
+        rebalance, rebalance_many and close) are mirrored in the ledger, with
+        amounts scaled by the ratio of the ledger's value to the Strategy's.
+        The mirror is exact for algos that size their trades from the
+        Strategy's value, weights and prices - others should use the full
+        paper trade. Calls to flatten are not mirrored: they also come from
+        the parent taking its capital back.
+
+        Must be called before setup.
+
+        Args:
+            * light (bool): Use the light paper trade?
+
+        """
+        self.light_paper_trade = light
+        if self.children is not None:
+            for c in self._childrenv:
+                if isinstance(c, StrategyBase):
+                    c.use_light_paper_trade(light)
+
+    def _setup_paper_ledger(self):
+        """
+        Sets up the light paper trade ledger - a position for each column of
+        the universe and the paper capital.
+        """
+        columns = self._universe.columns
+        self._paper = None
+        self._paper_positions = np.zeros(len(columns))
+        self._paper_cash = self._paper_amount
+        self._paper_value = self._paper_amount
+        self._paper_price = 100.
+
+        # strategy children are allocated capital - no commissions, no
+        # integer positions
+        self._paper_strats = np.zeros(len(columns), dtype=bool)
+        self._paper_mult = np.ones(len(columns))
+        if self.children is not None:
+            for c in self._childrenv:
+                if c.name not in columns:
+                    continue
+                col = columns.get_loc(c.name)
+                if c._issec:
+                    self._paper_mult[col] = c.multiplier
+                else:
+                    self._paper_strats[col] = True
+
+    @cy.locals(val=cy.double)
+    def _paper_update(self, inow):
+        """
+        Marks the paper trade ledger to market and updates its price.
+        """
+        pos = self._paper_positions
+        held = np.flatnonzero(pos)
+        val = self._paper_cash
+        if len(held):
+            val += (pos[held] * self._universe_values[inow, held] *
+                    self._paper_mult[held]).sum()
+
+        if self._paper_value != 0:
+            self._paper_price *= val / self._paper_value
+        self._paper_value = val
+
+    def paper_rebalance(self, weights, cash=0.):
+        """
+        Rebalance the light paper trade ledger (see use_light_paper_trade) to
+        the target weights, the same way the Rebalance algo rebalances the
+        Strategy: positions that are not in the weights are closed and the
+        target weights are applied to the ledger's value once the cash is set
+        aside. The Strategy's price follows the ledger's, unless it was
+        changed since the last update (by an allocation for example).
+
+        Does nothing if the Strategy is not using the light paper trade.
+
+        Args:
+            * weights (dict, Series): Target weights by child name.
+            * cash (float): Proportion of the value to keep in cash.
+
+        """
+        if not self._paper_trade or self._paper is not None:
+            return
+
+        columns = self._universe.columns
+        pos = self._paper_positions
+
+        if isinstance(weights, pd.Series):
+            weights = weights.to_dict()
+        cols = np.array([columns.get_loc(n) for n in weights], dtype=int)
+        w = np.array([weights[n] for n in weights], dtype=float)
+
+        # close the positions that are not in the targets
+        close = np.setdiff1d(np.flatnonzero(pos), cols)
+        if len(close):
+            self._paper_trade_cols(close, -pos[close])
+        self._paper_update(self.inow)
+
+        self._paper_rebalance(cols, w, self._paper_value * (1 - cash))
+
+    def _paper_mirrors(self):
+        """
+        Are the Strategy's trades mirrored in the light paper trade ledger
+        (see use_light_paper_trade)? They are not while the Rebalance algo
+        trades, as it rebalances the ledger itself.
+        """
+        return self._paper_trade and self._paper is None and \
+            not self._paper_synced
+
+    def _paper_scale(self):
+        """
+        Ratio of the paper trade ledger's value to the Strategy's, which
+        scales the amounts of the mirrored trades.
+        """
+        value = self.value
+        if value == 0:
+            return 0.
+        return self._paper_value / value
+
+    def _paper_cols(self, names, x):
+        """
+        Universe columns of the children names and the matching values of x
+        - children that are not in the universe are left out.
+        """
+        columns = self._universe.columns
+        keep = [k for k, n in enumerate(names) if n in columns]
+        cols = np.array([columns.get_loc(names[k]) for k in keep],
+                        dtype=int)
+        return cols, np.asarray(x, dtype=float)[keep]
+
+    def _paper_rebalance(self, cols, w, base):
+        """
+        Rebalances the universe columns cols of the paper trade ledger to the
+        weights w of base (see rebalance_many) - a weight of 0 closes the
+        position.
+        """
+        prc = self._universe_values[self.inow, cols] * self._paper_mult[cols]
+        value = self._paper_positions[cols] * prc
+        if self._paper_value != 0:
+            weight = value / self._paper_value
+        else:
+            weight = np.zeros(len(cols))
+        self._paper_allocate(cols, np.where(w == 0, -value,
+                                            (w - weight) * base))
+
+    def _paper_allocate(self, cols, amount):
+        """
+        Allocates the amounts to the universe columns cols of the paper trade
+        ledger, as allocate does to the children. The Strategy's price
+        follows the ledger's, unless it was changed since the last update (by
+        an allocation for example).
+        """
+        inow = self.inow
+        pos = self._paper_positions
+        prc = self._universe_values[inow, cols] * self._paper_mult[cols]
+        value = pos[cols] * prc
+
+        q = np.zeros(len(cols))
+        strats = self._paper_strats[cols]
+        if strats.any():
+            with np.errstate(divide='ignore', invalid='ignore'):
+                q[strats] = amount[strats] / prc[strats]
+        secs = ~strats
+        if secs.any():
+            q[secs] = _allocation_quantities(
+                amount[secs], pos[cols][secs], value[secs], prc[secs],
+                self.commission_fn, self.integer_positions)
+        q[np.isnan(q)] = 0
+
+        traded = np.flatnonzero(q)
+        if len(traded):
+            self._paper_trade_cols(cols[traded], q[traded])
+        self._paper_update(inow)
+
+        if self._paper_follow:
+            self._price = self._paper_price
+            self._store.price[inow, self._col] = self._price
+
+    def _paper_trade_cols(self, cols, q):
+        """
+        Trades the quantities q of the universe columns cols in the paper
+        trade ledger.
+        """
+        prc = self._universe_values[self.inow, cols] * self._paper_mult[cols]
+        outlay = q * prc
+        secs = ~self._paper_strats[cols]
+        if secs.any():
+            outlay[secs] += _commissions(self.commission_fn, q[secs],
+                                         prc[secs])
+        self._paper_positions[cols] += q
+        self._paper_cash -= outlay.sum()
 
     @cy.locals(amount=cy.double, update=cy.bint, flow=cy.bint, fees=cy.double)
     def adjust(self, amount, update=True, flow=True, fee=0.0):
@@ -605,6 +1914,7 @@ class StrategyBase(Node):
         # adjust capital
         self._capital += amount
         self._last_fee += fee
+        self._mark_dirty()
 
         # if flow - increment net_flows - this will not affect
         # performance. Commissions and other fees are not flows since
@@ -638,13 +1948,18 @@ class StrategyBase(Node):
         """
         # allocate to child
         if child is not None:
+            if self._paper_mirrors():
+                cols, a = self._paper_cols([child],
+                                           [amount * self._paper_scale()])
+                self._paper_allocate(cols, a)
             if child not in self.children:
                 c = SecurityBase(child)
+                # add child to tree - before setup so that it uses the tree's
+                # store
+                self._add_child(c)
                 c.setup(self._universe)
                 # update to bring up to speed
                 c.update(self.now)
-                # add child to tree
-                self._add_child(c)
 
             # allocate to child
             self.children[child].allocate(amount)
@@ -707,13 +2022,19 @@ class StrategyBase(Node):
         if np.isnan(base):
             base = self.value
 
+        if self._paper_mirrors():
+            cols, w = self._paper_cols([child], [weight])
+            self._paper_rebalance(cols, w, base * self._paper_scale())
+
         # else make sure we have child
         if child not in self.children:
             c = SecurityBase(child)
+            # add child to tree - before setup so that it uses the tree's
+            # store
+            self._add_child(c)
             c.setup(self._universe)
             # update child to bring up to speed
             c.update(self.now)
-            self._add_child(c)
 
         # allocate to child
         # figure out weight delta
@@ -721,6 +2042,131 @@ class StrategyBase(Node):
         delta = weight - c.weight
         c.allocate(delta * base)
 
+    @cy.locals(base=cy.double)
+    def rebalance_many(self, weights, base=np.nan, update=True):
+        """
+        Rebalance several children to given weights at once.
+
+        Batch version of rebalance. The weight deltas of all the children are
+        computed upfront from the current weights and the security trades are
+        applied in a single pass: the capital is adjusted once, so the tree
+        only goes stale (and gets updated) once instead of once per child.
+        Since the deltas are computed before any trade, the commissions paid
+        on some trades do not change the weights used for the others - with
+        commissions, the results differ slightly from calls to rebalance.
+        Strategy children and subclasses of SecurityBase are allocated one
+        after the other (see allocate).
+
+        Args:
+            * weights (dict, Series, ndarray): Target weights by child name.
+                An ndarray must be aligned with the universe's columns, NaN
+                weights are skipped. A weight of 0 closes the child.
+            * base (float): See rebalance.
+            * update (bool): Force update?
+
+        """
+        if isinstance(weights, np.ndarray):
+            keep = ~np.isnan(weights)
+            names = list(self._universe.columns[keep])
+            w = weights[keep].astype(float)
+        elif isinstance(weights, pd.Series):
+            names = list(weights.index)
+            w = weights.values.astype(float)
+        else:
+            names = list(weights.keys())
+            w = np.array([weights[n] for n in names], dtype=float)
+
+        # a weight of 0 only matters if we have to close the child
+        keep = [k for k, n in enumerate(names)
+                if w[k] != 0 or n in self.children]
+        if not keep:
+            return
+        names = [names[k] for k in keep]
+        w = w[keep]
+
+        # if no base specified use self's value
+        if np.isnan(base):
+            base = self.value
+
+        if self._paper_mirrors():
+            cols, pw = self._paper_cols(names, w)
+            self._paper_rebalance(cols, pw, base * self._paper_scale())
+
+        for n in names:
+            if n not in self.children:
+                c = SecurityBase(n)
+                # add child to tree - before setup so that it uses the tree's
+                # store
+                self._add_child(c)
+                c.setup(self._universe)
+                # update child to bring up to speed
+                c.update(self.now)
+
+        if self.root.stale:
+            self.root.update(self.root.now, None)
+
+        children = [self.children[n] for n in names]
+        weight = np.array([c._weight for c in children])
+        # plain securities are traded together - subclasses may override
+        # allocate
+        secs = [k for k, c in enumerate(children)
+                if type(c) is SecurityBase]
+
+        if secs:
+            secs_c = [children[k] for k in secs]
+            # bring idle securities up to speed
+            for c in secs_c:
+                if c._needupdate or c.now != self.now:
+                    c.update(self.now)
+
+            position = np.array([c._position for c in secs_c])
+            value = np.array([c._value for c in secs_c])
+            price = np.array([c._price for c in secs_c])
+            prc = price * np.array([c.multiplier for c in secs_c])
+
+            ws = w[secs]
+            amount = np.where(ws == 0, -value, (ws - weight[secs]) * base)
+
+            bad = np.flatnonzero((amount != 0) &
+                                 ((price == 0) | np.isnan(price)))
+            if len(bad):
+                raise Exception(
+                    'Cannot allocate capital to '
+                    '%s because price is %s as of %s'
+                    % (secs_c[bad[0]].name, price[bad[0]], self.now))
+
+            q = _allocation_quantities(amount, position, value, prc,
+                                       self.commission_fn,
+                                       self.integer_positions)
+
+            traded = np.flatnonzero(q != 0)
+            if len(traded):
+                outlay = q[traded] * prc[traded]
+                fee = _commissions(self.commission_fn, q[traded],
+                                   prc[traded])
+                for k, qk, ok in zip(traded, q[traded], outlay):
+                    c = secs_c[k]
+                    c._needupdate = True
+                    self._activate(c)
+                    c._position += qk
+                    c._outlay += ok
+                self._store.trades.extend(
+                    self.inow, [secs_c[k]._col for k in traded], q[traded],
+                    price[traded], fee, outlay)
+
+                self.adjust(-(outlay + fee).sum(), update=update, flow=False,
+                            fee=fee.sum())
+
+        # other children go through the regular allocation
+        batched = set(secs)
+        for k, c in enumerate(children):
+            if k in batched:
+                continue
+            if w[k] == 0:
+                self.close(c.name)
+            else:
+                c.allocate((w[k] - weight[k]) * base)
+
     def close(self, child):
         """
         Close a child position - alias for rebalance(0, child). This will also
@@ -729,6 +2175,10 @@ class StrategyBase(Node):
         Args:
             * child (str): Child, specified by name.
         """
+        if self._paper_mirrors():
+            cols, w = self._paper_cols([child], [0.])
+            self._paper_rebalance(cols, w, 0.)
+
         c = self.children[child]
         # flatten if children not None
         if c.children is not None and len(c.children) != 0:
@@ -758,7 +2208,9 @@ class StrategyBase(Node):
 
         Args:
             fn (fn(quantity, price)): Function used to determine commission
-            amount.
+            amount. Prefer a CommissionModel (ex: LinearCommission) when the
+            fee has one of their forms - allocations are solved in closed
+            form instead of iteratively.
 
         """
         self.commission_fn = fn
@@ -811,6 +2263,7 @@ class SecurityBase(Node):
     _prices_set = cy.declare(cy.bint)
     _needupdate = cy.declare(cy.bint)
     _outlay = cy.declare(cy.double)
+    _sparse = cy.declare(cy.bint)
 
     @cy.locals(multiplier=cy.double)
     def __init__(self, name, multiplier=1):
@@ -826,6 +2279,7 @@ class SecurityBase(Node):
         self._issec = True
         self._needupdate = True
         self._outlay = 0
+        self._sparse = False
 
     @property
     def price(self):
@@ -859,6 +2313,56 @@ class SecurityBase(Node):
             self.root.update(self.root.now, None)
         return self._values.loc[:self.now]
 
+    @property
+    def data(self):
+        """
+        DataFrame of prices, values, positions and outlays. This is a view on
+        the tree's TreeStore (a copy with sparse storage).
+        """
+        if self._sparse:
+            return pd.DataFrame({'price': self._prices, 'value': self._values,
+                                 'position': self._positions,
+                                 'outlay': self._outlays},
+                                columns=['price', 'value', 'position',
+                                         'outlay'])
+        return self._store.frame(self._col,
+                                 ['price', 'value', 'position', 'outlay'])
+
+    @property
+    def _prices(self):
+        if self._sparse:
+            return pd.Series(self._price_values, index=self._store.index,
+                             name='price')
+        return self._store.series('price', self._col, 'price')
+
+    @property
+    def _values(self):
+        if self._sparse:
+            pos = self._store.trades.positions(self._col,
+                                               len(self._store.index))
+            with np.errstate(invalid='ignore'):
+                values = np.where(
+                    pos != 0, pos * self._price_values * self.multiplier, 0.)
+            return pd.Series(values, index=self._store.index, name='value')
+        return self._store.series('value', self._col, 'value')
+
+    @property
+    def _positions(self):
+        if self._sparse:
+            return pd.Series(
+                self._store.trades.positions(self._col,
+                                             len(self._store.index)),
+                index=self._store.index, name='position')
+        return self._store.series('position', self._col, 'position')
+
+    @property
+    def _outlays(self):
+        if self._sparse:
+            return pd.Series(
+                self._store.trades.outlays(self._col, len(self._store.index)),
+                index=self._store.index, name='outlay')
+        return self._store.series('outlay', self._col, 'outlay')
+
     @property
     def position(self):
         """
@@ -901,30 +2405,74 @@ class SecurityBase(Node):
         """
         # if we already have all the prices, we will store them to speed up
         # future updates
-        try:
-            prices = universe[self.name]
-        except KeyError:
-            prices = None
+        self._prices_set = self.name in universe
 
         # setup internal data
-        if prices is not None:
-            self._prices = prices
-            self.data = pd.DataFrame(index=universe.index,
-                                     columns=['value', 'position'],
-                                     data=0.0)
-            self._prices_set = True
+        if self.parent is not self and self.parent._store is not None and \
+                self.parent._store.sparse:
+            # sparse storage - no column in the store
+            self._store = self.parent._store
+            self._col = self._store.add_sparse_node()
+            self._sparse = True
+        else:
+            self._setup_store(universe.index)
+        self._attach_prices(universe)
+
+    def _attach_prices(self, universe):
+        """
+        Reads the Security's prices from the universe. They are kept in the
+        store's price column, and only held apart when the store can not
+        hold them in double precision (sparse storage or a smaller dtype).
+        """
+        if self.name in universe:
+            prices = np.asarray(universe[self.name].values, dtype=float)
         else:
-            self.data = pd.DataFrame(index=universe.index,
-                                     columns=['price', 'value', 'position'])
-            self._prices = self.data['price']
-            self._prices_set = False
+            prices = np.full(len(universe.index), np.nan)
+        # buffer of the prices held apart - see extend_universe
+        self._buffers = {}
 
-        self._values = self.data['value']
-        self._positions = self.data['position']
+        if self._sparse:
+            self._price_values = prices
+            return
 
-        # add _outlay
-        self.data['outlay'] = 0.
-        self._outlays = self.data['outlay']
+        n = len(prices)
+        self._store.price[:n, self._col] = prices
+        if self._store.dtype == np.float64:
+            self._price_values = None
+        else:
+            self._price_values = prices
+
+    @property
+    def _price_array(self):
+        # prices on all the dates of the store, in double precision
+        if self._price_values is None:
+            return self._store.price[:, self._col]
+        return self._price_values
+
+    def extend_universe(self, universe, start=None):
+        """
+        Extends the Security's prices with the new dates of the universe (see
+        StrategyBase.extend_universe).
+        """
+        if start is None:
+            start = len(self._price_array)
+        n = start
+        if self.name in universe:
+            prices = np.asarray(universe[self.name].values[n:], dtype=float)
+        else:
+            prices = np.full(len(universe.index) - n, np.nan)
+
+        if not self._sparse:
+            self._store.price[n:, self._col] = prices
+        if self._price_values is not None:
+            # grown in place, as the store
+            buf = self._buffers.get('prices')
+            if buf is None:
+                buf = _RowBuffer(self._price_values)
+            buf = buf.extend(n + len(prices), n)
+            buf.array[n:] = prices
+            self._buffers['prices'] = buf
+            self._price_values = buf.array
 
     @cy.locals(prc=cy.double)
     def update(self, date, data=None, inow=None):
@@ -942,8 +2490,10 @@ class SecurityBase(Node):
         if inow is None:
             if date == 0:
                 inow = 0
+            elif self.root is not self and date == self.root.now:
+                inow = self.root.inow
             else:
-                inow = self.data.index.get_loc(date)
+                inow = self._store.index.get_loc(date)
 
         # date change - update price
         if date != self.now:
@@ -951,14 +2501,21 @@ class SecurityBase(Node):
             self.now = date
 
             if self._prices_set:
-                self._price = self._prices.values[inow]
+                if self._price_values is None:
+                    self._price = self._store.price[inow, self._col]
+                else:
+                    self._price = self._price_values[inow]
             # traditional data update
             elif data is not None:
                 prc = data[self.name]
                 self._price = prc
-                self._prices.values[inow] = prc
+                if self._price_values is not None:
+                    self._price_values[inow] = prc
+                if not self._sparse:
+                    self._store.price[inow, self._col] = prc
 
-        self._positions.values[inow] = self._position
+        if not self._sparse:
+            self._store.position[inow, self._col] = self._position
         self._last_pos = self._position
 
         if np.isnan(self._price):
@@ -971,19 +2528,22 @@ class SecurityBase(Node):
         else:
             self._value = self._position * self._price * self.multiplier
 
-        self._values.values[inow] = self._value
+        if not self._sparse:
+            self._store.value[inow, self._col] = self._value
 
         if self._weight == 0 and self._position == 0:
             self._needupdate = False
 
         # save outlay to outlays
         if self._outlay != 0:
-            self._outlays.values[inow] = self._outlay
+            # sparse storage - outlays are in the trade ledger
+            if not self._sparse:
+                self._store.outlay[inow, self._col] = self._outlay
             # reset outlay back to 0
             self._outlay = 0
 
     @cy.locals(amount=cy.double, update=cy.bint, q=cy.double, outlay=cy.double,
-               i=cy.int)
+               i=cy.int, solved=cy.double)
     def allocate(self, amount, update=True):
         """
         This allocates capital to the Security. This is the method used to
@@ -1059,7 +2619,18 @@ class SecurityBase(Node):
         # sell additional units to fund this requirement. As such, q must once
         # again decrease.
         #
-        if not q == -self._position:
+        # Commission models with a known structure are solved in closed form
+        # (see CommissionModel). solved is nan if the model cannot solve this
+        # trade, in which case we fall back to the iterative search.
+        solved = np.nan
+        if not q == -self._position and isinstance(
+                self.parent.commission_fn, CommissionModel):
+            solved = self.parent.commission_fn.solve(
+                amount, self._price * self.multiplier, self.integer_positions)
+
+        if not np.isnan(solved):
+            q = solved
+        elif not q == -self._position:
             full_outlay, _, _ = self.outlay(q)
 
             # if full outlay > amount, we must decrease the magnitude of `q`
@@ -1139,6 +2710,7 @@ class SecurityBase(Node):
         # we close the positions, value and pos is 0, but still need to do that
         # last update)
         self._needupdate = True
+        self.parent._activate(self)
 
         # adjust position & value
         self._position += q
@@ -1151,6 +2723,8 @@ class SecurityBase(Node):
 
         # store outlay for future reference
         self._outlay += outlay
+        self._store.trades.append(self.parent.inow, self._col, q, self._price,
+                                  fee, outlay)
 
         # call parent
         self.parent.adjust(-full_outlay, update=update, flow=False, fee=fee)
@@ -1190,6 +2764,319 @@ class SecurityBase(Node):
         pass
 
 
+class CommissionModel(object):
+
+    """
+    Base class for commission models with a known structure.
+
+    A commission model can be used wherever a commission function is
+    expected (see StrategyBase.set_commissions). It is called with a quantity
+    and a price and returns the fee.
+
+    Unlike an arbitrary function, a model describes its fee as a piecewise
+    linear function of abs(quantity) (see segments). This allows
+    SecurityBase.allocate to solve for the quantity whose full outlay
+    (outlay + fee) matches the allocated amount in closed form, instead of
+    searching for it iteratively.
+
+    """
+
+    def __call__(self, q, p):
+        raise NotImplementedError()
+
+    def segments(self, p):
+        """
+        Describes the fee at price p as a piecewise linear function of
+        abs(quantity).
+
+        Args:
+            * p (float, ndarray): price(s)
+
+        Returns:
+            (starts, intercepts, slopes) - ndarrays of shape
+            (nsegments,) + shape(p). Segment k covers abs(quantity) in
+            [starts[k], starts[k + 1]) and its fee is intercepts[k] +
+            slopes[k] * abs(quantity). starts[0] must be 0.
+
+        """
+        raise NotImplementedError()
+
+    def solve(self, amount, p, integer=False):
+        """
+        Solves for the quantity q, of the same sign as amount, such that
+        the full outlay q * p + fee(q, p) equals amount. With integer
+        positions, q is the largest integer whose full outlay does not
+        exceed amount. This is the quantity SecurityBase.allocate searches
+        for.
+
+        q is 0 if the fee alone exceeds what amount can cover and nan if the
+        solution cannot be found in closed form. That is the case if the
+        price is not positive or if the fee grows faster than the proceeds
+        of a sale.
+
+        Args:
+            * amount (float, ndarray): amount(s) to allocate
+            * p (float, ndarray): price(s)
+            * integer (bool): integer positions?
+
+        """
+        if np.ndim(amount) == 0 and np.ndim(p) == 0:
+            return self._solve_scalar(amount, p, integer)
+
+        amount, p = np.broadcast_arrays(np.atleast_1d(amount).astype(float),
+                                        np.atleast_1d(p).astype(float))
+        # segments as (nsegments, len(p)) arrays
+        starts, intercepts, slopes = [
+            np.broadcast_to(np.reshape(x, (len(x), -1)), (len(x), p.size))
+            for x in self.segments(p)]
+        sign = np.sign(amount)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            # full outlay at the start of each segment - it is monotonic in
+            # abs(q) so the solution lies in the last segment whose start
+            # the amount covers
+            start_outlays = sign * starts * p + intercepts + slopes * starts
+            covered = sign * (amount - start_outlays) >= 0
+            k = covered.sum(axis=0) - 1
+
+            cols = np.arange(p.size)
+            kk = np.maximum(k, 0)
+            u = (sign * (amount - intercepts[kk, cols]) /
+                 (p + sign * slopes[kk, cols]))
+
+        q = np.where(k < 0, 0., sign * u)
+        if integer:
+            q = np.floor(q)
+
+        unsolvable = (p <= 0) | ((p + sign * slopes) <= 0).any(axis=0)
+        q[unsolvable] = np.nan
+
+        return q
+
+    @cy.locals(amount=cy.double, p=cy.double, integer=cy.bint, sign=cy.double,
+               q=cy.double)
+    def _solve_scalar(self, amount, p, integer):
+        # same as solve, with python floats - allocate solves one trade at a
+        # time and array overhead would dominate
+        if p <= 0:
+            return np.nan
+
+        sign = 1. if amount > 0 else -1.
+        starts, intercepts, slopes = [np.ravel(x).tolist()
+                                      for x in self.segments(p)]
+
+        q = 0.
+        for start, intercept, slope in zip(starts, intercepts, slopes):
+            if p + sign * slope <= 0:
+                return np.nan
+            # last segment whose start the amount covers
+            if sign * (amount - sign * start * p - intercept
+                       - slope * start) >= 0:
+                q = (amount - intercept) / (p + sign * slope)
+
+        if integer:
+            q = math.floor(q)
+        return q
+
+
+class LinearCommission(CommissionModel):
+
+    """
+    Commission of the form fixed + per_unit * abs(q) + rate * abs(q) * p.
+
+    Args:
+        * fixed (float): fixed fee per trade
+        * per_unit (float): fee per unit traded
+        * rate (float): fee as a fraction of the traded notional
+
+    """
+
+    def __init__(self, fixed=0., per_unit=0., rate=0.):
+        self.fixed = fixed
+        self.per_unit = per_unit
+        self.rate = rate
+
+    def __call__(self, q, p):
+        return self.fixed + (self.per_unit + self.rate * p) * np.abs(q)
+
+    def segments(self, p):
+        return (np.zeros(1), np.full(1, float(self.fixed)),
+                np.array([self.per_unit + self.rate * p]))
+
+
+class MinimumCommission(CommissionModel):
+
+    """
+    Commission of the form max(minimum, per_unit * abs(q) + rate * abs(q) * p).
+    Ex: MinimumCommission(1, per_unit=0.01) is the same as
+    lambda q, p: max(1, abs(q) * 0.01)
+
+    Args:
+        * minimum (float): minimum fee per trade
+        * per_unit (float): fee per unit traded
+        * rate (float): fee as a fraction of the traded notional
+
+    """
+
+    def __init__(self, minimum, per_unit=0., rate=0.):
+        self.minimum = minimum
+        self.per_unit = per_unit
+        self.rate = rate
+
+    def __call__(self, q, p):
+        return np.maximum(self.minimum,
+                          (self.per_unit + self.rate * p) * np.abs(q))
+
+    def segments(self, p):
+        slope = self.per_unit + self.rate * np.asarray(p, dtype=float)
+        with np.errstate(divide='ignore'):
+            kink = self.minimum / slope
+        return (np.array([np.zeros_like(kink), kink]),
+                np.array([np.full_like(kink, self.minimum),
+                          np.zeros_like(kink)]),
+                np.array([np.zeros_like(slope), slope]))
+
+
+class TieredCommission(CommissionModel):
+
+    """
+    Tiered per-unit commission. Each tier's rate applies to the units traded
+    within that tier (marginal tiers).
+
+    Args:
+        * tiers (list): List of (threshold, per_unit) tuples sorted by
+            threshold. The first threshold must be 0. Ex: [(0, 0.005),
+            (500, 0.003)] charges 0.005 per unit for the first 500 units and
+            0.003 for the following ones.
+
+    """
+
+    def __init__(self, tiers):
+        if len(tiers) == 0 or tiers[0][0] != 0:
+            raise ValueError('The first tier must start at 0')
+        self.tiers = tiers
+        self._starts = np.array([t[0] for t in tiers], dtype=float)
+        self._slopes = np.array([t[1] for t in tiers], dtype=float)
+        # fee accumulated at the start of each tier
+        fees = np.r_[0., np.cumsum(np.diff(self._starts) * self._slopes[:-1])]
+        self._intercepts = fees - self._slopes * self._starts
+
+    def __call__(self, q, p):
+        u = np.abs(q)
+        k = np.searchsorted(self._starts, u, side='right') - 1
+        return self._intercepts[k] + self._slopes[k] * u
+
+    def segments(self, p):
+        return self._starts, self._intercepts, self._slopes
+
+
+# the default commission function of strategies (no fees)
+_dflt_comm_fn = getattr(StrategyBase._dflt_comm_fn, '__func__',
+                        StrategyBase._dflt_comm_fn)
+
+
+def _commissions(fn, q, prc):
+    # commission models work on arrays, and the default function charges
+    # nothing - other functions are called for each trade
+    if isinstance(fn, CommissionModel):
+        return np.broadcast_to(fn(q, prc), np.shape(q)).astype(float)
+    if getattr(fn, '__func__', None) is _dflt_comm_fn:
+        return np.zeros(np.shape(q))
+    return np.array([fn(x, y) for x, y in zip(q, prc)], dtype=float)
+
+
+def _fit_quantities(q, amount, prc, fn, integer, solve=True):
+    """
+    Vectorized version of the commission adjustment in SecurityBase.allocate.
+    Shrinks the quantities q until the full outlays (commissions included)
+    respect the amounts. Each quantity goes through the same iterations as it
+    would in allocate.
+    """
+    q = q.copy()
+
+    # commission models are solved in closed form - only the trades they
+    # cannot solve go through the iterations
+    if solve and isinstance(fn, CommissionModel):
+        solved = fn.solve(amount, prc, integer)
+        ok = ~np.isnan(solved)
+        q[ok] = solved[ok]
+        if ok.all():
+            return q
+        q[~ok] = _fit_quantities(q[~ok], amount[~ok], prc[~ok], fn,
+                                 integer, solve=False)
+        return q
+
+    full = q * prc + _commissions(fn, q, prc)
+    last_q = q.copy()
+    last_short = full - amount
+    todo = np.flatnonzero(~np.isclose(full, amount, rtol=0.) & (q != 0))
+    i = 0
+    while len(todo):
+        q[todo] -= (full[todo] - amount[todo]) / prc[todo]
+        if integer:
+            q[todo] = np.floor(q[todo])
+
+        full[todo] = q[todo] * prc[todo] + _commissions(
+            fn, q[todo], prc[todo])
+
+        # with integer positions, stop at the q where buying one more would
+        # exceed the amount
+        if integer:
+            more = (q[todo] + 1) * prc[todo] + _commissions(
+                fn, q[todo] + 1, prc[todo])
+            todo = todo[~((full[todo] < amount[todo]) &
+                          (more > amount[todo]))]
+
+        i = i + 1
+        if i > 1e4:
+            raise Exception(
+                'Potentially infinite loop detected while trying to reduce '
+                'the amount of shares purchased to respect the outlay <= '
+                'amount rule.')
+
+        if integer and (last_q[todo] == q[todo]).any():
+            raise Exception(
+                'Newton Method like root search for quantity is stuck!')
+        last_q[todo] = q[todo]
+
+        if (np.abs(full[todo] - amount[todo]) >
+                np.abs(last_short[todo])).any():
+            raise Exception(
+                'The difference between what we have raised with q and the '
+                'amount we are trying to raise has gotten bigger since last '
+                'iteration! There may be a case where the commission fn is '
+                'not smooth')
+        last_short[todo] = full[todo] - amount[todo]
+
+        todo = todo[~np.isclose(full[todo], amount[todo], rtol=0.) &
+                    (q[todo] != 0)]
+
+    return q
+
+
+def _allocation_quantities(amount, position, value, prc, fn, integer):
+    """
+    Vectorized version of the quantity logic in SecurityBase.allocate.
+    Returns the quantities bought (sold if negative) for the amounts.
+    prc is the price times the multiplier.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        q = amount / prc
+    if integer:
+        # floor when going long or changing a long position, ceil otherwise
+        going_long = (position > 0) | ((position == 0) & (amount > 0))
+        q = np.where(going_long, np.floor(q), np.ceil(q))
+
+    # closing out
+    q = np.where(amount == -value, -position, q)
+    q[(amount == 0) | np.isnan(q)] = 0
+
+    fit = (q != 0) & (q != -position)
+    if fit.any():
+        q[fit] = _fit_quantities(q[fit], amount[fit], prc[fit], fn, integer)
+    return q
+
+
 class Algo(object):
 
     """
@@ -1225,6 +3112,40 @@ class Algo(object):
     def __call__(self, target):
         raise NotImplementedError("%s not implemented!" % self.name)
 
+    def next_run(self, target):
+        """
+        Position, in target's data index, of the first date after the current
+        one on which the Algo may return True - the length of the index if
+        there is none. Used by the fast_forward engine (see Backtest) to skip
+        the dates on which a stack can not run.
+
+        Algos that implement it must not have side effects when called on the
+        dates they rule out. Returns None (the default) if the date is
+        unknown.
+        """
+        return None
+
+    def clone(self, memo=None):
+        """
+        Returns a copy of the Algo for use in another Strategy. Pandas
+        objects and arrays (signals, target weights, etc.) are shared with
+        the original, other attributes - including any run state - are deep
+        copied. Nested algos are cloned. Algos must therefore replace the
+        arrays they compute as they run (caches, masks, etc.) rather than
+        modify them in place.
+
+        Args:
+            * memo (dict): deepcopy memo, used to clone trees.
+
+        """
+        if memo is None:
+            memo = {}
+        c = copy(self)
+        memo[id(self)] = c
+        c.__dict__.update(
+            (k, _clone(v, memo)) for k, v in list(self.__dict__.items()))
+        return c
+
 
 class AlgoStack(Algo):
 
@@ -1267,6 +3188,19 @@ class AlgoStack(Algo):
                         algo(target)
             return res
 
+    def next_run(self, target):
+        """
+        The stack can only run once its first Algo does (see Algo.next_run).
+        Algos that always run rule this out, and so do plain functions used
+        as algos.
+        """
+        if self.check_run_always or not self.algos:
+            return None
+        next_run = getattr(self.algos[0], 'next_run', None)
+        if next_run is None:
+            return None
+        return next_run(target)
+
 
 class Strategy(StrategyBase):
 
@@ -1309,6 +3243,6 @@ class Strategy(StrategyBase):
         # run algo stack
         self.stack(self)
 
-        # run children
-        for c in self._childrenv:
+        # run children - idle securities have nothing to do
+        for c in self._activev:
             c.run()
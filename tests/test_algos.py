@@ -356,6 +356,61 @@ def test_run_yearly():
     assert not algo(target)
 
 
+def test_run_period_trigger_mask():
+    np.random.seed(0)
+    # irregular dates across year, quarter, month and week boundaries
+    dts = pd.DatetimeIndex(sorted(set(
+        pd.Timestamp('2015-12-20') +
+        pd.to_timedelta(np.random.randint(0, 800, 300), unit='D'))))
+    data = pd.DataFrame(index=dts, columns=['c1', 'c2'], data=100)
+    index = bt.Backtest(bt.Strategy('', []), data).data.index
+
+    for cls in [algos.RunDaily, algos.RunWeekly, algos.RunMonthly,
+                algos.RunQuarterly, algos.RunYearly]:
+        for end in [False, True]:
+            algo = cls(run_on_first_date=not end, run_on_end_of_period=end,
+                       run_on_last_date=end)
+            mask = algo.trigger_mask(index)
+            # computed once per index
+            assert algo.trigger_mask(index) is mask
+
+            offset = 1 if end else -1
+            for i in range(2, len(index) - 1):
+                assert mask[i] == algo.compare_dates(index[i],
+                                                     index[i + offset])
+            assert not mask[0]
+            assert mask[1] == (not end)
+            assert mask[-1] == end
+
+    # no period codes - dates are compared on each call
+    assert algos.RunPeriod().trigger_mask(index) is None
+
+
+def test_next_run():
+    dts = pd.date_range('2010-01-01', periods=40)
+    data = pd.DataFrame(index=dts, columns=['c1', 'c2'], data=100)
+    s = bt.Strategy('s', [])
+    s.setup(bt.Backtest(s, data).data)
+    s.inow = 3
+
+    # positions are in the index with the initial day
+    assert algos.RunMonthly().next_run(s) == 32
+    assert algos.RunOnDate(dts[10], dts[2]).next_run(s) == 11
+    assert algos.RunAfterDate(dts[20]).next_run(s) == 22
+    assert algos.RunAfterDate(dts[0]).next_run(s) == 4
+    weights = pd.DataFrame(0.5, index=dts[[1, 30]], columns=['c1', 'c2'])
+    assert algos.WeighTarget(weights).next_run(s) == 31
+
+    # never again
+    assert algos.RunOnDate(dts[1]).next_run(s) == 41
+    # unknown
+    assert algos.SelectAll().next_run(s) is None
+    assert bt.AlgoStack(algos.RunMonthly(), algos.SelectAll()).next_run(s) \
+        == 32
+    assert bt.AlgoStack(algos.SelectAll(), algos.RunMonthly()).next_run(s) \
+        is None
+
+
 def test_run_on_date():
     target = mock.MagicMock()
     target.now = pd.to_datetime('2010-01-01')
@@ -609,6 +664,14 @@ def test_select_has_data_preselected():
     selected = s.temp['selected']
     assert len(selected) == 0
 
+    # unknown tickers are not silently mapped to another column
+    s.temp['selected'] = ['c3']
+    try:
+        algo(s)
+        assert False
+    except KeyError:
+        pass
+
 
 @mock.patch('bt.ffn.calc_erc_weights')
 def test_weigh_erc(mock_erc):
@@ -718,6 +781,14 @@ def test_stat_total_return():
     assert stat['c1'] == 105.0 / 100 - 1
     assert stat['c2'] == 95.0 / 100 - 1
 
+    # unknown tickers are not silently mapped to another column
+    s.temp['selected'] = ['c1', 'c3']
+    try:
+        algo(s)
+        assert False
+    except KeyError:
+        pass
+
 
 def test_select_n():
     algo = algos.SelectN(n=1, sort_descending=True)
@@ -867,6 +938,46 @@ def test_limit_deltas():
     assert w['c2'] == -0.6
 
 
+def test_rebalance_batch():
+    dts = pd.date_range('2010-01-01', periods=3)
+    data = pd.DataFrame(index=dts, columns=['c1', 'c2', 'c3'], data=100.)
+    data['c1'][dts[1]] = 105
+    data['c2'][dts[1]] = 95
+    targets = [{'c1': 0.5, 'c2': 0.5}, {'c1': 0.2, 'c2': 0.3, 'c3': 0.5}]
+
+    def run(rebalance):
+        s = bt.Strategy('s')
+        s.set_commissions(lambda q, p: max(1, abs(q) * 0.01))
+        s.use_integer_positions(False)
+        s.setup(data)
+        s.adjust(10000)
+        for dt, weights in zip(dts, targets):
+            s.update(dt)
+            rebalance(s, weights)
+        return (s.value, s.capital,
+                [s[c].position for c in ['c1', 'c2', 'c3']])
+
+    def algo(batch):
+        def rebalance(s, weights):
+            s.temp['weights'] = weights
+            assert algos.Rebalance(batch=batch)(s)
+        return rebalance
+
+    def sequential(s, weights):
+        base = s.value
+        for c in sorted(weights):
+            s.rebalance(weights[c], c, base=base)
+
+    def batched(s, weights):
+        s.rebalance_many(weights, base=s.value)
+
+    # by default the children are rebalanced one after the other, so the
+    # commissions paid change the weights used for the next ones
+    assert run(algo(False)) == run(sequential)
+    assert run(algo(True)) == run(batched)
+    assert run(algo(False)) != run(algo(True))
+
+
 def test_rebalance_over_time():
     target = mock.MagicMock()
     rb = mock.MagicMock()
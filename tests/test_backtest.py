@@ -2,7 +2,12 @@ from __future__ import division
 import bt
 import pandas as pd
 import numpy as np
+import gc
+import os
+import pickle
+import shutil
 import sys
+import tempfile
 if sys.version_info < (3, 3):
     import mock
 else:
@@ -189,3 +194,723 @@ def test_30_min_data():
     wait=1
 
 
+def test_weights_nested_strategies():
+    dts = pd.date_range('2010-01-01', periods=5)
+    data = pd.DataFrame(index=dts, columns=['a', 'b', 'c'], data=100.)
+    data['a'][dts[2]] = 110
+    data['c'][dts[3]] = 90
+
+    s1 = bt.Strategy('s1', [bt.algos.SelectAll(),
+                            bt.algos.WeighEqually(),
+                            bt.algos.Rebalance()], ['a', 'b'])
+    s2 = bt.Strategy('s2', [bt.algos.SelectAll(),
+                            bt.algos.WeighEqually(),
+                            bt.algos.Rebalance()], ['b', 'c'])
+    m = bt.Strategy('m', [bt.algos.SelectAll(),
+                          bt.algos.WeighEqually(),
+                          bt.algos.Rebalance()], [s1, s2])
+
+    t = bt.Backtest(m, data, integer_positions=False, progress_bar=False)
+    bt.run(t)
+
+    s = t.strategy
+    w = t.weights
+    assert list(w.columns) == [x.full_name for x in s.members]
+    for x in s.members:
+        assert np.allclose(w[x.full_name], x.values / s.values)
+
+    sw = t.security_weights
+    assert list(sw.columns) == ['a', 'b', 'c']
+    b = s['s1']['b'].values + s['s2']['b'].values
+    assert np.allclose(sw['b'], b / s.values)
+    assert np.allclose(sw.sum(axis=1)[1:], 1.)
+
+
+def _engine_pair(strategy, data, **kwargs):
+    res = []
+    for engine in ['loop', 'vectorized']:
+        t = bt.Backtest(strategy, data, progress_bar=False, engine=engine,
+                        **kwargs)
+        t.run()
+        res.append(t)
+    return res
+
+
+def test_vectorized_engine_matches_loop():
+    np.random.seed(1)
+    dts = pd.date_range('2010-01-01', periods=300, freq='B')
+    data = pd.DataFrame(
+        100 * np.exp(np.cumsum(np.random.randn(300, 6) * 0.01, axis=0)),
+        index=dts, columns=['a', 'b', 'c', 'd', 'e', 'f'])
+    data['c'][:40] = np.nan
+
+    weights = pd.DataFrame(np.random.rand(300, 3), index=dts,
+                           columns=['f', 'a', 'b'])[::10]
+    weights['b'][3] = 0.
+    weights['a'][4] = -0.2
+
+    stacks = [[bt.algos.RunMonthly(), bt.algos.SelectAll(),
+               bt.algos.WeighEqually(), bt.algos.Rebalance()],
+              [bt.algos.WeighTarget(weights), bt.algos.Rebalance()]]
+
+    for algos in stacks:
+        for integer_positions in [True, False]:
+            s = bt.Strategy('s', algos)
+            loop, vec = _engine_pair(s, data,
+                                     integer_positions=integer_positions)
+
+            assert np.allclose(loop.strategy.prices, vec.strategy.prices,
+                               rtol=1e-12)
+            assert np.allclose(loop.strategy.cash, vec.strategy.cash,
+                               rtol=1e-12)
+            assert list(loop.weights.columns) == list(vec.weights.columns)
+            assert np.allclose(loop.weights, vec.weights, equal_nan=True)
+            assert np.allclose(loop.positions, vec.positions, equal_nan=True)
+            assert np.allclose(loop.strategy.outlays, vec.strategy.outlays,
+                               equal_nan=True)
+            for a, b in zip(loop.strategy.members, vec.strategy.members):
+                assert a.now == b.now
+                assert np.isclose(a.value, b.value)
+                assert np.isclose(a.weight, b.weight)
+
+
+def test_vectorized_engine_commissions():
+    np.random.seed(2)
+    dts = pd.date_range('2010-01-01', periods=200, freq='B')
+    data = pd.DataFrame(
+        100 * np.exp(np.cumsum(np.random.randn(200, 4) * 0.01, axis=0)),
+        index=dts, columns=['a', 'b', 'c', 'd'])
+
+    s = bt.Strategy('s', [bt.algos.RunWeekly(), bt.algos.SelectAll(),
+                          bt.algos.WeighEqually(), bt.algos.Rebalance()])
+    loop, vec = _engine_pair(s, data,
+                             commissions=lambda q, p: abs(q) * p * 0.001)
+
+    assert vec.strategy.fees.sum() > 0
+    assert np.allclose(loop.strategy.prices, vec.strategy.prices, rtol=1e-4)
+    assert np.allclose(loop.strategy.fees.sum(), vec.strategy.fees.sum(),
+                       rtol=1e-3)
+    assert np.allclose(loop.positions, vec.positions, atol=1)
+
+
+def test_get_transactions():
+    np.random.seed(3)
+    dts = pd.date_range('2010-01-01', periods=100, freq='B')
+    data = pd.DataFrame(
+        100 * np.exp(np.cumsum(np.random.randn(100, 3) * 0.01, axis=0)),
+        index=dts, columns=['a', 'b', 'c'])
+
+    def comm(q, p):
+        return abs(q) * 0.01 + 1
+
+    s = bt.Strategy('s', [bt.algos.RunMonthly(), bt.algos.SelectAll(),
+                          bt.algos.WeighEqually(), bt.algos.Rebalance()])
+    loop, vec = _engine_pair(s, data, commissions=comm)
+
+    res = bt.backtest.Result(loop)
+    tx = res.get_transactions()
+    assert list(tx.columns) == ['price', 'quantity', 'fee']
+    assert tx.index.names == ['Date', 'Security']
+
+    # matches the trades implied by the positions
+    positions = loop.positions
+    trades = positions.diff()
+    trades.iloc[0] = positions.iloc[0]
+    trades = trades.stack()
+    trades = trades[trades != 0]
+    assert np.allclose(tx['quantity'], trades.loc[tx.index])
+    assert len(tx) == len(trades)
+
+    for (dt, name), row in tx.iterrows():
+        assert row['price'] == loop.strategy[name].prices[dt]
+        assert row['fee'] == comm(row['quantity'], row['price'])
+    assert np.isclose(tx['fee'].sum(), loop.strategy.fees.sum())
+
+    # the vectorized engine records the same trades
+    assert tx.equals(bt.backtest.Result(vec).get_transactions())
+
+
+def test_sparse_storage():
+    np.random.seed(4)
+    dts = pd.date_range('2010-01-01', periods=120, freq='B')
+    names = ['c%d' % i for i in range(20)]
+    data = pd.DataFrame(
+        100 * np.exp(np.cumsum(np.random.randn(120, 20) * 0.01, axis=0)),
+        index=dts, columns=names)
+
+    def strategy():
+        return bt.Strategy('s', [bt.algos.RunWeekly(),
+                                 bt.algos.SelectRandomly(3),
+                                 bt.algos.WeighEqually(),
+                                 bt.algos.Rebalance()])
+
+    def backtests(sparse):
+        return [bt.Backtest(strategy(), data, progress_bar=False,
+                            commissions=bt.core.LinearCommission(fixed=1.),
+                            seed=1,
+                            sparse=sparse, engine=engine,
+                            name='%s_%s' % (sparse, engine))
+                for engine in ['loop', 'vectorized']]
+
+    dense = backtests(False)
+    sparse = backtests(True)
+    res = bt.run(*(dense + sparse))
+    dense, sparse = dense[0], sparse[0]
+
+    # securities have no columns in the store
+    assert sparse.strategy._store.ncols == 1
+    assert dense.strategy._store.ncols > 1
+
+    assert sparse.strategy.prices.equals(dense.strategy.prices)
+    assert sparse.weights.equals(dense.weights)
+    assert sparse.security_weights.equals(dense.security_weights)
+    assert sparse.positions.equals(dense.positions)
+    for x in dense.strategy.securities:
+        y = sparse.strategy[x.name]
+        assert y.values.equals(x.values)
+        assert y.prices.equals(x.prices)
+    assert res.get_transactions(dense.name).equals(
+        res.get_transactions(sparse.name))
+
+    # sparse accessors
+    positions = sparse.strategy.get_positions(sparse=True)
+    assert positions.index.names == ['Date', 'Security']
+    changes = dense.positions.diff()
+    changes.iloc[0] = dense.positions.iloc[0]
+    changes = changes.stack()
+    changes = changes[changes != 0]
+    assert len(positions) == len(changes)
+    assert positions.equals(
+        dense.positions.stack().loc[positions.index].rename('quantity'))
+
+    outlays = sparse.strategy.get_outlays(sparse=True)
+    assert (outlays != 0).all()
+    assert np.isclose(outlays.sum(),
+                      res.get_transactions(sparse.name).eval(
+                          'price * quantity').sum())
+    assert sparse.strategy.get_positions().equals(sparse.positions)
+
+    # vectorized engine and process workers
+    for name in ['True_vectorized']:
+        b = res.backtests[name]
+        assert b.strategy._store.ncols == 1
+        assert np.allclose(b.strategy.prices, dense.strategy.prices)
+
+    par = bt.run(*backtests(True), n_jobs=2)
+    b = par.backtests['True_loop']
+    assert b.strategy.prices.equals(dense.strategy.prices)
+    assert b.positions.fillna(0).equals(dense.positions.fillna(0))
+    assert b.security_weights.equals(dense.security_weights)
+
+
+def test_store_dtype():
+    np.random.seed(5)
+    dts = pd.date_range('2010-01-01', periods=500, freq='B')
+    data = pd.DataFrame(
+        100 * np.exp(np.cumsum(np.random.randn(500, 5) * 0.01, axis=0)),
+        index=dts, columns=['a', 'b', 'c', 'd', 'e'])
+
+    def backtests(dtype):
+        s = bt.Strategy('s', [bt.algos.RunMonthly(), bt.algos.SelectAll(),
+                              bt.algos.WeighInvVol(), bt.algos.Rebalance()])
+        return [bt.Backtest(s, data, progress_bar=False, dtype=dtype,
+                            commissions=bt.core.LinearCommission(1., 0.01),
+                            name='%s_%s' % (np.dtype(dtype).name, engine),
+                            engine=engine)
+                for engine in ['loop', 'vectorized']]
+
+    exact = backtests(np.float64)[0]
+    exact.run()
+    # double precision prices are only kept in the store
+    for c in exact.strategy.securities:
+        assert c._price_values is None
+        assert np.array_equal(c.prices.values[1:], data[c.name].values)
+
+    local = bt.run(*backtests(np.float32))
+    workers = bt.run(*backtests(np.float32), n_jobs=2)
+    for t in list(local.backtest_list) + list(workers.backtest_list):
+        store = t.strategy._store
+        assert store.block.dtype == np.float32
+        assert store.block.itemsize * 2 == \
+            exact.strategy._store.block.itemsize
+        assert t.strategy.prices.dtype == np.float32
+        for c in t.strategy.securities:
+            assert c._price_values.dtype == np.float64
+
+        # the running values are kept in double precision - the drift is
+        # bounded by the float32 rounding of the stored values
+        assert np.allclose(t.strategy.prices, exact.strategy.prices,
+                           rtol=1e-6, atol=0)
+        assert np.allclose(t.strategy.values, exact.strategy.values,
+                           rtol=1e-6, atol=0)
+        assert np.allclose(t.security_weights, exact.security_weights,
+                           rtol=0, atol=1e-6)
+        assert np.allclose(t.positions, exact.positions, rtol=1e-6)
+        assert np.isclose(t.strategy.value, exact.strategy.value,
+                          rtol=1e-12)
+
+
+def test_memmap_store():
+    np.random.seed(6)
+    dts = pd.date_range('2010-01-01', periods=100, freq='B')
+    data = pd.DataFrame(
+        100 * np.exp(np.cumsum(np.random.randn(100, 8) * 0.01, axis=0)),
+        index=dts, columns=['c%d' % i for i in range(8)])
+
+    def backtest(name, **kwargs):
+        s = bt.Strategy('s', [bt.algos.RunWeekly(), bt.algos.SelectAll(),
+                              bt.algos.WeighEqually(), bt.algos.Rebalance()])
+        return bt.Backtest(s, data, progress_bar=False, name=name, **kwargs)
+
+    directory = tempfile.mkdtemp()
+    try:
+        expected = backtest('memory')
+        expected.run()
+
+        t = backtest('mapped', memmap_dir=directory)
+        t.run()
+        store = t.strategy._store
+        assert isinstance(store.block, np.memmap)
+        # the store grew as securities were added - only the last file is
+        # left
+        assert store.ncols == 9
+        assert os.listdir(directory) == [os.path.basename(store.path)]
+
+        assert t.strategy.prices.equals(expected.strategy.prices)
+        assert t.positions.equals(expected.positions)
+        assert t.security_weights.equals(expected.security_weights)
+
+        # copies map the same file and do not own it
+        copy = pickle.loads(pickle.dumps(store))
+        assert copy.path == store.path
+        assert np.allclose(copy.block, store.block, rtol=0, atol=0,
+                           equal_nan=True)
+        copy.close()
+        assert os.path.exists(store.path)
+
+        # process workers hand the file over
+        res = bt.run(backtest('worker', memmap_dir=directory), n_jobs=2)
+        w = res.backtests['worker']
+        assert w.strategy._store.path != store.path
+        assert len(os.listdir(directory)) == 2
+        assert w.strategy.prices.equals(expected.strategy.prices)
+        assert w.positions.equals(expected.positions)
+
+        t.close()
+        w.close()
+        assert os.listdir(directory) == []
+
+        # the file of a store that goes away without being closed is deleted
+        store = bt.core.TreeStore(dts, directory=directory)
+        for _ in range(5):
+            store.add_column()
+        assert len(os.listdir(directory)) == 1
+        del store
+        gc.collect()
+        assert os.listdir(directory) == []
+        # in memory - nothing to do
+        expected.close()
+        assert len(expected.strategy.prices) == len(dts) + 1
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_step_append_data():
+    np.random.seed(7)
+    dts = pd.date_range('2010-01-01', periods=120, freq='B')
+    data = pd.DataFrame(
+        100 * np.exp(np.cumsum(np.random.randn(120, 4) * 0.01, axis=0)),
+        index=dts, columns=['a', 'b', 'c', 'd'])
+
+    s1 = bt.Strategy('s1', [bt.algos.SelectAll(), bt.algos.WeighInvVol(),
+                            bt.algos.Rebalance()], ['a', 'b'])
+    s = bt.Strategy('s', [bt.algos.RunWeekly(), bt.algos.SelectAll(),
+                          bt.algos.WeighEqually(), bt.algos.Rebalance()],
+                    [s1, 'c', 'd'])
+
+    expected = bt.Backtest(s, data, progress_bar=False, name='full')
+    expected.run()
+
+    t = bt.Backtest(s, data[:50], progress_bar=False, name='live')
+    t.run_until(dts[20])
+    assert t.strategy.now == dts[20]
+    assert not t.has_run
+    assert t.stats.prices.index[-1] == dts[20]
+    assert t.step() == dts[21]
+
+    t.run()
+    assert t.has_run
+    assert t.step() is None
+
+    # new dates are processed one at a time (chunks end on thursdays, so
+    # RunWeekly never skips a new week as the last date of the data)
+    for i in range(50, 120, 5):
+        t.append_data(data[i:i + 5])
+        assert not t.has_run
+        while t.step() is not None:
+            pass
+
+    assert t.has_run
+    assert t.strategy._store.block.shape[1] == 121
+    assert np.allclose(t.strategy.prices, expected.strategy.prices)
+    assert np.allclose(t.security_weights, expected.security_weights)
+    assert np.allclose(t.strategy['s1'].prices,
+                       expected.strategy['s1'].prices)
+    assert np.isclose(t.stats.stats['total_return'],
+                      expected.stats.stats['total_return'])
+
+    try:
+        t.append_data(data[:5])
+        assert False
+    except ValueError:
+        pass
+
+
+def test_append_data_in_place():
+    np.random.seed(9)
+    dts = pd.date_range('2010-01-01', periods=100, freq='B')
+    data = pd.DataFrame(
+        100 * np.exp(np.cumsum(np.random.randn(100, 4) * 0.01, axis=0)),
+        index=dts, columns=['a', 'b', 'c', 'd'])
+
+    def strategy():
+        s1 = bt.Strategy('s1', [bt.algos.SelectHasData(
+                                    lookback=pd.DateOffset(days=5)),
+                                bt.algos.WeighEqually(),
+                                bt.algos.Rebalance()], ['a', 'b'])
+        return bt.Strategy('s', [bt.algos.SelectAll(),
+                                 bt.algos.WeighEqually(),
+                                 bt.algos.Rebalance()], [s1, 'c', 'd'])
+
+    expected = bt.Backtest(strategy(), data, progress_bar=False,
+                           dtype=np.float32)
+    expected.run()
+
+    t = bt.Backtest(strategy(), data[:20], progress_bar=False,
+                    dtype=np.float32)
+    t.run()
+    buffers = set()
+    for i in range(20, 100):
+        t.append_data(data[i:i + 1])
+        t.run()
+        buffers.add(id(t._data_buffers[0]._buf))
+
+    # the data grows in place - its capacity doubles when it runs out
+    assert len(buffers) == 3
+    assert np.shares_memory(t.data.values, t._data_buffers[0]._buf)
+    s1 = t.strategy['s1']
+    assert np.shares_memory(s1._universe_values,
+                            s1._buffers['universe']._buf)
+    assert t.strategy['c']._price_values.dtype == np.float64
+    assert np.shares_memory(t.strategy['c']._price_values,
+                            t.strategy['c']._buffers['prices']._buf)
+
+    assert t.dates.equals(expected.dates)
+    assert np.allclose(t.strategy.prices, expected.strategy.prices)
+    assert np.allclose(s1.prices, expected.strategy['s1'].prices)
+    assert np.allclose(t.security_weights, expected.security_weights)
+
+
+def test_checkpoint_resume():
+    np.random.seed(8)
+    dts = pd.date_range('2010-01-01', periods=100, freq='B')
+    data = pd.DataFrame(
+        100 * np.exp(np.cumsum(np.random.randn(100, 5) * 0.01, axis=0)),
+        index=dts, columns=['a', 'b', 'c', 'd', 'e'])
+
+    s1 = bt.Strategy('s1', [bt.algos.RunEveryNPeriods(3),
+                            bt.algos.SelectRandomly(2),
+                            bt.algos.WeighRandomly(),
+                            bt.algos.Rebalance()], ['a', 'b', 'c'])
+    s = bt.Strategy('s', [bt.algos.RunWeekly(), bt.algos.SelectAll(),
+                          bt.algos.WeighEqually(),
+                          bt.algos.RebalanceOverTime(n=3)],
+                    [s1, 'd', 'e'])
+
+    def backtest(name):
+        return bt.Backtest(s, data, progress_bar=False, name=name, seed=3,
+                           commissions=bt.core.LinearCommission(1.))
+
+    expected = backtest('full')
+    state = np.random.get_state()
+    expected.run()
+    # the backtest has its own generators
+    assert (np.random.get_state()[1] == state[1]).all()
+
+    # drawing numbers between the steps does not alter the results
+    t = backtest('steps')
+    while t.step() is not None:
+        np.random.rand()
+    assert t.strategy.prices.equals(expected.strategy.prices)
+
+    t = backtest('part')
+    t.run_until(dts[50])
+    snapshot = pickle.loads(pickle.dumps(t.checkpoint()))
+    # the snapshot does not hold the data
+    assert snapshot['dates'][-1] == dts[50]
+    t.run()
+
+    # scenarios forked from the same snapshot are independent
+    for _ in range(2):
+        r = bt.Backtest.resume(snapshot, data)
+        assert r.strategy.now == dts[50]
+        assert not r.has_run
+        r.run()
+        assert r.name == 'part'
+        assert np.allclose(r.strategy.prices, expected.strategy.prices)
+        assert np.allclose(r.strategy['s1'].prices,
+                           expected.strategy['s1'].prices)
+        assert np.allclose(r.security_weights, expected.security_weights)
+        assert np.allclose(r.positions.fillna(0),
+                           expected.positions.fillna(0))
+
+    # the data must start like the data of the snapshot
+    try:
+        bt.Backtest.resume(snapshot, data[10:])
+        assert False
+    except ValueError:
+        pass
+
+    try:
+        backtest('new').checkpoint()
+        assert False
+    except ValueError:
+        pass
+
+
+def test_fast_forward_engine():
+    np.random.seed(9)
+    dts = pd.date_range('2010-01-01', periods=250, freq='B')
+    data = pd.DataFrame(
+        100 * np.exp(np.cumsum(np.random.randn(250, 5) * 0.01, axis=0)),
+        index=dts, columns=['a', 'b', 'c', 'd', 'e'])
+    data['e'][:60] = np.nan
+    weights = pd.DataFrame(0.2, index=dts[::20], columns=data.columns)
+    weights['e'][:3] = np.nan
+
+    stacks = [[bt.algos.RunMonthly(), bt.algos.SelectHasData(),
+               bt.algos.WeighInvVol(), bt.algos.Rebalance()],
+              [bt.algos.RunOnDate(dts[3], dts[100]), bt.algos.SelectAll(),
+               bt.algos.WeighEqually(), bt.algos.Rebalance()],
+              [bt.algos.WeighTarget(weights), bt.algos.Rebalance()],
+              # leveraged until bankrupt
+              [bt.algos.RunWeekly(), bt.algos.SelectThese(['a']),
+               bt.algos.WeighSpecified(a=40.), bt.algos.Rebalance()]]
+
+    for algos in stacks:
+        s = bt.Strategy('s', algos)
+        loop, fast = [bt.Backtest(s, data, progress_bar=False, engine=e,
+                                  commissions=bt.core.LinearCommission(.01))
+                      for e in ['loop', 'fast_forward']]
+        loop.run()
+        with mock.patch.object(fast.strategy, 'run',
+                               wraps=fast.strategy.run) as run:
+            fast.run()
+        # the stack only runs on the dates it may trigger
+        assert run.call_count < len(dts)
+
+        # same history and state as the loop
+        for field in ['price', 'value', 'cash', 'fees']:
+            assert np.array_equal(
+                np.nan_to_num(getattr(loop.strategy._store, field)),
+                np.nan_to_num(getattr(fast.strategy._store, field)))
+        assert fast.strategy.bankrupt == loop.strategy.bankrupt
+        assert fast.strategy.price == loop.strategy.price
+        assert fast.strategy._last_value == loop.strategy._last_value
+        for c in loop.strategy.children.values():
+            f = fast.strategy.children[c.name]
+            assert (f.now, f.value, f.weight, f._needupdate) == \
+                (c.now, c.value, c.weight, c._needupdate)
+
+    # stacks that may run on any date are run by the loop
+    s = bt.Strategy('s', [bt.algos.SelectAll(), bt.algos.WeighEqually(),
+                          bt.algos.Rebalance()])
+    t = bt.Backtest(s, data, progress_bar=False, engine='fast_forward')
+    with mock.patch.object(t.strategy, 'run', wraps=t.strategy.run) as run:
+        t.run()
+    assert run.call_count == len(dts)
+
+    # so do stacks that start with a plain function
+    def select_ab(target):
+        target.temp['selected'] = ['a', 'b']
+        return True
+
+    s = bt.Strategy('s', [select_ab, bt.algos.WeighEqually(),
+                          bt.algos.Rebalance()])
+    t = bt.Backtest(s, data, progress_bar=False, engine='fast_forward')
+    with mock.patch.object(t.strategy, 'run', wraps=t.strategy.run) as run:
+        t.run()
+    assert run.call_count == len(dts)
+
+
+def test_vectorized_engine_fallback():
+    dts = pd.date_range('2010-01-01', periods=5)
+    data = pd.DataFrame(index=dts, columns=['a', 'b'], data=100.)
+
+    s = bt.Strategy('s', [bt.algos.SelectAll(), bt.algos.WeighInvVol(),
+                          bt.algos.Rebalance()])
+    t = bt.Backtest(s, data, engine='vectorized', progress_bar=False)
+
+    with mock.patch.object(t.strategy, 'run',
+                           wraps=t.strategy.run) as run:
+        t.run()
+    # unsupported stacks are run by the loop
+    assert run.call_count == 5
+
+    try:
+        bt.Backtest(s, data, engine='other')
+        assert False
+    except ValueError:
+        pass
+
+
+def test_run_parallel():
+    np.random.seed(0)
+    names = ['c%s' % i for i in range(6)]
+    data = pd.DataFrame(
+        np.exp(np.random.randn(60, 6).cumsum(axis=0) * 0.01) * 100,
+        index=pd.date_range('2010-01-01', periods=60), columns=names)
+
+    def backtests():
+        s1 = bt.Strategy('s1', [bt.algos.RunWeekly(), bt.algos.SelectAll(),
+                                bt.algos.WeighEqually(),
+                                bt.algos.Rebalance()], names[:3])
+        s2 = bt.Strategy('s2', [bt.algos.RunMonthly(), bt.algos.SelectAll(),
+                                bt.algos.WeighInvVol(),
+                                bt.algos.Rebalance()], names[2:])
+        m = bt.Strategy('m', [bt.algos.RunMonthly(), bt.algos.SelectAll(),
+                              bt.algos.WeighEqually(),
+                              bt.algos.Rebalance()], [s1, s2, 'c5'])
+        return [bt.Backtest(s, data, progress_bar=False,
+                            commissions=bt.core.LinearCommission(1., 0.01))
+                for s in [s1, s2, m]]
+
+    expected = bt.run(*backtests())
+
+    for executor in ['process', 'thread']:
+        res = bt.run(*backtests(), n_jobs=2, executor=executor)
+        for name in ['s1', 's2', 'm']:
+            e = expected.backtests[name]
+            r = res.backtests[name]
+            assert r.has_run
+            assert e.strategy.prices.equals(r.strategy.prices)
+            assert e.weights.equals(r.weights)
+            assert e.security_weights.equals(r.security_weights)
+            assert e.strategy.outlays.equals(r.strategy.outlays)
+            assert expected.get_transactions(name).equals(
+                res.get_transactions(name))
+        assert np.allclose(expected.stats.loc['cagr'].values.astype(float),
+                           res.stats.loc['cagr'].values.astype(float))
+
+        # the algos' state is left in process workers
+        r = res.backtests['m']
+        row = data[-1:].copy()
+        row.index = row.index + pd.DateOffset(days=1)
+        for carry_on in [lambda: r.append_data(row), r.checkpoint]:
+            try:
+                carry_on()
+                assert executor == 'thread'
+            except ValueError:
+                assert executor == 'process'
+
+    # data is matched by identity before being compared
+    other = data.copy()
+    assert bt.backtest._find_data([other, data], data) == 1
+    assert bt.backtest._find_data([other], data) == 0
+    assert bt.backtest._find_data([other], data * 2) == -1
+
+    try:
+        bt.run(*backtests(), n_jobs=2, executor='cluster')
+        assert False
+    except ValueError:
+        pass
+
+
+def test_benchmark_random():
+    np.random.seed(0)
+    data = pd.DataFrame(
+        np.exp(np.random.randn(80, 5).cumsum(axis=0) * 0.01) * 100,
+        index=pd.date_range('2010-01-01', periods=80),
+        columns=['c%s' % i for i in range(5)])
+
+    s = bt.Strategy('s', [bt.algos.RunWeekly(), bt.algos.SelectAll(),
+                          bt.algos.WeighEqually(), bt.algos.Rebalance()])
+    r = bt.Strategy('r', [bt.algos.RunWeekly(), bt.algos.SelectRandomly(2),
+                          bt.algos.WeighRandomly(), bt.algos.Rebalance()])
+    t = bt.Backtest(s, data, progress_bar=False)
+
+    state = np.random.get_state()
+    res = bt.backtest.benchmark_random(t, r, nsim=4, seed=1)
+    # the caller's generators are left untouched
+    assert (np.random.get_state()[1] == state[1]).all()
+
+    assert res.base_name == 's'
+    assert list(res.r_stats.columns) == ['random_%s' % i for i in range(4)]
+    assert len(res.backtest_list) == 5
+    cagr = res.r_stats.loc['cagr'].astype(float)
+    assert cagr.nunique() == 4
+
+    for kwargs in [dict(n_jobs=2), dict(stream=True),
+                   dict(n_jobs=2, stream=True),
+                   dict(n_jobs=2, executor='thread')]:
+        other = bt.backtest.benchmark_random(t, r, nsim=4, seed=1, **kwargs)
+        assert np.allclose(other.r_stats.loc['cagr'].astype(float), cagr)
+        assert other.b_stats.equals(res.b_stats)
+        if kwargs.get('stream'):
+            assert len(other.backtest_list) == 1
+
+    other = bt.backtest.benchmark_random(t, r, nsim=4, seed=2)
+    assert not np.allclose(other.r_stats.loc['cagr'].astype(float), cagr)
+
+
+def test_shared_universe():
+    np.random.seed(0)
+    data = pd.DataFrame(
+        np.exp(np.random.randn(60, 4).cumsum(axis=0) * 0.01) * 100,
+        index=pd.date_range('2010-01-01', periods=60),
+        columns=['c%s' % i for i in range(4)])
+    shared = bt.backtest.SharedUniverse(data)
+
+    def backtest(d, name):
+        s = bt.Strategy('s', [bt.algos.RunWeekly(), bt.algos.SelectAll(),
+                              bt.algos.WeighEqually(), bt.algos.Rebalance()])
+        return bt.Backtest(s, d, name=name, progress_bar=False)
+
+    t = backtest(shared, 's')
+    expected = backtest(data, 's')
+    assert t.data.equals(expected.data)
+    # read-only view on the file
+    assert not t.data.values.flags.writeable
+
+    res = bt.run(t, backtest(shared, 's2'), n_jobs=2)
+    expected = bt.run(expected)
+    for name in ['s', 's2']:
+        assert res.backtests[name].strategy.prices.equals(
+            expected.backtests['s'].strategy.prices)
+
+    path = shared.path
+    shared.close()
+    assert not os.path.exists(path)
+
+
+def test_add_t0():
+    s = bt.Strategy('s', [bt.algos.RunDaily(), bt.algos.SelectAll(),
+                          bt.algos.WeighEqually(), bt.algos.Rebalance()])
+    data = pd.DataFrame(index=pd.date_range('2010-01-01', periods=5),
+                        columns=['a', 'b'], data=100.)
+
+    t1 = bt.Backtest(s, data, progress_bar=False)
+    assert np.isnan(t1.data.iloc[0]).all()
+    assert t1.data.index[0] == data.index[0] - pd.DateOffset(days=1)
+    assert t1.data.iloc[1:].equals(data)
+
+    # same frame as with mixed types
+    mixed = data.astype({'b': int})
+    t2 = bt.Backtest(s, mixed, progress_bar=False)
+    assert t2.data.equals(t1.data)
+
+    # the data is copied - changing it afterwards has no effect
+    data.iloc[2, 0] = 200.
+    assert t1.data.iloc[3, 0] == 100.
+    t3 = bt.Backtest(s, data, progress_bar=False)
+    assert t3.data.iloc[3, 0] == 200.
@@ -4,6 +4,7 @@ import copy
 
 import bt
 from bt.core import Node, StrategyBase, SecurityBase, AlgoStack, Strategy
+from bt.core import LinearCommission, MinimumCommission, TieredCommission
 import pandas as pd
 import numpy as np
 from nose.tools import assert_almost_equal as aae
@@ -173,6 +174,98 @@ def test_strategybase_tree_setup():
     assert len(c2._values) == 3
 
 
+def test_strategybase_tree_store():
+    c1 = SecurityBase('c1')
+    s = StrategyBase('p', [c1, 'c2'])
+
+    c1 = s['c1']
+    c2 = s['c2']
+
+    dts = pd.date_range('2010-01-01', periods=3)
+    data = pd.DataFrame(index=dts, columns=['c1', 'c2'], data=100.)
+
+    s.setup(data)
+
+    # whole tree shares one store, one column per node
+    assert c1._store is s._store
+    assert c2._store is s._store
+    assert len(set([s._col, c1._col, c2._col])) == 3
+    assert s._store.ncols == 3
+
+    s.update(dts[0])
+    s.adjust(1000)
+    s.allocate(500, 'c1')
+    s.update(dts[0])
+
+    # data is a view on the store
+    assert c1.data['position'][dts[0]] == 5
+    assert s._store.position[0, c1._col] == 5
+    assert s.data['value'][dts[0]] == 1000
+    assert s._store.value[0, s._col] == 1000
+
+    s.update(dts[1])
+    assert c1.values[dts[1]] == 500
+    assert s.values[dts[1]] == 1000
+
+
+def test_strategybase_tree_store_growth():
+    s = StrategyBase('p')
+
+    dts = pd.date_range('2010-01-01', periods=3)
+    data = pd.DataFrame(index=dts, columns=['c1', 'c2', 'c3'], data=100.)
+
+    s.setup(data)
+    s.update(dts[0])
+    s.adjust(1000)
+
+    # children created on allocation are added to the store, which grows
+    # without moving existing columns
+    s.allocate(100, 'c1')
+    s.allocate(200, 'c2')
+    s.allocate(300, 'c3')
+    s.update(dts[0])
+
+    c1 = s['c1']
+    c2 = s['c2']
+    c3 = s['c3']
+    assert s._store.ncols == 4
+    assert c3._store is s._store
+    assert c1.data['position'][dts[0]] == 1
+    assert c2.data['position'][dts[0]] == 2
+    assert c3.data['position'][dts[0]] == 3
+
+    s.update(dts[1])
+    assert c1.values[dts[1]] == 100
+    assert c3.values[dts[1]] == 300
+    assert s.values[dts[1]] == 1000
+
+
+def test_row_buffer():
+    values = np.arange(6.).reshape(3, 2)
+    buf = bt.core._RowBuffer(values)
+
+    # the first growth copies the rows, with room for as many again
+    b1 = buf.extend(4, 3)
+    assert b1 is buf
+    b1.array[3:] = 6.
+    assert b1.array.shape == (4, 2)
+    assert b1._buf.shape == (6, 2)
+    assert not np.shares_memory(b1.array, values)
+    assert b1.array[:3].tolist() == values.tolist()
+
+    # rows are then added in place
+    rows = b1._buf
+    assert b1.extend(6, 4) is b1
+    assert b1._buf is rows
+
+    # a holder of the first rows does not see the rows added by another
+    b2 = b1.extend(5, 4)
+    assert b2 is not b1
+    assert b1.array.shape == (6, 2)
+    assert b2.array[:4].tolist() == b1.array[:4].tolist()
+    assert not np.shares_memory(b2.array, b1.array)
+
+
 def test_strategybase_tree_adjust():
     c1 = SecurityBase('c1')
     c2 = SecurityBase('c2')
@@ -519,6 +612,44 @@ def test_strategybase_universe():
     assert len(s.children) == 0
 
 
+def test_strategybase_universe_positional():
+    s = StrategyBase('s')
+
+    dts = pd.date_range('2010-01-01', periods=5)
+    data = pd.DataFrame(index=dts, columns=['c1', 'c2'],
+                        data=np.arange(10.).reshape(5, 2))
+
+    s.setup(data)
+    s.update(dts[3])
+
+    assert s.inow == 3
+    assert len(s.universe) == 4
+    assert np.array_equal(s.universe_row, [6., 7.])
+
+    # int lookback and lag are in rows
+    assert s.universe_rows(2) == (2, 4)
+    assert s.universe_rows(2, 1) == (1, 3)
+    assert s.universe_rows(10) == (0, 4)
+    assert s.universe_rows(2, 5) == (0, 0)
+    assert np.array_equal(s.universe_window(2), data.values[2:4])
+
+    # DateOffsets behave like .loc[now - lag - lookback:now - lag]
+    lb = pd.DateOffset(days=2)
+    lag = pd.DateOffset(days=1)
+    assert np.array_equal(s.universe_window(lb, lag),
+                          data.loc[dts[0]:dts[2]].values)
+    assert np.array_equal(s.universe_window(lb),
+                          data.loc[dts[1]:dts[3]].values)
+
+    # never past now
+    assert s.universe_rows(2, pd.DateOffset(days=-5)) == (2, 4)
+
+    # the universe follows now even when inow is not set with it
+    s.now = dts[1]
+    assert len(s.universe) == 2
+    assert s.universe.index[-1] == dts[1]
+
+
 def test_strategybase_allocate():
     s = StrategyBase('s')
 
@@ -1692,6 +1823,183 @@ def test_strategybase_tree_rebalance_base():
     assert c1.weight == 400.0 / 998
 
 
+def test_strategybase_tree_rebalance_many():
+    s = StrategyBase('p')
+    s.set_commissions(lambda q, p: 1)
+
+    dts = pd.date_range('2010-01-01', periods=3)
+    data = pd.DataFrame(index=dts, columns=['c1', 'c2', 'c3'], data=100.)
+    data['c3'][dts[0]] = np.nan
+
+    s.setup(data)
+    s.update(dts[0])
+    s.adjust(1000)
+
+    # unlike successive rebalance calls, the commission of the first trade
+    # does not change the allocation of the second one
+    s.rebalance_many({'c1': 0.5, 'c2': 0.5})
+
+    c1 = s['c1']
+    c2 = s['c2']
+    assert list(s.children) == ['c1', 'c2']
+    assert c1.position == 4
+    assert c2.position == 4
+    assert s.capital == 1000 - 401 - 401
+    assert s.value == 998
+    assert c1.outlays[dts[0]] == 400
+    assert c2.outlays[dts[0]] == 400
+    assert s.fees[dts[0]] == 2
+
+    # 0 closes, NaN is skipped
+    s.rebalance_many(pd.Series({'c1': 0., 'c2': 0.25}))
+    assert c1.position == 0
+    assert c2.position == 2
+    assert s.value == 996
+
+    s.rebalance_many(np.array([np.nan, 0.5, np.nan]))
+    assert c1.position == 0
+    assert c2.position == 4
+
+    # weights of 0 do not create children
+    s.rebalance_many({'c3': 0.})
+    assert 'c3' not in s.children
+
+    try:
+        s.rebalance_many({'c3': 0.1})
+        assert False
+    except Exception as e:
+        assert str(e).startswith('Cannot allocate capital to c3')
+
+
+def test_strategybase_tree_rebalance_many_subclass():
+    calls = []
+
+    class Sec(SecurityBase):
+        def allocate(self, amount, update=True):
+            calls.append((self.name, amount))
+            SecurityBase.allocate(self, amount, update=update)
+
+    s = StrategyBase('p', children=[Sec('c1'), 'c2'])
+    dts = pd.date_range('2010-01-01', periods=3)
+    data = pd.DataFrame(index=dts, columns=['c1', 'c2'], data=100.)
+
+    s.setup(data)
+    s.update(dts[0])
+    s.adjust(1000)
+
+    # subclasses of SecurityBase go through their own allocate
+    s.rebalance_many({'c1': 0.5, 'c2': 0.5})
+    assert calls == [('c1', 500.)]
+    assert s['c1'].position == 5
+    assert s['c2'].position == 5
+    assert type(s['c2']) is SecurityBase
+
+
+def test_strategybase_tree_rebalance_many_matches_rebalance():
+    dts = pd.date_range('2010-01-01', periods=3)
+    data = pd.DataFrame(index=dts, columns=['c1', 'c2', 'c3'], data=100.)
+    data['c2'][dts[1]] = 90.
+
+    def run(many):
+        s = StrategyBase('p', [Strategy('s1', children=['c1', 'c2']), 'c3'])
+        s.use_integer_positions(False)
+        s.setup(data)
+        s.update(dts[0])
+        s.adjust(1000)
+        s['s1'].rebalance(0.5, 'c1')
+        s.update(dts[1])
+
+        base = s['s1'].value
+        if many:
+            s['s1'].rebalance_many({'c1': 0.2, 'c2': -0.3}, base=base)
+            s.rebalance_many({'s1': 0.4, 'c3': 0.6})
+        else:
+            s['s1'].rebalance(0.2, 'c1', base=base)
+            s['s1'].rebalance(-0.3, 'c2', base=base)
+            s.rebalance(0.4, 's1')
+            s.rebalance(0.6, 'c3')
+        return s
+
+    a, b = run(False), run(True)
+    assert np.isclose(a['s1']['c1'].position, b['s1']['c1'].position)
+    assert np.isclose(a['s1']['c2'].position, b['s1']['c2'].position)
+    assert np.isclose(a['c3'].position, b['c3'].position)
+    assert np.isclose(a['s1'].value, b['s1'].value)
+    assert np.isclose(a.value, b.value)
+
+
+def test_strategybase_tree_stale_update_skips_clean_children():
+    s1 = StrategyBase('s1', ['c1', 'c2'])
+    s2 = StrategyBase('s2', ['c1', 'c2'])
+    m = StrategyBase('m', [s1, s2])
+
+    s1 = m['s1']
+    s2 = m['s2']
+
+    dts = pd.date_range('2010-01-01', periods=3)
+    data = pd.DataFrame(index=dts, columns=['c1', 'c2'], data=100.)
+
+    m.setup(data)
+    m.update(dts[0])
+    m.adjust(1000)
+    m.allocate(500, 's1')
+    m.allocate(500, 's2')
+    s1.rebalance(1., 'c1')
+    s2.rebalance(1., 'c2')
+    m.update(dts[1])
+
+    assert not m._dirty
+    assert not s1._dirty
+    assert not s2._dirty
+
+    # only the path from s1 to the root is flagged
+    s1.rebalance(0.5, 'c2')
+    assert s1._dirty
+    assert m._dirty
+    assert not s2._dirty
+    assert m.stale
+
+    s2.update = mock.MagicMock(side_effect=s2.update)
+    assert m.value == 1000
+    assert s1['c2'].position == 2
+    assert s1.value == 500
+    assert not s2.update.called
+
+    # a date change still updates everything
+    m.update(dts[2])
+    assert s2.update.called
+
+
+def test_strategybase_active_children():
+    s = StrategyBase('p')
+
+    dts = pd.date_range('2010-01-01', periods=4)
+    data = pd.DataFrame(index=dts, columns=['c1', 'c2', 'c3'], data=100.)
+
+    s.setup(data)
+    s.update(dts[0])
+    s.adjust(1000)
+
+    s.rebalance_many({'c1': 0.5, 'c2': 0.5})
+    s.update(dts[1])
+    assert set(c.name for c in s._activev) == set(['c1', 'c2'])
+
+    s.close('c1')
+    s.rebalance(0.2, 'c3')
+    s.update(dts[2])
+    s.update(dts[3])
+    assert set(c.name for c in s._activev) == set(['c2', 'c3'])
+    assert len(s.children) == 3
+    assert s['c1'].position == 0
+    assert s['c1'].values[dts[2]] == 0
+    assert s.value == 1000
+
+    # reactivated on allocation
+    s.rebalance(0.1, 'c1')
+    assert s['c1'] in s._activev
+    assert s['c1'].position == 1
+
+
 def test_algo_stack():
     a1 = mock.MagicMock(return_value=True)
     a2 = mock.MagicMock(return_value=False)
@@ -1881,6 +2189,308 @@ def test_strategy_tree_paper():
     assert np.allclose(s.price, 100. * (102 / 101.))
 
 
+def test_strategy_tree_strat_children_universe():
+    dts = pd.date_range('2010-01-01', periods=3)
+    data = pd.DataFrame(index=dts, columns=['a', 'b'], data=100.)
+    data['a'][dts[1]] = 110
+    data['b'][dts[2]] = 90
+
+    s1 = Strategy('s1', [bt.algos.SelectThese(['a']),
+                         bt.algos.WeighEqually(),
+                         bt.algos.Rebalance()])
+    s2 = Strategy('s2', [bt.algos.SelectThese(['b']),
+                         bt.algos.WeighEqually(),
+                         bt.algos.Rebalance()])
+    m = Strategy('m', [], [s1, s2])
+
+    m.setup(data)
+    for dt in dts:
+        m.update(dt)
+        m.run()
+        m.update(dt)
+
+    universe = m.universe
+    assert list(universe.columns) == ['s1', 's2']
+    assert np.allclose(universe['s1'], m['s1'].prices)
+    assert np.allclose(universe['s2'], m['s2'].prices)
+    aae(universe['s1'][dts[1]], 110)
+    aae(universe['s2'][dts[2]], 90)
+
+    # strategy children have data once their prices are written
+    assert m.universe_has_data.tolist() == [True, True]
+    assert m._has_data.all()
+
+
+def test_strategy_universe_has_data():
+    dts = pd.date_range('2010-01-01', periods=3)
+    data = pd.DataFrame(index=dts, columns=['a', 'b', 'c'], data=100.)
+    data['a'][dts[0]] = np.nan
+    data['b'][dts[1]] = 0.
+    data['c'][dts[2]] = -1.
+
+    s = Strategy('s')
+    s.setup(data)
+    expected = [[False, True, True], [True, False, True],
+                [True, True, False]]
+    for i, dt in enumerate(dts):
+        s.update(dt)
+        assert s.universe_has_data.tolist() == expected[i]
+
+    s.update(dts[1])
+    assert bt.algos.SelectAll()(s)
+    assert s.temp['selected'] == ['a', 'c']
+    assert bt.algos.SelectThese(['c', 'b'])(s)
+    assert s.temp['selected'] == ['c']
+
+    # built once per universe
+    s2 = Strategy('s2')
+    s2.setup(data)
+    s2.update(dts[1])
+    assert s2._has_data is None
+    assert s2.universe_has_data.tolist() == expected[1]
+    assert s2._has_data is s._has_data
+
+
+def test_strategy_universe_counts():
+    dts = pd.date_range('2010-01-01', periods=30)
+    np.random.seed(2)
+    data = pd.DataFrame(np.random.rand(30, 3) + 1, index=dts,
+                        columns=['a', 'b', 'c'])
+    data[data < 1.3] = np.nan
+
+    s1 = Strategy('s1', [], ['a', 'b'])
+    m = Strategy('m', [], [s1, 'c'])
+    m.setup(data)
+
+    for i, dt in enumerate(dts):
+        m.update(dt)
+        m.run()
+        m.update(dt)
+        for lookback in [1, 5, pd.DateOffset(days=7)]:
+            start, stop = m.universe_rows(lookback)
+            window = m.universe_window(lookback)
+            assert m.universe_counts(start, stop).tolist() == \
+                (~np.isnan(window)).sum(axis=0).tolist()
+
+    # the strategy child's column is counted as its prices are written
+    counts = m.universe_counts(0, len(dts))
+    assert counts[m.universe.columns.get_loc('s1')] == len(dts)
+    assert counts[m.universe.columns.get_loc('c')] == data['c'].count()
+
+
+def test_strategy_universe_returns():
+    dts = pd.date_range('2010-01-01', periods=30)
+    np.random.seed(3)
+    data = pd.DataFrame(np.random.rand(30, 3) + 1, index=dts,
+                        columns=['a', 'b', 'c'])
+
+    s1 = Strategy('s1', [], ['a', 'b'])
+    m = Strategy('m', [], [s1, 'c'])
+    m.setup(data)
+
+    windows = [(1, 0), (5, 0), (5, 2), (pd.DateOffset(days=7), 0),
+               (pd.DateOffset(days=7), pd.DateOffset(days=3)),
+               (4, pd.DateOffset(days=2))]
+
+    for i, dt in enumerate(dts):
+        m.update(dt)
+        m.run()
+        m.update(dt)
+        for lookback, lag in windows:
+            start, stop = m.universe_rows(lookback, lag)
+            if start == stop:
+                try:
+                    m.universe_returns(lookback, lag)
+                    assert False
+                except IndexError:
+                    pass
+                continue
+            window = m.universe_window(lookback, lag)
+            assert np.array_equal(m.universe_returns(lookback, lag),
+                                  window[-1] / window[0] - 1)
+
+    # the windows are found once per index, lookback and lag, and shared by
+    # the strategies with the same dates
+    m2 = Strategy('m2')
+    m2.setup(data)
+    m3 = Strategy('m3', [], ['a', 'b', 'c'])
+    m3.setup(data)
+    m2.update(dts[10])
+    m3.update(dts[10])
+    starts = bt.core._window_bounds(m2._universe.index, 5, 0)[0]
+    assert bt.core._window_bounds(m3._universe.index, 5, 0)[0] is starts
+    assert bt.core._window_bounds(data.index, 4, 0)[0] is not starts
+    assert pd.Series(m3.universe_returns(5), m3.universe.columns).equals(
+        pd.Series(m2.universe_returns(5), m2.universe.columns)[
+            m3.universe.columns])
+
+    # only the windows of new dates are found when the index grows
+    lookback = pd.DateOffset(days=7)
+    old = bt.core._window_bounds(dts[:20], lookback, 0)
+    new = bt.core._window_bounds(dts, lookback, 0)
+    assert len(new[0]) == 30
+    for rows, expected in zip(new, bt.core._window_rows(dts, lookback, 0)):
+        assert np.array_equal(rows, expected)
+    assert np.array_equal(new[0][:20], old[0])
+
+
+def test_strategy_tree_light_paper():
+    dts = pd.date_range('2010-01-01', periods=60)
+    np.random.seed(0)
+    data = pd.DataFrame(
+        100 * np.exp(np.cumsum(np.random.randn(60, 4) * 0.01, axis=0)),
+        index=dts, columns=['a', 'b', 'c', 'd'])
+
+    weights = pd.DataFrame(index=dts, columns=['s1', 's2'], data=0.)
+    weights['s1'] = 1.
+    weights.iloc[30:] = 0.5
+
+    def run(light):
+        s1 = Strategy('s1', [bt.algos.RunWeekly(),
+                             bt.algos.SelectThese(['a', 'b']),
+                             bt.algos.WeighEqually(),
+                             bt.algos.Rebalance()])
+        s2 = Strategy('s2', [bt.algos.RunWeekly(),
+                             bt.algos.SelectThese(['c', 'd']),
+                             bt.algos.WeighEqually(),
+                             bt.algos.Rebalance()])
+        m = Strategy('m', [bt.algos.WeighTarget(weights),
+                           bt.algos.Rebalance()], [s1, s2])
+        if light:
+            m.use_light_paper_trade()
+        t = bt.Backtest(m, data, commissions=lambda q, p: abs(q) * 0.01,
+                        progress_bar=False)
+        t.run()
+        return t.strategy
+
+    full = run(False)
+    light = run(True)
+
+    assert full['s1']._paper is not None
+    assert light['s1']._paper is None
+    assert light['s1'].light_paper_trade
+
+    for c in ['s1', 's2']:
+        assert np.allclose(light[c].prices, full[c].prices, rtol=1e-12)
+        assert np.allclose(light[c].values, full[c].values, rtol=1e-12)
+    assert np.allclose(light.prices, full.prices, rtol=1e-12)
+
+
+def test_strategy_tree_light_paper_mirror():
+    dts = pd.date_range('2010-01-01', periods=60)
+    np.random.seed(1)
+    data = pd.DataFrame(
+        100 * np.exp(np.cumsum(np.random.randn(60, 4) * 0.01, axis=0)),
+        index=dts, columns=['a', 'b', 'c', 'd'])
+
+    class Trade(bt.Algo):
+
+        # trades without the Rebalance algo
+        def __call__(self, target):
+            x, y = target.universe.columns
+            if target.inow % 10 == 1:
+                target.rebalance(0.6, x)
+                target.allocate(0.3 * target.value, y)
+            elif target.inow % 10 == 6:
+                target.close(x)
+                target.rebalance_many({y: 0.5})
+            return True
+
+    def run(light):
+        s1 = Strategy('s1', [Trade()], ['a', 'b'])
+        s2 = Strategy('s2', [Trade()], ['c', 'd'])
+        m = Strategy('m', [bt.algos.RunWeekly(), bt.algos.SelectAll(),
+                           bt.algos.WeighEqually(), bt.algos.Rebalance()],
+                     [s1, s2])
+        if light:
+            m.use_light_paper_trade()
+        t = bt.Backtest(m, data, commissions=lambda q, p: abs(q) * 0.01,
+                        progress_bar=False)
+        t.run()
+        return t.strategy
+
+    full = run(False)
+    light = run(True)
+
+    assert light['s1']._paper is None
+    for c in ['s1', 's2']:
+        assert np.allclose(light[c].prices, full[c].prices, rtol=1e-12)
+        assert np.allclose(light[c].values, full[c].values, rtol=1e-12)
+    assert np.allclose(light.prices, full.prices, rtol=1e-12)
+    # the paper trades follow the prices
+    assert light['s1'].prices.iloc[-1] != 100.
+
+
+def test_strategy_clone():
+    dts = pd.date_range('2010-01-01', periods=3)
+    data = pd.DataFrame(index=dts, columns=['a', 'b'], data=100.)
+    weights = pd.DataFrame(index=dts, columns=['a', 'b'], data=0.5)
+
+    s = Strategy('s', [bt.algos.WeighTarget(weights),
+                       bt.algos.Rebalance()])
+    m = Strategy('m', [bt.algos.RunOnce()], [s])
+
+    c = m.clone()
+
+    assert c is not m
+    assert c.stack is not m.stack
+    assert c.stack.algos[0] is not m.stack.algos[0]
+    # pandas inputs are shared
+    assert c['s'].stack.algos[0].weights is weights
+
+    # tree wiring points to the clones
+    assert c['s'] is not m['s']
+    assert c['s'].parent is c
+    assert c['s'].root is c
+    assert c['s'] in c._childrenv
+    assert m['s'].parent is m
+
+    # and state is independent
+    c.setup(data)
+    c.update(dts[0])
+    c.adjust(1000)
+    c['s'].allocate(1000)
+    c['s'].run()
+
+    assert c['s'].value == 1000
+    assert c['s']['a'].position == 5
+    assert not hasattr(m['s'], 'data')
+
+    # sub-tree clones keep the original parent
+    sc = m['s'].clone()
+    assert sc is not m['s']
+    assert sc.parent is m
+
+    # clones of a tree that has run share none of its run state
+    s = Strategy('s', [bt.algos.SelectAll(), bt.algos.WeighEqually(),
+                       bt.algos.RebalanceOverTime(n=3)], ['a', 'b'])
+    s.use_light_paper_trade(True)
+    m = Strategy('m', [bt.algos.SelectAll(), bt.algos.WeighEqually(),
+                       bt.algos.Rebalance()], [s])
+    m.setup(data)
+    m.update(dts[0])
+    m.adjust(1000)
+    m.run()
+    m.update(dts[1])
+
+    c = m.clone()
+    assert c._store is None
+    assert c['s']._store is None
+    assert c['s']._paper is None
+    for k in ['_universe_values', '_buffers', '_paper_positions']:
+        assert k not in c['s'].__dict__
+    assert c['s'].stack.algos[2]._weights == \
+        m['s'].stack.algos[2]._weights
+    assert c['s'].stack.algos[2]._weights is not \
+        m['s'].stack.algos[2]._weights
+
+    # the original carries on
+    m.run()
+    m.update(dts[2])
+    assert m['s'].value > 0
+    assert m['s']._paper_positions.any()
+
+
 def test_outlays():
     c1 = SecurityBase('c1')
     c2 = SecurityBase('c2')
@@ -2020,6 +2630,145 @@ def test_fixed_commissions():
     assert s.capital == 198 + 199 - 101 + 499 + 199
 
 
+def test_fixed_commissions_model():
+    # same as test_fixed_commissions, solved in closed form
+    c1 = SecurityBase('c1')
+    c2 = SecurityBase('c2')
+    s = StrategyBase('p', [c1, c2])
+    s.set_commissions(LinearCommission(fixed=1.))
+
+    c1 = s['c1']
+    c2 = s['c2']
+
+    dts = pd.date_range('2010-01-01', periods=3)
+    data = pd.DataFrame(index=dts, columns=['c1', 'c2'], data=100)
+
+    s.setup(data)
+    s.update(dts[0])
+    s.adjust(1000)
+
+    c1.allocate(500)
+    c2.allocate(500)
+    s.update(dts[0])
+
+    assert c1.value == 400
+    assert c2.value == 400
+    assert s.capital == 198
+
+    c1.allocate(-100)
+    s.update(dts[0])
+
+    assert c1.value == 200
+    assert s.capital == 198 + 199
+
+    c2.allocate(100)
+    s.update(dts[0])
+
+    assert c2.value == 400
+
+    c2.allocate(101)
+    s.update(dts[0])
+
+    assert c2.value == 500
+    assert s.capital == 198 + 199 - 101
+
+    c2.allocate(-500)
+    c2.allocate(-100)
+    s.update(dts[0])
+
+    assert c2.value == -200
+    assert s.capital == 198 + 199 - 101 + 499 + 199
+
+
+def test_commission_models():
+    lin = LinearCommission(fixed=1., per_unit=0.01, rate=0.001)
+    aae(lin(-100, 20.), 1. + 1. + 2.)
+
+    mn = MinimumCommission(1., per_unit=0.01)
+    assert mn(50, 20.) == 1.
+    aae(mn(-500, 20.), 5.)
+
+    tier = TieredCommission([(0, 0.01), (100, 0.005)])
+    aae(tier(50, 20.), 0.5)
+    aae(tier(-300, 20.), 1. + 1.)
+
+    try:
+        TieredCommission([(100, 0.01)])
+        assert False
+    except ValueError:
+        pass
+
+    amounts = np.array([1000., 12345.6, -2000., -50000., 0.5])
+    prices = np.array([20., 3.3, 45., 1.1, 20.])
+    for m in [lin, mn, tier]:
+        for integer in [False, True]:
+            q = m.solve(amounts, prices, integer)
+
+            # scalar and array paths agree
+            for i in range(len(q)):
+                aae(m.solve(amounts[i], prices[i], integer), q[i])
+
+            t = q != 0
+            full = q[t] * prices[t] + m(q[t], prices[t])
+            if integer:
+                # largest integer quantity that fits the amount
+                assert (full <= amounts[t] + 1e-9).all()
+                more = (q[t] + 1) * prices[t] + m(q[t] + 1, prices[t])
+                assert (more > amounts[t]).all()
+            else:
+                assert np.allclose(full, amounts[t])
+
+    # cannot cover the fixed fee - no trade
+    assert lin.solve(0.5, 20.) == 0
+
+    # fee grows faster than the proceeds of a sale - no closed form
+    assert np.isnan(LinearCommission(per_unit=2.).solve(-100., 1.))
+    assert np.isnan(lin.solve(100., 0.))
+
+
+def test_commission_model_matches_function():
+    dts = pd.date_range('2010-01-01', periods=3)
+    data = pd.DataFrame(index=dts, columns=['c1'], data=37.3)
+
+    for integer in [True, False]:
+        res = []
+        for fn in [lambda q, p: max(1, abs(q) * 0.01),
+                   MinimumCommission(1., per_unit=0.01)]:
+            s = StrategyBase('s')
+            s.setup(data)
+            s.update(dts[0])
+            s.use_integer_positions(integer)
+            s.set_commissions(fn)
+            s.adjust(100000)
+            s.allocate(12345.6, 'c1')
+            s.allocate(-5000.1, 'c1')
+            s.allocate(-20000, 'c1')
+            s.update(dts[0])
+            res.append((s['c1'].position, s.capital))
+
+        aae(res[0][0], res[1][0])
+        aae(res[0][1], res[1][1])
+
+    # the iterations work on arrays for models as for functions
+    amounts = np.array([1000., 12345.6, -2000., -50000.])
+    prices = np.array([20., 3.3, 45., 1.1])
+    fn = MinimumCommission(1., per_unit=0.01)
+    for integer in [True, False]:
+        q = amounts / prices
+        if integer:
+            q = np.floor(q)
+        assert np.allclose(
+            bt.core._fit_quantities(q, amounts, prices, fn, integer,
+                                    solve=False),
+            bt.core._fit_quantities(q, amounts, prices,
+                                    lambda x, y: max(1, abs(x) * 0.01),
+                                    integer))
+
+    # as for the default function, which charges nothing
+    fn = StrategyBase('s').commission_fn
+    assert (bt.core._commissions(fn, amounts, prices) == 0).all()
+
+
 def test_degenerate_shorting():
     # can have situation where you short infinitely if commission/share > share
     # price
@@ -2048,6 +2797,36 @@ def test_degenerate_shorting():
         assert 'full_outlay should always be approaching amount' in str(e)
 
 
+def test_trade_ledger():
+    s = StrategyBase('p')
+    s.set_commissions(lambda q, p: 1.)
+
+    dts = pd.date_range('2010-01-01', periods=3)
+    data = pd.DataFrame(index=dts, columns=['c1', 'c2'], data=100.)
+    data['c2'][dts[1]] = 50.
+    s.setup(data)
+
+    s.update(dts[0])
+    s.adjust(1000)
+    s.rebalance_many({'c1': 0.5, 'c2': 0.5})
+
+    s.update(dts[1])
+    s.rebalance(0, 'c2')
+    s['c1'].allocate(-100)
+
+    trades = s._store.trades.records
+    assert len(trades) == 4
+    assert list(trades['date']) == [0, 0, 1, 1]
+    assert list(trades['node']) == [s['c1']._col, s['c2']._col,
+                                    s['c2']._col, s['c1']._col]
+    assert list(trades['quantity']) == [4, 4, -4, -2]
+    assert list(trades['price']) == [100, 100, 50, 100]
+    assert list(trades['fee']) == [1, 1, 1, 1]
+    assert list(trades['outlay']) == [400, 400, -200, -200]
+
+    assert s.positions['c1'][dts[1]] == 2
+
+
 def test_securitybase_allocate():
     c1 = SecurityBase('c1')
     s = StrategyBase('p', [c1])